@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
-import urllib.request
-from urllib.error import URLError, HTTPError
-from http.client import InvalidURL
+import asyncio
+import aiohttp
+from urllib.parse import urlsplit
 import tldextract
 import json
 import sys
@@ -10,7 +10,7 @@ import psycopg2.extras
 import os
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from common.utils import get_args, extract_domain, select_all_domains, insert_domain, approve_domain
+from common.utils import get_args, extract_domain, get_domains_allowing_subdomains, select_all_domains, insert_domain, approve_domain
 
 # Instructions:
 #
@@ -18,15 +18,21 @@ from common.utils import get_args, extract_domain, select_all_domains, insert_do
 # (e.g. michael-lewis.com) or home page links (e.g. https://michael-lewis.com/) each on a new line.
 #
 # Step 2: run `./import.py` or `./import.py --env prod`
-# Make sure that you have your python env set up. If running against dev, make sure your local dev 
+# Make sure that you have your python env set up (including aiohttp). If running against dev, make sure your local dev 
 # is up and running. import.py will do a bunch of checks, e.g. to make sure the site is responding, 
 # that it isn't already in the database, and so on.
+# The sites are checked concurrently, and the result of each check is saved to import-results.jsonl as it completes,
+# so if the checks are interrupted, running again will only check the sites which haven't been checked yet,
+# and the sites whose check failed with a timeout or connection error (which may be temporary), which are checked again.
+# Delete import-results.jsonl to recheck all the sites.
 #
 # Step 3: run `./import.py --update` or `./import.py --env prod --update`
-# To actually import the sites. Note the hardcoded values used during site insert.
+# To actually import the sites. This uses the results in import-results.jsonl rather than checking the sites again.
+# Note the hardcoded values used during site insert.
 
 
 input_file = "import.txt"
+results_file = "import-results.jsonl"
 if not os.path.exists(input_file):
     exit("You need to provide an input file at {}. This ".format(input_file))
 
@@ -38,96 +44,134 @@ moderator = 'michael-lewis.com'
 category = "personal-website"
 tier = 1
 
+# Values used during site checks
+headers = {'Accept': 'text/html', 'User-Agent': 'Python'} # Some sites give a 403 Forbidden if they don't get headers
+max_concurrent_checks = 20
+check_timeout = 30 # seconds for each check, including redirects
+check_connect_timeout = 10 # seconds to connect to each host
+
+# Check a single home page, returning the response code, message and final home page (after any redirects),
+# the redirect chain, i.e. the urls which redirected to the final home page, and whether the check should be retried,
+# i.e. if it failed with a timeout or connection error, which may be temporary, rather than an HTTP response
+async def check_home_page(session, home_page):
+    redirects = []
+    retry = False
+    try:
+        async with session.head(home_page, headers=headers, allow_redirects=True) as resp:
+            redirects = [str(r.url) for r in resp.history]
+            response_code = resp.status
+            if response_code == 308 and 'Location' not in resp.headers: # Some sites return a 308 Permanent Redirect for an http request to be redirected to https but don't provide the Location header
+                redirects.append(home_page)
+                home_page = "https://" + urlsplit(home_page).netloc + "/"
+                async with session.head(home_page, headers=headers, allow_redirects=True) as resp:
+                    redirects.extend([str(r.url) for r in resp.history])
+                    response_code = resp.status
+            home_page = str(resp.url) # Going to get the home page from the response in case there have been redirects
+            if response_code == 200:
+                valid = True
+                message = "Success"
+            else:
+                valid = False
+                message = "HTTPError ({} {})".format(response_code, resp.reason)
+    except asyncio.TimeoutError:
+        valid = False
+        retry = True
+        response_code = "-"
+        message = "Timeout"
+    except aiohttp.ClientError as err:
+        valid = False
+        retry = True
+        response_code = "-"
+        message = "ClientError ({})".format(err)
+    except Exception:
+        valid = False
+        retry = True
+        response_code = "-"
+        message = "Other error ({})".format(sys.exc_info())
+    return valid, response_code, message, home_page, redirects, retry
+
+# Check a line from the input file and append the result to the results file
+async def check_line(session, semaphore, line, results_file):
+    # Get input domain and home_page
+    if line.startswith("http"):
+        home_page = line
+    else:
+        home_page = "http://" + line.lower() + "/"
+    async with semaphore:
+        valid, response_code, message, home_page, redirects, retry = await check_home_page(session, home_page)
+    result = {'input': line, 'valid': valid, 'response_code': response_code, 'message': message, 'home_page': home_page, 'redirects': redirects, 'retry': retry}
+    results_file.write(json.dumps(result) + "\n")
+    results_file.flush()
+    print("Checked {}: {}{}".format(line, message, " (redirected to {})".format(home_page) if redirects else ""))
+    return result
+
+# Check all the lines which aren't already in the results file, or whose check is to be retried, concurrently, with up to max_concurrent_checks at a time
+# Each result is appended to the results file as soon as it is complete, so if the checks are interrupted they can be resumed
+async def check_lines(lines):
+    checked_results = read_results()
+    lines_to_check = [line for line in lines if line not in checked_results or checked_results[line].get('retry')]
+    lines_to_retry = [line for line in lines_to_check if line in checked_results]
+    print("{} lines already checked, {} lines to check (including {} to retry)".format(len(lines) - len(lines_to_check), len(lines_to_check), len(lines_to_retry)))
+    if lines_to_check:
+        semaphore = asyncio.Semaphore(max_concurrent_checks)
+        timeout = aiohttp.ClientTimeout(total=check_timeout, sock_connect=check_connect_timeout)
+        connector = aiohttp.TCPConnector(limit=max_concurrent_checks, limit_per_host=2) # The connections are reused where possible, e.g. for an http to https redirect
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            with open(results_file, 'a') as f:
+                await asyncio.gather(*[check_line(session, semaphore, line, f) for line in lines_to_check])
+    return read_results()
+
+# Read the results file, returning a dict keyed on the input line
+# A line which has been retried has more than one result, in which case the last one is used
+def read_results():
+    results = {}
+    if os.path.exists(results_file):
+        with open(results_file, 'r') as f:
+            for result_line in f:
+                if result_line.strip():
+                    result = json.loads(result_line)
+                    results[result['input']] = result
+    return results
+
 def check_domains(all_domains):
     domains = []
-    headers = {'Accept': 'text/html', 'User-Agent': 'Python'} # Some sites give a 403 Forbidden if they don't get headers
-    f = open(input_file, 'r')
-    lines = f.readlines()
+    with open(input_file, 'r') as f:
+        lines = [line.strip() for line in f.readlines()]
+    lines = [line for line in lines if line != "" and not line.startswith("#")]
+    results = asyncio.run(check_lines(lines))
+    domains_allowing_subdomains = get_domains_allowing_subdomains()
+    all_domains = set(all_domains)
+    domains_in_list = set()
     for line in lines:
-        line = line.strip()
-        if line != "" and not line.startswith("#"):
-            print("\nChecking {}".format(line))
-            result = {}
-
-            # Step 1: Get input domain and home_page
-            if line.startswith("http"):
-                domain = extract_domain(line)
-                home_page = line
-            else:
-                domain = line.lower()
-                home_page = "http://" + domain + "/"
-
-            # Step 2: Get response
-            try:
-                req = urllib.request.Request(home_page, method="HEAD", headers=headers)
-                resp = urllib.request.urlopen(req)
-                home_page = resp.url # Going to get the home page from the response in case there have been redirects
-                domain = extract_domain(home_page)
-                response_code = resp.getcode()
-                if response_code == 200:
-                    valid = True
-                    message = "Success"
-                else:
-                    valid = False
-                    message = "Unknown response code {}".format(response_code)
-            except HTTPError as err:
-                if err.reason == "Permanent Redirect": # Some sites return a 308 Permanent Redirect for an http request to be redirected to https but don't provide the Location header so this throws an HTTPError
-                    try:
-                        home_page = "https://" + domain + "/"
-                        req = urllib.request.Request(home_page, method="HEAD", headers=headers)
-                        resp = urllib.request.urlopen(req)
-                        domain = extract_domain(home_page)
-                        response_code = resp.getcode()
-                        if response_code == 200:
-                            valid = True
-                            message = "Success"
-                    except:
-                            valid = False
-                            response_code = "-"
-                            message = "Error {}".format(response_code)
-                else:
-                    valid = False
-                    response_code = err.code
-                    message = "HTTPError ({})".format(err.reason)
-            except InvalidURL as err:
-                valid = False
-                response_code = resp.getcode()
-                message = "InvalidURL ({})".format(err)
-            except URLError as err:
-                valid = False
-                response_code = resp.getcode()
-                message = "URLError ({})".format(err.reason)
-            except:
-                valid = False
-                response_code = resp.getcode()
-                message = "Other error ({})".format(sys.exc_info())
-
-            # Step 3: See if it is a duplicate entry in the input file
-            if valid:
-                already_in_list = False
-                for d in domains:
-                    if d['domain'] == domain:
-                        already_in_list = True
-
-            # Step 4: See if it is already in the database
-            if valid and not already_in_list:
-                already_in_database = False
-                if domain in all_domains:
-                    already_in_database = True
-
-            if not valid:
-                print("Not valid. Error message: {}.".format(message))
-            elif already_in_list:
-                print("Already in list.")
-            elif already_in_database:
-                print("Already in database.")
-            else:
-                print("Good.")
-                result['domain'] = domain
-                result['home_page'] = home_page
-                domains.append(result)
+        print("\nChecking {}".format(line))
+        result = {}
+        check_result = results[line]
+        valid = check_result['valid']
+        message = check_result['message']
+        home_page = check_result['home_page']
+        domain = extract_domain(home_page, domains_allowing_subdomains)
+
+        # See if it is a duplicate entry in the input file
+        if valid:
+            already_in_list = domain in domains_in_list
+
+        # See if it is already in the database
+        if valid and not already_in_list:
+            already_in_database = domain in all_domains
+
+        if not valid:
+            print("Not valid. Error message: {}.".format(message))
+        elif already_in_list:
+            print("Already in list.")
+        elif already_in_database:
+            print("Already in database.")
+        else:
+            print("Good.")
+            result['domain'] = domain
+            result['home_page'] = home_page
+            domains.append(result)
+            domains_in_list.add(domain)
 
-    f.close()
     return domains
 
 all_domains = select_all_domains()
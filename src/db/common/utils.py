@@ -10,6 +10,7 @@ from urllib.request import urlopen
 parser = argparse.ArgumentParser(description='Utilities for searchmysite.net.', epilog='Needs access to prod, or for there to be a dev env running.')
 parser.add_argument('--env', choices=['dev', 'prod'], default='dev', help='environment to query (default: dev)')
 parser.add_argument('--update', default=False, action="store_true", help='make any data updates (default: False)')
+parser.add_argument('--report', default=None, help='file to write a JSON report to, for the utilities which produce one (default: None)')
 args = parser.parse_args()
 
 DATABASE_HOST = '128.140.125.52' if args.env == 'prod' else 'db'
@@ -34,14 +35,22 @@ def get_args():
     return args
 
 # Solr queries
-solr_domains_with_home_page = "select?fl=domain,url&fq=is_home%3Atrue&q=domain%3A*&sort=domain%20asc&rows=10000"
-solr_domains_with_or_without_home = "select?facet.field=domain&facet.limit=10000&facet.sort=index&facet.mincount=1&facet=true&fq=relationship%3Aparent&indent=true&q.op=OR&q=*%3A*&rows=0&useParams="
+# The home pages are streamed via the export handler (which uses the docValues of the domain and url fields), so aren't subject to a rows limit
+solr_domains_with_home_page = "export?fl=domain,url&q=is_home%3Atrue&sort=domain%20asc"
+solr_domains_with_or_without_home = "select?facet.field=domain&facet.limit=-1&facet.sort=index&facet.mincount=1&facet=true&fq=relationship%3Aparent&q=*%3A*&rows=0"
 
 # SQL
 
 sql_select_all_domains = 'SELECT * FROM tblDomains;' # This returns all domains, even pending ones or moderator rejected or indexing disabled
 
-sql_select_indexing_log_message = "SELECT domain, message FROM tblindexinglog WHERE domain IN ((%s)) AND status = 'COMPLETE' ORDER BY timestamp DESC LIMIT 1;"
+sql_select_indexing_log_message = "SELECT domain, last_complete_message AS message FROM tblIndexingStatusLatest WHERE domain = (%s) AND last_complete_timestamp IS NOT NULL;"
+
+# The indexed domains with their highest active tier and most recent COMPLETE indexing log message, in one query
+sql_select_indexed_domains_with_indexing_log_message = "SELECT DISTINCT ON (d.domain) d.domain, d.home_page, l.tier, s.last_complete_message AS message "\
+    "FROM tblDomains d INNER JOIN tblListingStatus l ON d.domain = l.domain "\
+    "LEFT JOIN tblIndexingStatusLatest s ON d.domain = s.domain "\
+    "WHERE d.indexing_enabled = TRUE AND l.status = 'ACTIVE' "\
+    "ORDER BY d.domain, l.tier DESC;"
 
 # This is a version of ../../web/content/dynamic/searchmysite/sql.py modified to include other fields - if that is updated this should be too
 sql_select_indexed_domains = "SELECT d.domain, d.home_page, l.tier FROM tblDomains d INNER JOIN tblListingStatus l ON d.domain = l.domain WHERE d.indexing_enabled = TRUE AND l.status = 'ACTIVE' ORDER BY domain;"
@@ -100,6 +109,22 @@ def get_solr_domains_with_or_without_home():
             solr_domains.append(result) # result is a list of domains and counts like ["0d.be",50,"0xfab1.net",50,...] so just take the domains
     return solr_domains
 
+# Returns a dict keyed on domain, with a dict of domain, home_page, tier and (most recent COMPLETE indexing log) message for each domain
+def select_indexed_domains_with_indexing_log_message():
+    indexed_domains = {}
+    conn = get_db()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cursor.execute(sql_select_indexed_domains_with_indexing_log_message)
+    results = cursor.fetchall()
+    for result in results:
+        indexed_domain = {}
+        indexed_domain['domain'] = result['domain']
+        indexed_domain['home_page'] = result['home_page']
+        indexed_domain['tier'] = result['tier']
+        indexed_domain['message'] = result['message'] if result['message'] else ""
+        indexed_domains[result['domain']] = indexed_domain
+    return indexed_domains
+
 def get_indexing_log_message(domain):
     message = ""
     conn = get_db()
@@ -149,9 +174,27 @@ def select_indexed_domains():
         indexed_domains.append(indexed_domain)
     return indexed_domains
 
+def get_domains_allowing_subdomains():
+    domains_allowing_subdomains = []
+    conn = get_db()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cursor.execute(sql_select_domains_allowing_subdomains)
+    results = cursor.fetchall()
+    for result in results:
+        domains_allowing_subdomains.append(result['setting_value'])
+    return domains_allowing_subdomains
+
+# Write a report to the file specified by --report (if any) as JSON
+def write_report(report):
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Report written to {}'.format(args.report))
+
 # This is copied from ../../web/content/dynamic/searchmysite/adminutils.py - if that is updated this should be too
 # The cursor.execute(searchmysite.sql.sql_select_domains_allowing_subdomains) line should be updated to remove searchmysite.sql.
-def extract_domain(url):
+# domains_allowing_subdomains can be passed in (from get_domains_allowing_subdomains) to save looking it up for every url
+def extract_domain(url, domains_allowing_subdomains=None):
     # Get the domain from the URL
     if not url: url = ""
     # returns subdomain, domain, suffix, is_private=True|False), also registered_domain (domain+'.'+suffix) and fqdn (subdomain+'.'+domain+'.'+suffix)
@@ -161,13 +204,8 @@ def extract_domain(url):
         domain = tld.domain
     domain = domain.lower() # lowercase the domain to help prevent duplicates
     # Look up list of domains which allow subdomains from database
-    domains_allowing_subdomains = []
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute(sql_select_domains_allowing_subdomains)
-    results = cursor.fetchall()
-    for result in results:
-        domains_allowing_subdomains.append(result['setting_value'])
+    if domains_allowing_subdomains is None:
+        domains_allowing_subdomains = get_domains_allowing_subdomains()
     # Add subdomain if in domains_allowing_subdomains
     if domain in domains_allowing_subdomains: # special domains where a site can be on a subdomain
         if tld.subdomain and tld.subdomain != "":
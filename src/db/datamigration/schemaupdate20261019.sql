@@ -0,0 +1,132 @@
+-- Add tblIndexedLinks for the link graph
+-- To reflect changes in db/sql/init-tables.inc
+-- Once created, populate from the existing Solr index from within the indexing container via:
+-- python -c "from common.linkgraph import backfill_link_graph; backfill_link_graph()"
+
+CREATE TABLE tblIndexedLinks (
+  source_url TEXT NOT NULL,
+  source_domain TEXT NOT NULL,
+  target_url TEXT NOT NULL,
+  target_domain TEXT NOT NULL,
+  PRIMARY KEY (source_url, target_url)
+);
+
+CREATE INDEX idx_indexedlinks_source_domain ON tblIndexedLinks (source_domain);
+CREATE INDEX idx_indexedlinks_target_url ON tblIndexedLinks (target_url);
+CREATE INDEX idx_indexedlinks_target_domain ON tblIndexedLinks (target_domain);
+
+-- Add domain_rank to tblDomains
+-- Populated by running python -m common.domainrank from within the indexing container
+
+ALTER TABLE tblDomains ADD COLUMN domain_rank REAL;
+
+-- Add indexing_worker and indexing_lease_expiry to tblDomains for the indexing job queue
+-- Sites which are already RUNNING are given the lease expiry they would have had under the previous 6 hour stuck job check
+
+ALTER TABLE tblDomains ADD COLUMN indexing_worker TEXT;
+ALTER TABLE tblDomains ADD COLUMN indexing_lease_expiry TIMESTAMPTZ;
+UPDATE tblDomains SET indexing_lease_expiry = indexing_status_changed + '6 hours' WHERE indexing_status = 'RUNNING';
+
+-- Add next_due_at and next_due_full to tblDomains, and indexes for the indexing scheduler's query for the sites which are due
+-- These are set when each index completes, so populate them for the existing sites from the last completed indexes
+
+ALTER TABLE tblDomains ADD COLUMN next_due_at TIMESTAMPTZ;
+ALTER TABLE tblDomains ADD COLUMN next_due_full BOOLEAN;
+UPDATE tblDomains SET
+  next_due_at = LEAST(last_full_index_completed + full_reindex_frequency, last_index_completed + incremental_reindex_frequency),
+  next_due_full = COALESCE(last_full_index_completed + full_reindex_frequency <= last_index_completed + incremental_reindex_frequency, last_full_index_completed + full_reindex_frequency IS NOT NULL);
+CREATE INDEX idx_domains_next_due_at ON tblDomains (next_due_at) WHERE indexing_enabled = TRUE AND indexing_type = 'spider/default';
+CREATE INDEX idx_domains_indexing_status ON tblDomains (indexing_status) WHERE indexing_enabled = TRUE AND indexing_type = 'spider/default' AND indexing_status <> 'COMPLETE';
+
+-- Partition tblIndexingLog by month, and add tblIndexingStatusLatest with the latest status for each domain
+-- To reflect changes in db/sql/init-tables.inc
+-- Only the rows within the retention period (12 months, as per INDEXING_LOG_RETENTION_MONTHS in indexing/indexer/settings.py)
+-- are copied to the new partitioned table, but tblIndexingStatusLatest is populated from all the rows
+
+ALTER TABLE tblIndexingLog RENAME TO tblIndexingLog_old;
+
+CREATE TABLE tblIndexingLog (
+  domain TEXT NOT NULL,
+  status TEXT,
+  timestamp TIMESTAMPTZ,
+  message TEXT
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE tblIndexingLog_default PARTITION OF tblIndexingLog DEFAULT;
+
+CREATE FUNCTION maintain_indexing_log_partitions(months_ahead INTEGER, retention_months INTEGER) RETURNS VOID AS $$
+DECLARE
+  partition_start TIMESTAMPTZ;
+  oldest_month TIMESTAMPTZ := date_trunc('month', now()) - retention_months * INTERVAL '1 month';
+  old_partition RECORD;
+BEGIN
+  -- Create the partitions from the start of the retention period to months_ahead months ahead, if they don't already exist
+  FOR i IN -retention_months..months_ahead LOOP
+    partition_start := date_trunc('month', now()) + i * INTERVAL '1 month';
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF tblIndexingLog FOR VALUES FROM (%L) TO (%L)',
+      'tblindexinglog_' || to_char(partition_start, '"y"YYYY"m"MM'), partition_start, partition_start + INTERVAL '1 month');
+  END LOOP;
+  -- Drop the partitions which are older than the retention period
+  FOR old_partition IN SELECT c.relname FROM pg_inherits i
+    INNER JOIN pg_class c ON c.oid = i.inhrelid
+    INNER JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relname = 'tblindexinglog' AND c.relname ~ '^tblindexinglog_y[0-9]{4}m[0-9]{2}$'
+    AND to_date(substring(c.relname from 'y([0-9]{4}m[0-9]{2})$'), 'YYYY"m"MM') < oldest_month LOOP
+    EXECUTE format('DROP TABLE %I', old_partition.relname);
+  END LOOP;
+  DELETE FROM tblIndexingLog_default WHERE timestamp < oldest_month;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT maintain_indexing_log_partitions(2, 12);
+
+INSERT INTO tblIndexingLog (domain, status, timestamp, message)
+  SELECT domain, status, timestamp, message FROM tblIndexingLog_old
+  WHERE timestamp >= date_trunc('month', now()) - INTERVAL '12 months';
+
+CREATE TABLE tblIndexingStatusLatest (
+  domain TEXT PRIMARY KEY,
+  status TEXT,
+  timestamp TIMESTAMPTZ,
+  message TEXT,
+  last_complete_timestamp TIMESTAMPTZ,
+  last_complete_message TEXT
+);
+
+CREATE FUNCTION update_indexing_status_latest() RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO tblIndexingStatusLatest AS s (domain, status, timestamp, message, last_complete_timestamp, last_complete_message)
+  VALUES (NEW.domain, NEW.status, NEW.timestamp, NEW.message,
+    CASE WHEN NEW.status = 'COMPLETE' THEN NEW.timestamp END,
+    CASE WHEN NEW.status = 'COMPLETE' THEN NEW.message END)
+  ON CONFLICT (domain) DO UPDATE SET
+    status = EXCLUDED.status,
+    timestamp = EXCLUDED.timestamp,
+    message = EXCLUDED.message,
+    last_complete_timestamp = CASE WHEN EXCLUDED.status = 'COMPLETE' THEN EXCLUDED.last_complete_timestamp ELSE s.last_complete_timestamp END,
+    last_complete_message = CASE WHEN EXCLUDED.status = 'COMPLETE' THEN EXCLUDED.last_complete_message ELSE s.last_complete_message END;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO tblIndexingStatusLatest (domain, status, timestamp, message)
+  SELECT DISTINCT ON (domain) domain, status, timestamp, message FROM tblIndexingLog_old
+  ORDER BY domain, timestamp DESC NULLS LAST;
+UPDATE tblIndexingStatusLatest s SET last_complete_timestamp = c.timestamp, last_complete_message = c.message
+  FROM (SELECT DISTINCT ON (domain) domain, timestamp, message FROM tblIndexingLog_old WHERE status = 'COMPLETE' ORDER BY domain, timestamp DESC NULLS LAST) c
+  WHERE s.domain = c.domain;
+
+CREATE TRIGGER trg_indexinglog_status_latest AFTER INSERT ON tblIndexingLog
+  FOR EACH ROW EXECUTE FUNCTION update_indexing_status_latest();
+
+DROP TABLE tblIndexingLog_old;
+
+-- The search queries sent to Solr by the web app, with how often each is sent, used to generate the queries which warm the Solr
+-- caches after a commit (see indexing/common/searchwarming.py). Only the Solr request is recorded, i.e. nothing about who searched.
+-- count decays each time the warming queries are updated, so it is a rolling count which favours recent queries.
+CREATE TABLE tblSearchQueryLog (
+  request_hash TEXT PRIMARY KEY,
+  request JSONB NOT NULL,
+  count REAL NOT NULL DEFAULT 0,
+  last_seen TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -3,18 +3,24 @@ import sys
 import os
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from common.utils import convert_list_of_dicts_to_list_of_domains, select_indexed_domains, get_solr_domains_with_or_without_home, get_solr_domains_with_a_home_page, get_indexing_log_message
+from common.utils import select_indexed_domains_with_indexing_log_message, get_solr_domains_with_or_without_home, get_solr_domains_with_a_home_page, write_report
 
-database_domains = convert_list_of_dicts_to_list_of_domains(select_indexed_domains())
-solr_domains_with_or_without_home = get_solr_domains_with_or_without_home()
-solr_domains_with_a_home_page = convert_list_of_dicts_to_list_of_domains(get_solr_domains_with_a_home_page())
+# This utility checks for domains in the database but not in the search engine, and categorises them by the likely reason.
+# The database domains (with their most recent indexing log messages) are fetched in one query and the search engine domains
+# in one request each, and they are compared as sets/dicts in memory.
+# To also write the results as JSON, e.g.:
+# python consistencycheck.py --env prod --report consistencycheck.json
+
+database_details = select_indexed_domains_with_indexing_log_message() # dict keyed on domain
+solr_domains_with_or_without_home = set(get_solr_domains_with_or_without_home())
+solr_domains_with_a_home_page = set(solr_domain['domain'] for solr_domain in get_solr_domains_with_a_home_page())
 
 # Top level issues
-domains_in_database_but_not_search = set(database_domains) - set(solr_domains_with_a_home_page)
-domains_in_search_but_not_database = set(solr_domains_with_a_home_page) - set(database_domains)
+domains_in_database_but_not_search = database_details.keys() - solr_domains_with_a_home_page
+domains_in_search_but_not_database = solr_domains_with_a_home_page - database_details.keys()
 
 # Issues which should be a subset of domains_in_database_but_not_search
-domains_in_search_without_a_home_page = set(solr_domains_with_or_without_home) - set(solr_domains_with_a_home_page)
+domains_in_search_without_a_home_page = solr_domains_with_or_without_home - solr_domains_with_a_home_page
 
 robots_forbidden = []
 site_timeout = []
@@ -22,8 +28,8 @@ no_documents = []
 no_home_in_search = []
 unknown = []
 
-for domain in domains_in_database_but_not_search:
-    message = get_indexing_log_message(domain)
+for domain in sorted(domains_in_database_but_not_search):
+    message = database_details[domain]['message']
     if message.startswith('WARNING: No documents found. Likely robots.txt forbidden.'):
         robots_forbidden.append(domain)
     elif message.startswith('WARNING: No documents found. Likely site timeout.'):
@@ -45,3 +51,16 @@ print("Unknown: {}".format(unknown))
 # This shouldn't happen any more
 #print("\nDomains in the search engine but not the database:")
 #print(domains_in_search_but_not_database)
+
+write_report({
+    'database_domains': len(database_details),
+    'search_domains_with_a_home_page': len(solr_domains_with_a_home_page),
+    'domains_in_database_but_not_search': {
+        'robots_forbidden': robots_forbidden,
+        'site_timeout': site_timeout,
+        'no_documents': no_documents,
+        'no_home_in_search': no_home_in_search,
+        'unknown': unknown
+    },
+    'domains_in_search_but_not_database': sorted(domains_in_search_but_not_database)
+})
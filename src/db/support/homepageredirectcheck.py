@@ -7,7 +7,7 @@ import os
 from urllib.request import urlopen
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
-from common.utils import get_args, extract_domain, select_indexed_domains, get_solr_domains_with_a_home_page
+from common.utils import get_args, extract_domain, get_domains_allowing_subdomains, select_indexed_domains_with_indexing_log_message, get_solr_domains_with_a_home_page, write_report
 
 # This utility connects to the database and search index, and checks whether
 # the home page in the database has been redirected to a different home page.
@@ -27,6 +27,9 @@ from common.utils import get_args, extract_domain, select_indexed_domains, get_s
 # until there's confidence to make bulk changes
 # Final note: Still want to manually verify the changes, because some of the redirects are to 
 # shared domains, which won't work, e.g. abc.com -> github.com/abc or abc.me -> persumi.com/u/abc
+# The database details are a dict keyed on domain, so each search engine home page is matched with a dict lookup,
+# and the domains allowing subdomains are only looked up once rather than for every extract_domain.
+# Use --report to also write the results as JSON.
 
 sql_insert_new_domain = "INSERT INTO tblDomains "\
     "(domain, home_page, category, domain_first_submitted, email, include_in_public_search, moderator_approved, moderator_action_changed, moderator, full_reindex_frequency, indexing_page_limit, on_demand_reindexing, api_enabled, indexing_enabled, indexing_type, indexing_status, indexing_status_changed) "\
@@ -40,22 +43,21 @@ sql_insert_listing_status = "INSERT INTO tblListingStatus "\
 
 args = get_args()
 
-def get_mismatched_home_pages(database_details, search_details):
+def get_mismatched_home_pages(database_details, search_details, domains_allowing_subdomains):
     mismatched_home_pages = []
     for search_detail in search_details:
         search_home = search_detail['url']
         search_domain = search_detail['domain']
-        for database_detail in database_details:
-            if database_detail['domain'] == search_domain:
-                if database_detail['home_page'] != search_home:
-                    search_domain = extract_domain(search_home) # This can be a bit slow so best only do it where necessary, e.g. where home pages don't match
-                    mismatched_home_page = {}
-                    mismatched_home_page['search_home'] = search_home
-                    mismatched_home_page['search_domain'] = search_domain
-                    mismatched_home_page['database_home'] = database_detail['home_page']
-                    mismatched_home_page['database_domain'] = database_detail['domain']
-                    mismatched_home_page['tier'] = database_detail['tier']
-                    mismatched_home_pages.append(mismatched_home_page)
+        database_detail = database_details.get(search_domain)
+        if database_detail and database_detail['home_page'] != search_home:
+            search_domain = extract_domain(search_home, domains_allowing_subdomains) # This can be a bit slow so best only do it where necessary, e.g. where home pages don't match
+            mismatched_home_page = {}
+            mismatched_home_page['search_home'] = search_home
+            mismatched_home_page['search_domain'] = search_domain
+            mismatched_home_page['database_home'] = database_detail['home_page']
+            mismatched_home_page['database_domain'] = database_detail['domain']
+            mismatched_home_page['tier'] = database_detail['tier']
+            mismatched_home_pages.append(mismatched_home_page)
     return mismatched_home_pages
 
 # Mismatched domains will be a subset of mistmatched_home_pages
@@ -65,7 +67,7 @@ def get_mismatched_domains(mismatched_home_pages, database_details):
         search_domain = mismatched_home_page['search_domain']
         database_domain = mismatched_home_page['database_domain']
         if search_domain != database_domain:
-            if any(database_detail['domain'] == search_domain for database_detail in database_details): # Only add new domains that don't already exist, to prevent an error
+            if search_domain in database_details: # Only add new domains that don't already exist, to prevent an error
                 print('\n{} -> {} but there is already a separate entry for {}'.format(database_domain, search_domain, search_domain))
             elif mismatched_home_page['tier'] != 1: # Only add new tier 1 domains for now, because tier 2 and 3 may require additional SQL
                 print('\n{} -> {} but this is not a tier 1 site, so additional SQL may be required'.format(database_domain, search_domain))
@@ -75,10 +77,11 @@ def get_mismatched_domains(mismatched_home_pages, database_details):
                 mismatched_domains.append(mismatched_home_page)
     return mismatched_domains
 
-database_details = select_indexed_domains()
+database_details = select_indexed_domains_with_indexing_log_message() # dict keyed on domain
 search_details = get_solr_domains_with_a_home_page()
+domains_allowing_subdomains = get_domains_allowing_subdomains()
 
-mismatched_home_pages = get_mismatched_home_pages(database_details, search_details)
+mismatched_home_pages = get_mismatched_home_pages(database_details, search_details, domains_allowing_subdomains)
 #for mismatch in mismatched_home_pages:
 #    print("database_home: {}, search_home: {} (database domain: {}, search_domain: {}), ".format(mismatch['database_home'], mismatch['search_home'], mismatch['database_domain'], mismatch['search_domain']))
 
@@ -94,3 +97,7 @@ for mismatch in mismatched_domains:
         print(sql_insert_new_domain.format(new_domain=new_domain, new_home_page=new_home_page, old_domain=old_domain))
         print(sql_insert_listing_status.format(new_domain=new_domain, old_domain=old_domain))
 
+write_report({
+    'mismatched_home_pages': mismatched_home_pages,
+    'mismatched_domains': mismatched_domains
+})
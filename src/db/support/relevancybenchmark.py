@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import json
+import sys
+import os
+import statistics
+from urllib.request import urlopen, Request
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from common.utils import SOLR_URL, write_report
+
+# This utility compares the query latency of the precomputed static_rank boost (the default in solrconfig.xml) with the
+# original boost function which was calculated for every matching doc on every query, on a set of queries with large result sets.
+# It also checks that the top results are the same for both, which they should be once all the docs have a static_rank.
+# The QTime reported by Solr is used rather than the elapsed time so network latency isn't included.
+# To also write the results as JSON, e.g.:
+# python relevancybenchmark.py --env dev --report relevancybenchmark.json
+
+original_boost = "product( sum(1, log(sum(1, product(indexed_inlink_domains_count, 1.8)))), if(contains_adverts,0.5,1), if(owner_verified,1.1,1) )"
+queries = ['blog', 'the', 'web', 'python', 'music', 'home', 'about', 'linux', 'photography', 'open source']
+repeats = 10
+
+# Similar to the main search query in ../../web/content/dynamic/searchmysite/solr.py, but without the highlighting
+# and facets, and with the query cache disabled so the boost is evaluated on every run
+def get_query(q, boost=None):
+    params = {
+        "q": "{!edismax cache=false}" + q,
+        "mm": 2,
+        "q.op": "AND",
+        "fl": "id",
+        "rows": 10,
+        "fq": ["public:true", "(content_type:text/html OR content_type:text/plain)"],
+        "group": True,
+        "group.field": "domain",
+        "group.limit": 3,
+        "group.ngroups": True
+    }
+    if boost: params['boost'] = boost
+    return {'params': params}
+
+def run_query(solr_search):
+    req = Request(SOLR_URL + 'select', json.dumps(solr_search).encode("utf8"), {'Content-Type': 'text/json'})
+    results = json.load(urlopen(req))
+    ids = [doc['id'] for group in results['grouped']['domain']['groups'] for doc in group['doclist']['docs']]
+    return results['responseHeader']['QTime'], results['grouped']['domain']['matches'], ids
+
+report = {'repeats': repeats, 'queries': []}
+for q in queries:
+    query_report = {'q': q}
+    for (name, boost) in [('original_boost', original_boost), ('static_rank', None)]:
+        run_query(get_query(q, boost)) # warm up
+        qtimes = []
+        for i in range(repeats):
+            (qtime, matches, ids) = run_query(get_query(q, boost))
+            qtimes.append(qtime)
+        query_report['matches'] = matches
+        query_report[name] = {'median_qtime': statistics.median(qtimes), 'max_qtime': max(qtimes), 'ids': ids}
+    query_report['same_top_results'] = query_report['original_boost'].pop('ids') == query_report['static_rank'].pop('ids')
+    print('{}: {} matches, median QTime {}ms with original boost vs {}ms with static_rank, same top results: {}'.format(q, query_report['matches'], query_report['original_boost']['median_qtime'], query_report['static_rank']['median_qtime'], query_report['same_top_results']))
+    report['queries'].append(query_report)
+
+write_report(report)
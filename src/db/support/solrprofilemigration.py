@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import json
+import sys
+import os
+import time
+import statistics
+from urllib.request import urlopen, Request
+from urllib.parse import urlencode, quote
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+from common.utils import SOLR_URL, get_args, write_report
+
+# This utility migrates the content core to the lean schema profile (see the comment in src/search/content/conf/schema.xml), i.e.:
+# 1. Creates a new core (content_lean) from the content configset with the lean profile core properties, which the schema.xml and
+#    solrconfig.xml in the configset use in place of their defaults, so there is only the one schema.
+# 2. Copies every doc (with its content chunk child docs) from the content core to the new core, streamed via cursorMark.
+#    This works because every field in the content core is either stored or docValues.
+# 3. Reports the index size and the query latency of both cores.
+# 4. Swaps the cores, so the new core is the content core used by the web app and indexer, and the old core is kept as content_lean.
+# Without --update it just reports on the current core. Indexing should be stopped while it runs (e.g. docker stop indexing)
+# because docs indexed to the content core after they have been copied won't be in the new core.
+# To roll back, swap the cores again, i.e. /solr/admin/cores?action=SWAP&core=content&other=content_lean
+# and once happy, remove the old core with /solr/admin/cores?action=UNLOAD&core=content_lean&deleteInstanceDir=true
+# e.g.
+# python solrprofilemigration.py --env dev --update --report solrprofilemigration.json
+
+source_core = 'content'
+target_core = 'content_lean'
+lean_core_properties = {
+    'property.searchmysite.indexTextCatchAll': 'false',
+    'property.searchmysite.storeLinks': 'false',
+    'property.searchmysite.indexSortFields': 'false',
+    'property.searchmysite.compressionMode': 'BEST_COMPRESSION',
+    'property.searchmysite.df': 'content'
+}
+batch_size = 500
+# Internal fields which are regenerated when the docs are added to the new core
+fields_to_remove = ['_version_', '_root_', '_nest_path_', '_text_']
+queries = ['blog', 'the', 'web', 'python', 'music', 'home', 'about', 'linux', 'photography', 'open source']
+repeats = 10
+
+solr_base_url = SOLR_URL.rsplit(source_core + '/', 1)[0] # i.e. http://<host>:8983/solr/
+solr_query_to_get_docs = "select?q=*%3A*&fq=!relationship%3Achild&fl=*,[child%20limit%3D-1]&sort=id%20asc&rows={}&cursorMark={}"
+solr_query_to_get_no_of_docs = "select?q=*%3A*&rows=0"
+
+def core_admin(params):
+    connection = urlopen(solr_base_url + 'admin/cores?' + urlencode(dict(params, wt='json')))
+    return json.load(connection)
+
+def get_core_status(core):
+    status = core_admin({'action': 'STATUS', 'core': core})['status'].get(core)
+    if not status or 'index' not in status:
+        return None
+    return {'num_docs': status['index']['numDocs'], 'size_in_bytes': status['index']['sizeInBytes'], 'size': status['index']['size']}
+
+def remove_internal_fields(doc):
+    for field in fields_to_remove:
+        doc.pop(field, None)
+    for value in doc.values():
+        if isinstance(value, list):
+            for child in value:
+                if isinstance(child, dict): remove_internal_fields(child)
+        elif isinstance(value, dict):
+            remove_internal_fields(value)
+    return doc
+
+def copy_docs(source_url, target_url):
+    cursor_mark = '*'
+    no_of_docs = 0
+    while True:
+        connection = urlopen(source_url + solr_query_to_get_docs.format(batch_size, quote(cursor_mark)))
+        results = json.load(connection)
+        docs = [remove_internal_fields(doc) for doc in results['response']['docs']]
+        if docs:
+            req = Request(target_url + 'update', json.dumps(docs).encode("utf8"), {'Content-Type': 'application/json'})
+            urlopen(req).read()
+            no_of_docs += len(docs)
+            print('Copied {} docs'.format(no_of_docs))
+        next_cursor_mark = results['nextCursorMark']
+        if next_cursor_mark == cursor_mark:
+            break
+        cursor_mark = next_cursor_mark
+    urlopen(target_url + 'update?commit=true').read()
+    return no_of_docs
+
+# Median QTime for the queries, using the same relevancy as the main search, with highlighting on content
+def get_query_latency(core_url):
+    latency = {}
+    for q in queries:
+        solr_search = {'params': {'q': q, 'defType': 'edismax', 'mm': 2, 'q.op': 'AND', 'fq': ['public:true'], 'fl': 'id', 'hl': True, 'hl.fl': 'content', 'hl.method': 'original', 'rows': 10}}
+        qtimes = []
+        for i in range(repeats + 1):
+            req = Request(core_url + 'select', json.dumps(solr_search).encode("utf8"), {'Content-Type': 'text/json'})
+            results = json.load(urlopen(req))
+            if i > 0: qtimes.append(results['responseHeader']['QTime']) # i.e. the first is a warm up
+        latency[q] = statistics.median(qtimes)
+    return latency
+
+args = get_args()
+source_url = solr_base_url + source_core + '/'
+target_url = solr_base_url + target_core + '/'
+report = {'before': {'core': source_core, 'status': get_core_status(source_core)}}
+print('{} core: {}'.format(source_core, report['before']['status']))
+
+if not args.update:
+    print('Run with --update to create the {} core with the lean schema profile, copy the docs, and swap it with the {} core'.format(target_core, source_core))
+else:
+    if get_core_status(target_core):
+        print('The {} core already exists, so not migrating. Swap or unload it first.'.format(target_core))
+        sys.exit(1)
+    core_admin(dict({'action': 'CREATE', 'name': target_core, 'configSet': source_core}, **lean_core_properties))
+    start = time.time()
+    no_of_docs = copy_docs(source_url, target_url)
+    print('Copied {} docs in {:.0f}s'.format(no_of_docs, time.time() - start))
+    urlopen(target_url + 'update?optimize=true&maxSegments=1').read() # so the size isn't inflated by unmerged segments
+    report['before']['latency'] = get_query_latency(source_url)
+    report['after'] = {'core': target_core, 'status': get_core_status(target_core), 'latency': get_query_latency(target_url)}
+    source_count = json.load(urlopen(source_url + solr_query_to_get_no_of_docs))['response']['numFound']
+    target_count = json.load(urlopen(target_url + solr_query_to_get_no_of_docs))['response']['numFound']
+    print('{} core: {}'.format(target_core, report['after']['status']))
+    print('Index size: {} before, {} after'.format(report['before']['status']['size'], report['after']['status']['size']))
+    for q in queries:
+        print('{}: median QTime {}ms before, {}ms after'.format(q, report['before']['latency'][q], report['after']['latency'][q]))
+    if source_count != target_count:
+        print('Not swapping the cores because the doc counts differ: {} in {}, {} in {}'.format(source_count, source_core, target_count, target_core))
+    else:
+        core_admin({'action': 'SWAP', 'core': source_core, 'other': target_core})
+        report['swapped'] = True
+        print('Swapped the {} and {} cores'.format(source_core, target_core))
+
+write_report(report)
@@ -60,12 +60,15 @@ done
 echo -ne "\n\nStep 5: Load into Solr, started at" `date` "\n"
 # Start by deleting existing Solr collection, for a clean index
 # If allowing indexing multiple languages, delete query would be <delete><query>(domain:wikipedia.org)AND(language:${LAN_CODE})</query></delete>
-curl ${SOLR_URL}update?commit=true -H "Content-Type: text/xml" --data-binary '<delete><query>domain:wikipedia.org</query></delete>'
+# The files are sent with commitWithin rather than a commit per file, so the new searchers are opened at the coordinated commit interval
+# (see SOLR_COMMIT_WITHIN in indexer/settings.py) rather than for every file, with one commit at the end
+curl ${SOLR_URL}update?commitWithin=10000 -H "Content-Type: text/xml" --data-binary '<delete><query>domain:wikipedia.org</query></delete>'
 for file in ${FOLDER}/*
 do
     echo $file
-    curl ${SOLR_URL}update?commit=true -H "Content-Type: application/json" --data-binary @$file
+    curl ${SOLR_URL}update?commitWithin=10000 -H "Content-Type: application/json" --data-binary @$file
 done
+curl ${SOLR_URL}update?commit=true
 rm ${FOLDER}/*
 
 echo -ne "\nCompleted at" `date` "\n"
@@ -142,6 +142,7 @@ for input_page in input_pages:
         page['indexed_inlink_domains'] = indexed_inlink_domains
         if len(indexed_inlink_domains) > 0:
             page['indexed_inlink_domains_count'] = len(indexed_inlink_domains)
+        page['static_rank'] = utils.get_static_rank(len(indexed_inlink_domains), page['contains_adverts'], page['owner_verified'])
         # Populate the indexed_outlinks, i.e. pages on other domains within this index to which this page links
         # Note that the mechanism here isn't bulletproof - it just looks for the domain string anywhere rather than between the "//" and first "/"
         # But given it will be run 10s of millions of times for potentially 100s of links on potentially 1000s of domains
@@ -0,0 +1,107 @@
+import psycopg2
+import psycopg2.extras
+import logging
+import numpy as np
+from common.utils import db_host, db_name, db_user, db_password, solr_update_site_fields
+
+
+# Domain rank
+# -----------
+#
+# A PageRank style score for each domain, based on the links between domains in the link graph (tblIndexedLinks), i.e. a domain
+# scores highly if it is linked to by other domains which score highly. This is calculated offline (rather than at query time) and
+# saved to tblDomains.domain_rank, from where it is set on every page in the domain at index time, and is also written to the
+# domain_rank field of existing pages via atomic updates for the domains whose rank has changed.
+# The domain graph is held as compressed sparse row (CSR) arrays, i.e. the edges sorted by source domain with an offset array,
+# and each iteration is a handful of vectorised NumPy operations over the edges, so it takes seconds even for millions of edges.
+#
+# To run from within the indexing container (this is also run daily from run.sh):
+# python -m common.domainrank
+
+damping_factor = 0.85
+max_iterations = 100
+tolerance = 1.0e-6
+min_change_to_update = 0.01 # i.e. the Solr docs are only updated if the rank has changed by more than 1%
+
+# SQL
+# Links within a domain are excluded, and multiple links between the same two domains are counted as a weight
+sql_select_domain_links = "SELECT source_domain, target_domain, COUNT(*) AS links FROM tblIndexedLinks "\
+    "WHERE source_domain <> target_domain "\
+    "GROUP BY source_domain, target_domain;"
+sql_select_domain_ranks = "SELECT d.domain, d.domain_rank FROM tblDomains d INNER JOIN tblListingStatus l ON d.domain = l.domain "\
+    "WHERE l.status = 'ACTIVE' AND d.indexing_enabled = TRUE;"
+sql_update_domain_rank = "UPDATE tblDomains SET domain_rank = (%s) WHERE domain = (%s);"
+
+
+# Build the CSR arrays from the edge list, where domains is a list of all the domains (the row and column labels).
+# Returns indptr (the offset of the first edge for each source domain), indices (the target domain of each edge) and
+# weights (the weight of each edge, normalised so the weights of the edges from each source domain sum to 1).
+def get_csr_arrays(domains, links):
+    domain_index = {domain: i for i, domain in enumerate(domains)}
+    links = [(domain_index[source], domain_index[target], weight) for (source, target, weight) in links if source in domain_index and target in domain_index]
+    sources = np.fromiter((link[0] for link in links), dtype=np.int32, count=len(links))
+    targets = np.fromiter((link[1] for link in links), dtype=np.int32, count=len(links))
+    weights = np.fromiter((link[2] for link in links), dtype=np.float64, count=len(links))
+    order = np.argsort(sources, kind='stable')
+    sources, indices, weights = sources[order], targets[order], weights[order]
+    indptr = np.zeros(len(domains) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(domains)), out=indptr[1:])
+    out_weights = np.bincount(sources, weights=weights, minlength=len(domains))
+    weights = weights / out_weights[sources]
+    return indptr, indices, weights
+
+# Power iteration, i.e. repeatedly distribute each domain's rank over its outlinks until the ranks converge.
+# The rank of domains without any outlinks ("dangling" domains) is distributed evenly across all domains.
+# Returns the ranks scaled so the average is 1.0.
+def get_domain_ranks(indptr, indices, weights):
+    n = len(indptr) - 1
+    if n == 0:
+        return np.zeros(0)
+    out_degrees = np.diff(indptr)
+    sources = np.repeat(np.arange(n), out_degrees)
+    dangling = out_degrees == 0
+    ranks = np.full(n, 1.0 / n)
+    for i in range(max_iterations):
+        new_ranks = np.bincount(indices, weights=ranks[sources] * weights, minlength=n)
+        new_ranks = (1.0 - damping_factor) / n + damping_factor * (new_ranks + ranks[dangling].sum() / n)
+        converged = np.abs(new_ranks - ranks).sum() < tolerance
+        ranks = new_ranks
+        if converged:
+            break
+    logger = logging.getLogger()
+    logger.info('Domain ranks calculated for {} domains and {} links in {} iterations'.format(n, len(indices), i + 1))
+    return ranks * n
+
+# Calculate the domain ranks, save to the database, and update Solr for those which have changed
+def update_domain_ranks():
+    logger = logging.getLogger()
+    try:
+        conn = psycopg2.connect(host=db_host, dbname=db_name, user=db_user, password=db_password)
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute(sql_select_domain_ranks)
+        previous_ranks = {result['domain']: result['domain_rank'] for result in cursor.fetchall()}
+        cursor.execute(sql_select_domain_links)
+        links = [(result['source_domain'], result['target_domain'], result['links']) for result in cursor.fetchall()]
+        domains = list(previous_ranks)
+        indptr, indices, weights = get_csr_arrays(domains, links)
+        ranks = get_domain_ranks(indptr, indices, weights)
+        changed_domains = {}
+        for domain, rank in zip(domains, ranks.tolist()):
+            previous_rank = previous_ranks[domain]
+            if previous_rank is None or abs(rank - previous_rank) > min_change_to_update * previous_rank:
+                changed_domains[domain] = rank
+        psycopg2.extras.execute_batch(cursor, sql_update_domain_rank, [(rank, domain) for domain, rank in changed_domains.items()])
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error('update_domain_ranks: {}'.format(e.pgerror))
+        return
+    finally:
+        conn.close()
+    for domain, rank in changed_domains.items():
+        solr_update_site_fields(domain, {'domain_rank': rank}, {})
+    logger.info('Domain ranks updated in Solr for {} domains'.format(len(changed_domains)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    update_domain_ranks()
@@ -0,0 +1,104 @@
+import time
+import re
+from functools import lru_cache
+import tldextract
+
+
+# Domain resolver
+# ---------------
+#
+# Returns the domain for a URL, e.g. michael-lewis.com for https://www.michael-lewis.com/about/, where the domain could be a subdomain
+# if that domain allows subdomains, e.g. user1.github.io for https://user1.github.io/ (see tblSettings domain_allowing_subdomains).
+# This is called for every indexed link of every page at index time, so:
+# - The public suffix list snapshot bundled with tldextract is used, i.e. there is no network fetch of the latest list at startup.
+# - The split of each hostname into subdomain and domain is cached in an LRU cache, because the same hostnames come up again and again.
+# - The domains allowing subdomains can be cached for domains_allowing_subdomains_ttl seconds via get_domains_allowing_subdomains_cached,
+#   for callers which would otherwise have to look them up from the database every time.
+#
+# IMPORTANT: This file is in both indexing/common/domainresolver.py and web/content/dynamic/searchmysite/domainresolver.py
+# so if it is updated in one it should be updated in the other
+#
+# To run the micro-benchmark:
+# python -m common.domainresolver (from src/indexing) or python -m searchmysite.domainresolver (from src/web/content/dynamic)
+
+hostname_cache_size = 100000
+domains_allowing_subdomains_ttl = 300 # seconds
+
+# suffix_list_urls=() means only the bundled snapshot of the public suffix list is used
+extractor = tldextract.TLDExtract(suffix_list_urls=())
+
+domains_allowing_subdomains_cache = {'domains': None, 'expiry': 0}
+
+scheme_pattern = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*:(?![0-9])')
+
+
+# Get the hostname part of a URL, e.g. www.michael-lewis.com for https://www.michael-lewis.com:443/about/
+# This is the same as the netloc that tldextract extracts from, so it can be used as the key for the cache.
+# Only a scheme at the start of the URL is removed (as with tldextract), so e.g. example.com/?ref=https://example.net/ is example.com.
+# A URL with a scheme but no // (e.g. mailto:user@example.com) doesn't have a hostname. A scheme-less URL with a port
+# (e.g. localhost:8080/) isn't treated as having a scheme, because the scheme can't be followed by digits.
+def get_hostname(url):
+    scheme = scheme_pattern.match(url)
+    if scheme:
+        url = url[scheme.end():]
+        if not url.startswith('//'):
+            return ''
+    hostname = url.lstrip('/').partition('/')[0].partition('?')[0].partition('#')[0].rpartition('@')[2]
+    if not hostname.startswith('['): # i.e. not an IPv6 address
+        hostname = hostname.partition(':')[0]
+    return hostname
+
+# Split a hostname into subdomain and domain, where domain is lowercase, e.g. ('www', 'michael-lewis.com') for www.michael-lewis.com
+@lru_cache(maxsize=hostname_cache_size)
+def split_hostname(hostname):
+    # returns subdomain, domain, suffix, is_private=True|False), also registered_domain (domain+'.'+suffix) and fqdn (subdomain+'.'+domain+'.'+suffix)
+    tld = extractor(hostname)
+    domain = tld.registered_domain
+    if tld.domain == 'localhost' and tld.suffix == '': # special case for localhost which has tld.registered_domain = ''
+        domain = tld.domain
+    domain = domain.lower() # lowercase the domain to help prevent duplicates
+    return tld.subdomain, domain
+
+# Extract domain from a URL, where domain could be a subdomain if that domain allows subdomains
+def extract_domain_from_url(url, domains_allowing_subdomains):
+    if not url: url = ""
+    (subdomain, domain) = split_hostname(get_hostname(url))
+    # Add subdomain if in domains_allowing_subdomains
+    if domain in domains_allowing_subdomains: # special domains where a site can be on a subdomain
+        if subdomain and subdomain != "":
+            domain = subdomain + "." + domain
+    return domain
+
+# Get the domains allowing subdomains as a set, only calling load_domains_allowing_subdomains (which should return a list of domains,
+# e.g. from the database) if they haven't been loaded in the last domains_allowing_subdomains_ttl seconds
+def get_domains_allowing_subdomains_cached(load_domains_allowing_subdomains):
+    now = time.monotonic()
+    if domains_allowing_subdomains_cache['domains'] is None or now >= domains_allowing_subdomains_cache['expiry']:
+        domains_allowing_subdomains_cache['domains'] = frozenset(load_domains_allowing_subdomains())
+        domains_allowing_subdomains_cache['expiry'] = now + domains_allowing_subdomains_ttl
+    return domains_allowing_subdomains_cache['domains']
+
+
+# Micro-benchmark of lookups per second, for a mix of urls similar to the indexed links of a typical crawl,
+# i.e. many different pages on a smaller number of hosts, with and without the cache
+if __name__ == '__main__':
+    import random
+    hosts = ['www.example{}.com'.format(i) for i in range(500)] + ['user{}.github.io'.format(i) for i in range(500)] + ['blog.example{}.co.uk'.format(i) for i in range(500)]
+    urls = ['https://{}/posts/{}/'.format(random.choice(hosts), i) for i in range(100000)]
+    domains_allowing_subdomains = frozenset(['github.io'])
+    extractor(urls[0]) # i.e. so loading the public suffix list isn't included in the timings
+
+    def uncached_extract_domain_from_url(url, domains_allowing_subdomains):
+        tld = extractor(url)
+        domain = tld.registered_domain.lower()
+        if domain in domains_allowing_subdomains and tld.subdomain:
+            domain = tld.subdomain + "." + domain
+        return domain
+
+    for (name, function) in [('Uncached', uncached_extract_domain_from_url), ('Cached', extract_domain_from_url)]:
+        start = time.perf_counter()
+        for url in urls:
+            function(url, domains_allowing_subdomains)
+        elapsed = time.perf_counter() - start
+        print('{}: {} lookups in {:.3f}s, i.e. {:,.0f} lookups/s'.format(name, len(urls), elapsed, len(urls) / elapsed))
+    print('Cache: {}'.format(split_hostname.cache_info()))
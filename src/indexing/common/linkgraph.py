@@ -0,0 +1,169 @@
+import json
+from urllib.request import urlopen, Request
+from urllib.parse import quote
+import psycopg2
+import psycopg2.extras
+import logging
+from common.utils import db_host, db_name, db_user, db_password, solr_url, solr_atomic_update_query, solr_atomic_update_headers, solr_atomic_update_batch_size, extract_domain_from_url, get_domains_allowing_subdomains, get_static_rank
+
+
+# Link graph
+# ----------
+#
+# The link graph is every link from a page in the search index to another page in the search index, i.e. every indexed_outlink,
+# stored in tblIndexedLinks with one row per link.
+# It is used to:
+# (i) look up the indexed_inlinks for the pages in a domain at the start of a crawl, which previously required a wildcard search on
+#     indexed_outlinks across the whole Solr index, and
+# (ii) keep the indexed_inlinks of pages on other domains up to date when a crawl adds or removes links to them, so these don't have
+#      to wait until the other domain is recrawled. At the end of each crawl the new indexed_outlinks are compared with the ones stored
+#      from the previous crawl, and only the pages which have gained or lost an inlink are updated in Solr, via atomic updates.
+#
+# To populate tblIndexedLinks from the existing Solr index (e.g. after the table is first created) run:
+# python -c "from common.linkgraph import backfill_link_graph; backfill_link_graph()"
+
+# SQL
+sql_select_indexed_inlinks_for_domain = "SELECT target_url, source_url FROM tblIndexedLinks WHERE target_domain = (%s);"
+sql_select_indexed_links_for_domain = "SELECT source_url, target_url FROM tblIndexedLinks WHERE source_domain = (%s);"
+sql_select_indexed_links_for_urls = "SELECT source_url, target_url FROM tblIndexedLinks WHERE source_url = ANY(%s);"
+sql_select_indexed_inlinks_for_urls = "SELECT target_url, array_agg(source_url ORDER BY source_url) AS source_urls FROM tblIndexedLinks WHERE target_url = ANY(%s) GROUP BY target_url;"
+sql_delete_indexed_links = "DELETE FROM tblIndexedLinks WHERE source_url = (%s) AND target_url = (%s);"
+sql_insert_indexed_links = "INSERT INTO tblIndexedLinks (source_url, source_domain, target_url, target_domain) VALUES %s ON CONFLICT DO NOTHING;"
+
+# Solr queries
+# The {!terms} query is used to find which of the target urls are actually in the index (an atomic update to an id which isn't in the
+# index would create a new doc) and to get their ids. The urls are sent in the body of a POST because there can be a large number of them.
+solr_select_docs_for_urls = "select"
+solr_select_docs_for_urls_headers = {'Content-Type': 'application/json'}
+solr_query_to_get_indexed_outlinks = "select?q=indexed_outlinks%3A*&fq=!relationship%3Achild&fl=id,url,domain,indexed_outlinks&sort=id%20asc&rows=1000&cursorMark={}"
+
+
+# Get all the indexed_inlinks for a domain, i.e. pages (from other domains within this search index) which link to this domain
+# Returns a dict keyed on the url of the page being linked to, with the value a list of the urls of the pages linking to it
+def get_indexed_inlinks_for_domain(domain):
+    indexed_inlinks = {}
+    try:
+        conn = psycopg2.connect(host=db_host, dbname=db_name, user=db_user, password=db_password)
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute(sql_select_indexed_inlinks_for_domain, (domain,))
+        results = cursor.fetchall()
+        for result in results:
+            indexed_inlinks.setdefault(result['target_url'], []).append(result['source_url'])
+    except psycopg2.Error as e:
+        logger = logging.getLogger()
+        logger.error('get_indexed_inlinks_for_domain: {}'.format(e.pgerror))
+    finally:
+        conn.close()
+    return indexed_inlinks
+
+# Update the link graph with the indexed_outlinks from a crawl, and update the indexed_inlinks in Solr for the pages which have
+# gained or lost an inlink as a result.
+# For a full index, every link from the domain which is no longer present is removed, while for an incremental index only the links
+# from the pages which have been crawled are compared (because the pages which haven't been recrawled will still have the same links).
+def update_link_graph(domain, items, full_index, domains_allowing_subdomains):
+    logger = logging.getLogger()
+    new_links = set()
+    for item in items:
+        for indexed_outlink in item.get('indexed_outlinks') or []:
+            new_links.add((item['url'], indexed_outlink))
+    affected_urls = set()
+    try:
+        conn = psycopg2.connect(host=db_host, dbname=db_name, user=db_user, password=db_password)
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        if full_index:
+            cursor.execute(sql_select_indexed_links_for_domain, (domain,))
+        else:
+            cursor.execute(sql_select_indexed_links_for_urls, ([item['url'] for item in items],))
+        old_links = set((result['source_url'], result['target_url']) for result in cursor.fetchall())
+        added_links = new_links - old_links
+        removed_links = old_links - new_links
+        if removed_links:
+            psycopg2.extras.execute_batch(cursor, sql_delete_indexed_links, list(removed_links))
+        if added_links:
+            values = [(source_url, domain, target_url, extract_domain_from_url(target_url, domains_allowing_subdomains)) for (source_url, target_url) in added_links]
+            psycopg2.extras.execute_values(cursor, sql_insert_indexed_links, values)
+        conn.commit()
+        affected_urls = set(target_url for (source_url, target_url) in added_links | removed_links)
+        logger.info('Link graph for {}: {} links added, {} links removed, {} pages affected'.format(domain, len(added_links), len(removed_links), len(affected_urls)))
+    except psycopg2.Error as e:
+        logger.error('update_link_graph: {}'.format(e.pgerror))
+    finally:
+        conn.close()
+    if affected_urls:
+        update_indexed_inlinks_in_solr(list(affected_urls), domains_allowing_subdomains)
+
+# Set indexed_inlinks, indexed_inlinks_count, indexed_inlink_domains and indexed_inlink_domains_count (and static_rank, which is derived
+# from indexed_inlink_domains_count) for the specified urls to the values from the link graph, via atomic updates, for those urls which are in the index
+def update_indexed_inlinks_in_solr(urls, domains_allowing_subdomains):
+    logger = logging.getLogger()
+    for start in range(0, len(urls), solr_atomic_update_batch_size):
+        batch_urls = urls[start:start + solr_atomic_update_batch_size]
+        # Get the ids of the docs for the urls
+        # The separator is a space rather than the default comma because urls can contain commas but not (unencoded) spaces
+        solr_search = {'params': {'q': "{!terms f=url separator=' '}" + ' '.join(batch_urls), 'fq': '!relationship:child', 'fl': 'id,url,contains_adverts,owner_verified', 'rows': len(batch_urls)}}
+        req = Request(solr_url + solr_select_docs_for_urls, json.dumps(solr_search).encode("utf8"), solr_select_docs_for_urls_headers)
+        results = json.load(urlopen(req))
+        docs = results['response']['docs']
+        if not docs: continue
+        # Get the inlinks for the docs
+        indexed_inlinks = {}
+        try:
+            conn = psycopg2.connect(host=db_host, dbname=db_name, user=db_user, password=db_password)
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cursor.execute(sql_select_indexed_inlinks_for_urls, ([doc['url'] for doc in docs],))
+            for result in cursor.fetchall():
+                indexed_inlinks[result['target_url']] = result['source_urls']
+        except psycopg2.Error as e:
+            logger.error('update_indexed_inlinks_in_solr: {}'.format(e.pgerror))
+            return
+        finally:
+            conn.close()
+        # Submit the updates, with the same values as customparser would set
+        updates = []
+        for doc in docs:
+            inlinks = indexed_inlinks.get(doc['url'], [])
+            inlink_domains = []
+            for inlink in inlinks:
+                inlink_domain = extract_domain_from_url(inlink, domains_allowing_subdomains)
+                if inlink_domain not in inlink_domains:
+                    inlink_domains.append(inlink_domain)
+            update = {'id': doc['id']}
+            update['indexed_inlinks'] = {'set': inlinks}
+            update['indexed_inlinks_count'] = {'set': len(inlinks) if inlinks else None}
+            update['indexed_inlink_domains'] = {'set': inlink_domains}
+            update['indexed_inlink_domains_count'] = {'set': len(inlink_domains) if inlink_domains else None}
+            update['static_rank'] = {'set': get_static_rank(len(inlink_domains), doc.get('contains_adverts'), doc.get('owner_verified'))}
+            updates.append(update)
+        req = Request(solr_url + solr_atomic_update_query, json.dumps(updates).encode("utf8"), solr_atomic_update_headers)
+        urlopen(req).read()
+        logger.debug('Updated indexed_inlinks for {}'.format([doc['url'] for doc in docs]))
+
+# Populate the link graph from the indexed_outlinks of every page in the Solr index
+def backfill_link_graph():
+    logger = logging.getLogger()
+    domains_allowing_subdomains = get_domains_allowing_subdomains()
+    cursor_mark = '*'
+    no_of_links = 0
+    while True:
+        connection = urlopen(solr_url + solr_query_to_get_indexed_outlinks.format(quote(cursor_mark)))
+        results = json.load(connection)
+        values = []
+        for doc in results['response']['docs']:
+            for indexed_outlink in doc['indexed_outlinks']:
+                values.append((doc['url'], doc['domain'], indexed_outlink, extract_domain_from_url(indexed_outlink, domains_allowing_subdomains)))
+        if values:
+            try:
+                conn = psycopg2.connect(host=db_host, dbname=db_name, user=db_user, password=db_password)
+                cursor = conn.cursor()
+                psycopg2.extras.execute_values(cursor, sql_insert_indexed_links, values)
+                conn.commit()
+                no_of_links += len(values)
+            except psycopg2.Error as e:
+                logger.error('backfill_link_graph: {}'.format(e.pgerror))
+            finally:
+                conn.close()
+        next_cursor_mark = results['nextCursorMark']
+        if next_cursor_mark == cursor_mark:
+            break
+        cursor_mark = next_cursor_mark
+    print('Backfilled {} links'.format(no_of_links))
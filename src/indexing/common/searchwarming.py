@@ -0,0 +1,104 @@
+import json
+import psycopg2
+import psycopg2.extras
+import logging
+from urllib.request import urlopen, Request
+from indexer import settings
+from common.utils import db_host, db_name, db_user, db_password, solr_url
+
+
+# Search warming
+# --------------
+#
+# Every commit which changes the index opens a new searcher with empty caches, so the first searches after a commit are slow.
+# The web app records how often each search query is sent to Solr in tblSearchQueryLog, and this regularly takes the most
+# frequent ones and sets them as the queries for the newSearcher and firstSearcher listeners via the Solr Config API, so that
+# Solr runs them on each new searcher before it starts using it, i.e. it warms the filterCache and queryResultCache with
+# the entries the production searches actually use. The Config API saves the listeners in configoverlay.json, which
+# overrides solrconfig.xml, and reloads the core, so the listeners are only updated if the warming queries have changed.
+# The counts are decayed each time, so the warming queries follow the recent searches.
+#
+# To run from within the indexing container (this is also run regularly by the scheduler):
+# python -m common.searchwarming
+
+max_warming_queries = settings.SEARCH_WARMING_QUERIES
+decay_factor = 0.5 # i.e. the counts are halved each time the warming queries are updated
+min_count = 0.1 # queries whose count has decayed below this are removed from the log
+max_age = '7 days' # queries which haven't been seen for this long are removed from the log
+listener_names = {'newSearcher': 'searchmysite-warming-newsearcher', 'firstSearcher': 'searchmysite-warming-firstsearcher'}
+solr_config_query = 'config'
+solr_config_overlay_query = 'config/overlay'
+solr_config_headers = {'Content-Type': 'application/json'}
+
+# SQL
+sql_select_top_search_queries = "SELECT request FROM tblSearchQueryLog WHERE last_seen > NOW() - (%s)::interval ORDER BY count DESC LIMIT (%s);"
+sql_decay_search_query_log = "UPDATE tblSearchQueryLog SET count = count * (%s); "\
+    "DELETE FROM tblSearchQueryLog WHERE count < (%s) OR last_seen < NOW() - (%s)::interval;"
+
+
+# Convert a Solr JSON request as recorded by the web app, i.e. {'params': {...}, 'facet': {...}}, to the params of a warming query.
+# Highlighting is removed because it doesn't use the caches, and the facets are passed as json.facet.
+# fq stays a list, i.e. one cached filter per fq, while the other list params (e.g. fl) are comma separated.
+def get_warming_query(request):
+    warming_query = {}
+    for param, value in request['params'].items():
+        if param == 'hl' or param.startswith('hl.'):
+            continue
+        if isinstance(value, list):
+            warming_query[param] = [str(v) for v in value] if param == 'fq' else ','.join(str(v) for v in value)
+        elif isinstance(value, bool):
+            warming_query[param] = 'true' if value else 'false'
+        else:
+            warming_query[param] = str(value)
+    if request.get('facet'):
+        warming_query['json.facet'] = json.dumps(request['facet'])
+    return warming_query
+
+# Get the most frequent recent search queries from the log, and decay the counts
+def get_top_search_queries():
+    logger = logging.getLogger()
+    requests = []
+    try:
+        conn = psycopg2.connect(host=db_host, dbname=db_name, user=db_user, password=db_password)
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute(sql_select_top_search_queries, (max_age, max_warming_queries))
+        requests = [result['request'] for result in cursor.fetchall()]
+        cursor.execute(sql_decay_search_query_log, (decay_factor, min_count, max_age))
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error('get_top_search_queries: {}'.format(e.pgerror))
+    finally:
+        conn.close()
+    return requests
+
+# Set the warming queries on the newSearcher and firstSearcher listeners, if they have changed
+def update_warming_queries():
+    logger = logging.getLogger()
+    # Sorted so the order of the counts doesn't matter when checking whether the warming queries have changed
+    warming_queries = sorted([get_warming_query(request) for request in get_top_search_queries()], key=lambda query: json.dumps(query, sort_keys=True))
+    if not warming_queries:
+        logger.info('No search queries to warm with')
+        return
+    overlay = json.load(urlopen(solr_url + solr_config_overlay_query))['overlay']
+    existing_listeners = overlay.get('listener', {})
+    commands = []
+    for event, name in listener_names.items():
+        listener = {'name': name, 'event': event, 'class': 'solr.QuerySenderListener', 'queries': warming_queries}
+        if name not in existing_listeners:
+            commands.append(('add-listener', listener))
+        elif existing_listeners[name].get('queries') != warming_queries:
+            commands.append(('update-listener', listener))
+    if not commands:
+        logger.info('Warming queries unchanged')
+        return
+    # The Config API accepts the same command more than once in a request, i.e. a JSON object with duplicate keys,
+    # so both listeners are updated with one core reload
+    data = '{' + ', '.join('{}: {}'.format(json.dumps(command), json.dumps(listener)) for (command, listener) in commands) + '}'
+    req = Request(solr_url + solr_config_query, data.encode("utf8"), solr_config_headers)
+    urlopen(req).read()
+    logger.info('Updated the warming queries with {} queries'.format(len(warming_queries)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    update_warming_queries()
@@ -1,11 +1,14 @@
 import json
+import socket
 from urllib.request import urlopen, Request
+from urllib.error import URLError
+from urllib.parse import quote
 import psycopg2
 import psycopg2.extras
-import tldextract
 import logging
 from os import environ
 import re
+import math
 import httplib2
 import smtplib, ssl
 from email import encoders
@@ -17,6 +20,7 @@ from bs4 import BeautifulSoup, SoupStrainer
 #from sentence_transformers import SentenceTransformer
 #from langchain.text_splitter import RecursiveCharacterTextSplitter
 from indexer import settings
+from common import domainresolver
 
 
 # Database config
@@ -36,14 +40,25 @@ smtp_to_email = environ.get('SMTP_TO_EMAIL')
 sql_select_domains = "SELECT d.domain from tblDomains d INNER JOIN tblListingStatus l ON d.domain = l.domain WHERE l.status = 'ACTIVE' AND d.indexing_enabled = TRUE;"
 sql_select_domains_allowing_subdomains = "SELECT setting_value FROM tblSettings WHERE setting_name = 'domain_allowing_subdomains';"
 sql_update_indexing_status = "UPDATE tblDomains "\
-    "SET indexing_status = (%s), indexing_status_changed = now() "\
+    "SET indexing_status = (%s), indexing_status_changed = now(), indexing_worker = NULL, indexing_lease_expiry = NULL "\
     "WHERE domain = (%s); "\
     "INSERT INTO tblIndexingLog (domain, status, timestamp, message) "\
     "VALUES ((%s), (%s), now(), (%s));"
-sql_update_indexing_complete = "UPDATE tblDomains SET last_index_completed = now() WHERE domain = (%s);"
-sql_update_full_indexing_complete = "UPDATE tblDomains SET last_index_completed = now(), last_full_index_completed = now() WHERE domain = (%s);"
-sql_select_indexing_log = "SELECT * FROM tblIndexingLog WHERE domain = (%s) AND status = 'COMPLETE' ORDER BY timestamp DESC LIMIT 1;"
-sql_select_last_complete_indexing_log_message = "SELECT message FROM tblIndexingLog WHERE domain = (%s) AND status = 'COMPLETE' ORDER BY timestamp DESC LIMIT 1;"
+# next_due_at is when the next reindex is due, i.e. the earlier of the next full reindex (last_full_index_completed + full_reindex_frequency)
+# and the next incremental reindex (last_index_completed + incremental_reindex_frequency), and next_due_full is whether that is a full reindex.
+# These are kept up to date here so the scheduler can find the sites which are due via an index on next_due_at.
+sql_update_indexing_complete = "UPDATE tblDomains SET last_index_completed = now(), "\
+    "next_due_at = LEAST(last_full_index_completed + full_reindex_frequency, now() + incremental_reindex_frequency), "\
+    "next_due_full = COALESCE(last_full_index_completed + full_reindex_frequency <= now() + incremental_reindex_frequency, last_full_index_completed + full_reindex_frequency IS NOT NULL) "\
+    "WHERE domain = (%s);"
+sql_update_full_indexing_complete = "UPDATE tblDomains SET last_index_completed = now(), last_full_index_completed = now(), "\
+    "next_due_at = LEAST(now() + full_reindex_frequency, now() + incremental_reindex_frequency), "\
+    "next_due_full = COALESCE(full_reindex_frequency <= incremental_reindex_frequency, full_reindex_frequency IS NOT NULL) "\
+    "WHERE domain = (%s);"
+# The latest COMPLETE indexing log entries are in tblIndexingStatusLatest (maintained by a trigger on tblIndexingLog)
+sql_select_indexing_log = "SELECT domain, last_complete_timestamp AS timestamp, last_complete_message AS message FROM tblIndexingStatusLatest WHERE domain = (%s) AND last_complete_timestamp IS NOT NULL;"
+sql_select_last_complete_indexing_log_message = "SELECT last_complete_message AS message FROM tblIndexingStatusLatest WHERE domain = (%s);"
+sql_maintain_indexing_log_partitions = "SELECT maintain_indexing_log_partitions(%s, %s);"
 sql_deactivate_indexing = "UPDATE tblDomains SET "\
     "indexing_enabled = FALSE, indexing_disabled_changed = now(), indexing_disabled_reason = (%s) WHERE domain = (%s);"
 sql_select_expired_listings = "SELECT d.domain, d.email from tblDomains d "\
@@ -78,20 +93,34 @@ sql_reset_indexing_defaults = "UPDATE tblDomains SET "\
 sql_select_stuck_jobs = "SELECT * FROM tblDomains "\
     "WHERE indexing_type = 'spider/default' "\
     "AND indexing_status = 'RUNNING' "\
-    "AND indexing_status_changed + '6 hours' < NOW();"
+    "AND indexing_lease_expiry < NOW();"
+sql_select_site_fields = "SELECT d.category, d.include_in_public_search, d.api_enabled, d.domain_first_submitted, l.tier FROM tblDomains d INNER JOIN tblListingStatus l ON d.domain = l.domain "\
+    "WHERE d.domain = (%s) AND l.status = 'ACTIVE' ORDER BY l.tier DESC LIMIT 1;"
 sql_select_user_entered = "SELECT web_feed_user_entered, sitemap_user_entered FROM tblDomains WHERE domain = (%s);"
 sql_update_auto_discovered = "UPDATE tblDomains SET web_feed_auto_discovered = (%s), sitemap_auto_discovered = (%s) WHERE domain = (%s);"
 
 # Solr config and queries
 solr_url = settings.SOLR_URL
-solr_query_to_get_indexed_outlinks = "select?q=*%3A*&fq=indexed_outlinks%3A*{}*&fl=url,indexed_outlinks&rows=10000"
-solr_query_to_get_already_indexed_links = "select?q=domain%3A{}&fq=!relationship%3Achild&fl=url&rows=1000"
+chunks_solr_url = settings.CONTENT_CHUNKS_SOLR_URL # None if the content chunks are nested child docs in the content core
+solr_query_to_get_already_indexed_links = "select?q=domain%3A{}&fq=!relationship%3Achild&fl=url,is_home,indexed_date,content_last_modified&rows=1000"
 # The solr_query_to_get_content includes fl=content_chunks,[child] to get the correctly nested child documents, and fq=!relationship:child 
 # to ensure the child documents don't also appear as siblings (noting that fq=relationship:parent can't be used until all pages have that value set)  
-solr_query_to_get_content = "select?q=*%3A*&fq=domain%3A{}&fq=!relationship:child&fl=id,url,domain,content,content_last_modified,content_chunk_no,content_chunk_text,content_chunk_vector,relationship,content_chunks,[child]&rows=1000"
-solr_delete_query = "update?commit=true"
+solr_query_to_get_content = "select?q=*%3A*&fq=domain%3A{}&fq=!relationship:child&fl=id,url,domain,content,content_last_modified,content_chunk_no,content_chunk_text,content_chunk_vector,content_chunk_byte_vector,content_chunk_model,relationship,content_chunks,[child]&rows=1000"
+# The ids are sorted so cursorMark can be used, and fq=!relationship:child excludes the content chunks
+solr_query_to_get_ids_for_domain = "select?q=domain%3A{}&fq=!relationship%3Achild&fl=id,is_home,indexed_inlink_domains_count,contains_adverts&sort=id%20asc&rows={}&cursorMark={}"
+solr_atomic_update_query = "update?commitWithin={}".format(settings.SOLR_COMMIT_WITHIN)
+solr_atomic_update_headers = {'Content-Type': 'application/json'}
+solr_atomic_update_batch_size = 500
+solr_delete_query = "update?commitWithin={}".format(settings.SOLR_COMMIT_WITHIN)
 solr_delete_headers = {'Content-Type': 'text/xml'}
 solr_delete_data = "<delete><query>domain:{}</query></delete>"
+solr_commit_query = "update?commit=true"
+# Used instead of the [child] in solr_query_to_get_content if the content chunks are in the chunks core
+solr_query_to_get_content_chunks = "select?q=domain%3A{}&fl=id,parent_id,url,domain,relationship,content_chunk_no,content_chunk_text,content_chunk_vector,content_chunk_byte_vector,content_chunk_model&sort=id%20asc&rows={}&cursorMark={}"
+solr_content_chunks_batch_size = 1000
+# The stats for the update handler (commit counts), searcher (when it was opened and registered, and how long it took to warm)
+# and caches (how long they took to autowarm)
+solr_commit_stats_query = "admin/mbeans?stats=true&cat=UPDATE&cat=SEARCHER&cat=CACHE&wt=json"
 
 
 # Database utils
@@ -132,7 +161,8 @@ def get_domains_allowing_subdomains():
     return domains_allowing_subdomains
 
 # Update indexing status
-# This is called at both the start and the end of indexing 
+# This is called at the end of indexing (sites are set to RUNNING when they are claimed by the scheduler), and
+# clears the indexing_worker and indexing_lease_expiry set when the site was claimed
 # status either RUNNING or COMPLETE
 # full_index only required if status = 'COMPLETE'
 def update_indexing_status(domain, full_index, status, message):
@@ -197,12 +227,26 @@ def check_for_stuck_jobs():
         for result in results:
             stuck_domains.append(result['domain'])
         if stuck_domains:
-            logger.warning('The following domains have had indexing RUNNING for over 6 hours, so something is likely to be wrong: {}'.format(stuck_domains))
+            logger.warning('The following domains have indexing RUNNING but an expired lease, so will be reindexed, although something is likely to be wrong: {}'.format(stuck_domains))
     except psycopg2.Error as e:
         logger.error(' %s' % e.pgerror)
     finally:
         conn.close()
 
+# Maintain indexing log partitions
+# Creates the tblIndexingLog partitions for the next couple of months, and drops those older than retention_months
+def maintain_indexing_log_partitions(retention_months):
+    logger = logging.getLogger()
+    try:
+        conn = psycopg2.connect(host=db_host, dbname=db_name, user=db_user, password=db_password)
+        cursor = conn.cursor()
+        cursor.execute(sql_maintain_indexing_log_partitions, (2, retention_months))
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error('maintain_indexing_log_partitions: {}'.format(e.pgerror))
+    finally:
+        conn.close()
+
 # Expire listings
 # The expiry process varies per tier.
 # Tier 1 expiry:
@@ -237,6 +281,9 @@ def expire_listings(tier):
                 elif tier == 2 or tier == 3:
                     cursor.execute(sql_expire_tier2or3_listing, (expired_listing['domain'], tier, expired_listing['domain'], new_tier, new_tier,))
                     cursor.execute(sql_reset_indexing_defaults, (new_tier, expired_listing['domain'],))
+                    conn.commit()
+                    # Update owner_verified and api_enabled in Solr now rather than waiting for the reindex to complete
+                    update_site_fields_in_solr(expired_listing['domain'])
                     if tier == 3 and expired_listing['email']:
                         subject = "searchmysite.net Full listing expiry"
                         text = 'Dear {},\n\n'.format(expired_listing['email'])
@@ -262,46 +309,128 @@ def expire_listings(tier):
 # Solr utils
 # ----------
 
-# Logic for generating all the indexed_inlinks for a domain:
-# Step 1:
-# Search for any indexed_outlinks to that domain, i.e.
-# /solr/content/select?q=*%3A*&fq=indexed_outlinks%3A*{domain}*&fl=url,indexed_outlinks&rows=10000
-# This will return urls each with a list of indexed_outlinks to that domain (and potentially other domains).
-# Note that it doesn't appear possible to restrict indexed_outlinks to just the domain specified in fq=indexed_outlinks%3A*{domain}*
-# (see https://issues.apache.org/jira/browse/SOLR-3955) so other domains will need to be filtered out later.
-# Step 2:
-# Invert, so instead of a dict of indexed links each with a list of indexed_outlinks 
-# it is a dict of indexed_outlinks each with a list of indexed links.
-# The indexed_outlinks, if matching the domain, will be the ones that will have indexed_inlinks value set for them, and the value of the
-# indexed_inlinks will be the list of urls.
-def get_all_indexed_inlinks_for_domain(domain):
-    indexed_inlinks = {}
-    solrquery = solr_query_to_get_indexed_outlinks.format(domain)
-    connection = urlopen(solr_url + solrquery)
-    results = json.load(connection)
-    if results['response']['docs']:
-        for doc in results['response']['docs']:
-            url = doc['url']
-            indexed_outlinks = doc['indexed_outlinks']
-            for indexed_outlink in indexed_outlinks:
-                if domain in indexed_outlink:
-                    if indexed_outlink not in indexed_inlinks:
-                        indexed_inlinks[indexed_outlink] = [url]
-                    else:
-                        indexed_inlinks[indexed_outlink].append(url)
-    return indexed_inlinks
+# The static rank of a page, i.e. the query independent part of the relevancy, which is stored in the static_rank field
+# and multiplied into the score by the boost in solrconfig.xml, rather than being calculated for every matching doc on every query.
+# It is the same as the boost function it replaces:
+# product( sum(1, log(sum(1, product(indexed_inlink_domains_count, 1.8)))), if(contains_adverts,0.5,1), if(owner_verified,1.1,1) )
+# noting log in Solr function queries is log base 10. It needs to be recalculated if any of the fields it is derived from change.
+# IMPORTANT: This function is in both indexing/common/utils.py and web/content/dynamic/searchmysite/adminutils.py
+# so if it is updated in one it should be updated in the other
+def get_static_rank(indexed_inlink_domains_count, contains_adverts, owner_verified):
+    static_rank = 1 + math.log10(1 + (indexed_inlink_domains_count or 0) * 1.8)
+    if contains_adverts: static_rank = static_rank * 0.5
+    if owner_verified: static_rank = static_rank * 1.1
+    return static_rank
+
+# Update the site level fields in Solr, i.e. the fields which have the same value for every page in a site, to match the
+# database, so changes such as a tier expiry are reflected in the search results without having to wait for a full reindex.
+# public, owner_verified and site_category are set on every page, while api_enabled and date_domain_added are only set on the home page.
+def update_site_fields_in_solr(domain):
+    try:
+        conn = psycopg2.connect(host=db_host, dbname=db_name, user=db_user, password=db_password)
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute(sql_select_site_fields, (domain,))
+        result = cursor.fetchone()
+    except psycopg2.Error as e:
+        logger = logging.getLogger()
+        logger.error('update_site_fields_in_solr: {}'.format(e.pgerror))
+        result = None
+    finally:
+        conn.close()
+    if result:
+        site_fields = {}
+        site_fields['public'] = result['include_in_public_search']
+        site_fields['owner_verified'] = True if result['tier'] == 3 else False
+        site_fields['site_category'] = result['category']
+        home_page_fields = {}
+        home_page_fields['api_enabled'] = result['api_enabled']
+        home_page_fields['date_domain_added'] = convert_datetime_to_utc_date(result['domain_first_submitted'])
+        solr_update_site_fields(domain, site_fields, home_page_fields)
+    return
+
+# Set field values on every page in a domain via atomic updates, i.e. without having to reindex the pages.
+# The ids are streamed from Solr via cursorMark so there's no limit on the number of pages, and the updates are submitted in batches,
+# with commitWithin rather than a commit so updates from different domains can be combined into the same commit.
+# home_page_fields are only set on the home page.
+# See https://solr.apache.org/guide/solr/latest/indexing-guide/partial-document-updates.html#atomic-updates
+# IMPORTANT: This function is in both indexing/common/utils.py and web/content/dynamic/searchmysite/adminutils.py
+# so if it is updated in one it should be updated in the other
+def solr_update_site_fields(domain, site_fields, home_page_fields):
+    logger = logging.getLogger()
+    batch_size = solr_atomic_update_batch_size
+    cursor_mark = '*'
+    no_of_docs = 0
+    # A failure is logged rather than raised, because the database has already been updated, and the next reindex will set the fields anyway
+    try:
+        while True:
+            solrquery = solr_query_to_get_ids_for_domain.format(domain, batch_size, quote(cursor_mark))
+            connection = urlopen(solr_url + solrquery, timeout=settings.SOLR_CLIENT_TIMEOUT)
+            results = json.load(connection)
+            updates = []
+            for doc in results['response']['docs']:
+                update = {'id': doc['id']}
+                fields = dict(site_fields, **home_page_fields) if doc.get('is_home') else site_fields
+                for field, value in fields.items():
+                    update[field] = {'set': value}
+                if 'owner_verified' in site_fields: # static_rank is derived from owner_verified
+                    update['static_rank'] = {'set': get_static_rank(doc.get('indexed_inlink_domains_count'), doc.get('contains_adverts'), site_fields['owner_verified'])}
+                updates.append(update)
+            if updates:
+                req = Request(solr_url + solr_atomic_update_query, json.dumps(updates).encode("utf8"), solr_atomic_update_headers)
+                response = urlopen(req, timeout=settings.SOLR_CLIENT_TIMEOUT)
+                response.read()
+                no_of_docs += len(updates)
+            next_cursor_mark = results['nextCursorMark']
+            if next_cursor_mark == cursor_mark:
+                break
+            cursor_mark = next_cursor_mark
+    except (URLError, socket.timeout, ValueError, KeyError) as e:
+        logger.error('Error updating {} on the docs for {} after {} docs: {}'.format(list(site_fields) + list(home_page_fields), domain, no_of_docs, e))
+        return
+    logger.info('Updated {} on {} docs for {}'.format(list(site_fields) + list(home_page_fields), no_of_docs, domain))
+    return
 
 # Remove all pages from a domain from the Solr index
+# and from the chunks core if the content chunks are kept there
 def solr_delete_domain(domain):
-    solrquery = solr_url + solr_delete_query
-    data = solr_delete_data.format(domain)
-    req = Request(solrquery, data.encode("utf8"), solr_delete_headers)
-    response = urlopen(req)
-    results = response.read()
+    for url in [solr_url, chunks_solr_url]:
+        if url:
+            solrquery = url + solr_delete_query
+            data = solr_delete_data.format(domain)
+            req = Request(solrquery, data.encode("utf8"), solr_delete_headers)
+            response = urlopen(req)
+            results = response.read()
+
+# Make all pending changes visible now, rather than waiting for the coordinated commit (see SOLR_COMMIT_WITHIN in settings.py).
+# This is only for when the indexing is run once rather than continuously, e.g. from the tests, which search straight after indexing.
+def solr_commit():
+    response = urlopen(solr_url + solr_commit_query)
+    response.read()
+
+# Get the number of commits of each type since Solr started, and how long the current searcher and its caches took to warm
+def get_solr_commit_stats():
+    connection = urlopen(solr_url + solr_commit_stats_query)
+    results = json.load(connection)
+    mbeans = results['solr-mbeans']
+    stats = {}
+    for category, beans in zip(mbeans[0::2], mbeans[1::2]):
+        for bean_name, bean in beans.items():
+            for stat_name, value in bean.get('stats', {}).items():
+                if category == 'UPDATE' and bean_name == 'updateHandler' and stat_name.split('.')[-1] in ['commits', 'autoCommits', 'softAutoCommits']:
+                    stats[stat_name.split('.')[-1]] = value
+                elif category == 'SEARCHER' and bean_name == 'searcher' and stat_name.split('.')[-1] in ['warmupTime', 'openedAt', 'registeredAt']:
+                    stats['searcher_' + stat_name.split('.')[-1]] = value
+                elif category == 'CACHE' and bean_name in ['filterCache', 'queryResultCache'] and stat_name.split('.')[-1] == 'warmupTime':
+                    stats[bean_name + '_warmupTime'] = value
+    return stats
 
 # Find all the pages in the site which have already been indexed (used for identifying pages which haven't already been indexed)
+# Returns a dict of url to the date the page was last indexed (or if not set the content_last_modified) in Solr's date format,
+# which is compared with the lastmod in the sitemap to identify pages which have changed since they were indexed
+# Returns a dict of url to the date it was last indexed, and the set of the urls indexed as the home page
 def get_already_indexed_links(domain):
-    already_indexed_links = []
+    already_indexed_links = {}
+    indexed_home_pages = set()
     solrquery = solr_query_to_get_already_indexed_links.format(domain)
     connection = urlopen(solr_url + solrquery)
     results = json.load(connection)
@@ -309,8 +438,9 @@ def get_already_indexed_links(domain):
         for doc in results['response']['docs']:
             url = doc['url']
             if url:
-                already_indexed_links.append(url)
-    return already_indexed_links
+                already_indexed_links[url] = doc.get('indexed_date') or doc.get('content_last_modified')
+                if doc.get('is_home'): indexed_home_pages.add(url)
+    return already_indexed_links, indexed_home_pages
 
 # Get all the content for a domain
 # Used for (i) identifying whether content has changed, and (ii) preserving existing content_chunks if the content hasn't changed
@@ -341,6 +471,8 @@ def get_already_indexed_links(domain):
 #      ]
 #   }
 # }
+# If the content chunks are in the chunks core (see CONTENT_CHUNKS_SOLR_URL in settings.py) they are fetched from there and
+# added to the content_chunks of their parent, so the data structure is the same.
 def get_contents(domain):
     contents = {}
     solrquery = solr_query_to_get_content.format(domain)
@@ -350,6 +482,19 @@ def get_contents(domain):
         for doc in results['response']['docs']:
             if 'id' in doc:
                 contents[doc['id']] = doc
+    if chunks_solr_url:
+        cursor_mark = '*'
+        while True:
+            solrquery = solr_query_to_get_content_chunks.format(domain, solr_content_chunks_batch_size, quote(cursor_mark))
+            connection = urlopen(chunks_solr_url + solrquery)
+            results = json.load(connection)
+            for doc in results['response']['docs']:
+                if doc['parent_id'] in contents:
+                    contents[doc['parent_id']].setdefault('content_chunks', []).append(doc)
+            next_cursor_mark = results['nextCursorMark']
+            if next_cursor_mark == cursor_mark:
+                break
+            cursor_mark = next_cursor_mark
     return contents
 
 
@@ -440,20 +585,10 @@ def web_feed_and_sitemap(domain, items):
 # ------------
 
 # Extract domain from a URL, where domain could be a subdomain if that domain allows subdomains
-# This is a variant of ../../web/content/dynamic/searchmysite/adminutils.py which takes domains_allowing_subdomains as an input parameter
-# because don't want a database lookup every time this is called in this context
+# This takes domains_allowing_subdomains as an input parameter because don't want a database lookup every time this is called in this context
+# See common/domainresolver.py for the (cached) implementation, which is shared with ../../web/content/dynamic/searchmysite/adminutils.py
 def extract_domain_from_url(url, domains_allowing_subdomains):
-    # returns subdomain, domain, suffix, is_private=True|False), also registered_domain (domain+'.'+suffix) and fqdn (subdomain+'.'+domain+'.'+suffix)
-    tld = tldextract.extract(url) 
-    domain = tld.registered_domain
-    if tld.domain == 'localhost' and tld.suffix == '': # special case for localhost which has tld.registered_domain = ''
-        domain = tld.domain
-    domain = domain.lower() # lowercase the domain to help prevent duplicates
-    # Add subdomain if in domains_allowing_subdomains
-    if domain in domains_allowing_subdomains: # special domains where a site can be on a subdomain
-        if tld.subdomain and tld.subdomain != "":
-            domain = tld.subdomain + "." + domain
-    return domain
+    return domainresolver.extract_domain_from_url(url, domains_allowing_subdomains)
 
 
 # String utils
@@ -497,6 +632,19 @@ def get_text(html):
 # Vector search utils
 # -------------------
 
+# The field the embeddings are stored in, depending on the VECTOR_ENCODING (see settings.py)
+def get_vector_field():
+    return 'content_chunk_byte_vector' if settings.VECTOR_ENCODING == 'BYTE' else 'content_chunk_vector'
+
+# Scalar quantise an embedding to int8, i.e. so it can be stored in a BYTE encoded DenseVectorField,
+# where scale is the value which maps to 127 (calibrated for each model, see common/vectorquantisation.py)
+# and larger values are clipped. The dot product of the quantised vectors is proportional to the dot product of the
+# originals (less the rounding and clipping error), so the ranking is preserved for similarityFunction="dot_product".
+# IMPORTANT: This function is in both indexing/common/utils.py and web/content/dynamic/searchmysite/searchutils.py
+# so if it is updated in one it should be updated in the other
+def quantise_vector(vector, scale):
+    return [max(-127, min(127, round(value * 127 / scale))) for value in vector]
+
 # Return the page content as a list of content chunks, each chunk a max chunk_size, with a max length of max_chunks 
 # def get_content_chunks(content, max_chunks, id, url, domain):
 #     logger = logging.getLogger()
@@ -515,8 +663,11 @@ def get_text(html):
 #             content_chunk['content_chunk_no'] = chunk_no
 #             content_chunk['content_chunk_text'] = chunk
 #             content_chunk['content_chunk_model'] = settings.EMBEDDING_MODEL
-#             content_chunk['content_chunk_vector'] = get_vector(chunk)
-#             if content_chunk['content_chunk_vector']:
+#             vector = get_vector(chunk)
+#             if vector and settings.VECTOR_ENCODING == 'BYTE':
+#                 vector = quantise_vector(vector, settings.EMBEDDING_QUANTISATION_SCALES[settings.EMBEDDING_MODEL])
+#             content_chunk[get_vector_field()] = vector
+#             if vector:
 #                 content_chunks.append(content_chunk)
 #             else:
 #                 logger.warn("Unable to generate chunk number {} for {}".format(chunk_no, url))
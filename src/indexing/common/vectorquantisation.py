@@ -0,0 +1,71 @@
+import json
+import logging
+from urllib.request import urlopen
+from indexer import settings
+from common.utils import solr_url, quantise_vector
+
+
+# Vector quantisation
+# -------------------
+#
+# The embeddings can be stored as float32 (VECTOR_ENCODING = 'FLOAT') or scalar quantised to int8 (VECTOR_ENCODING = 'BYTE'),
+# which takes a quarter of the memory for the HNSW graph and page cache. Each value is multiplied by 127 / scale and rounded,
+# where the scale is calibrated for each model as a high percentile of the absolute values of the embeddings of a sample
+# of the indexed content, i.e. so the range of int8 values is used for the range the model's values are actually in, clipping
+# the small number of outliers rather than wasting most of the range on them.
+#
+# This calibrates the scale for the EMBEDDING_MODEL on a sample of pages from the content core, and measures the recall@10
+# of the quantised embeddings against the float embeddings, i.e. the fraction of the top 10 chunks by float dot product
+# which are also in the top 10 by quantised dot product, using the page titles as the queries. The top 10 are found by
+# exact (brute force) search, so the recall only reflects the quantisation and not the HNSW approximation.
+# The scale it reports should be set for the model in EMBEDDING_QUANTISATION_SCALES in settings.py and the web app's config.py.
+#
+# To run from within the indexing container (with sentence-transformers installed, which also installs numpy):
+# python -m common.vectorquantisation
+
+sample_size = 500 # number of pages
+max_chunks_per_page = 10
+no_of_queries = 200
+top_k = 10
+percentile = 99.9
+solr_query_to_get_sample = "select?q=*%3A*&fq=!relationship%3Achild&fq=content%3A*&fl=title,content&sort=random_1%20asc&rows={}"
+
+
+# Split the content into chunks of CHUNK_SIZE chars overlapping by CHUNK_OVERLAP, which is close enough to the
+# text splitter used at index time for calibration, without needing langchain
+def get_chunks(content):
+    step = settings.CHUNK_SIZE - settings.CHUNK_OVERLAP
+    return [content[start:start + settings.CHUNK_SIZE] for start in range(0, len(content), step)][:max_chunks_per_page]
+
+# The scale, i.e. the value which maps to 127, from the absolute values of a sample of embeddings
+def calibrate_scale(embeddings):
+    import numpy
+    return float(numpy.percentile(numpy.abs(embeddings), percentile))
+
+# Mean recall@k of the quantised embeddings against the float embeddings
+def get_recall(embeddings, query_embeddings, scale):
+    import numpy
+    quantised_embeddings = numpy.array([quantise_vector(embedding, scale) for embedding in embeddings.tolist()], dtype=numpy.int32)
+    quantised_query_embeddings = numpy.array([quantise_vector(embedding, scale) for embedding in query_embeddings.tolist()], dtype=numpy.int32)
+    float_top_k = numpy.argsort(-(query_embeddings @ embeddings.T), axis=1)[:, :top_k]
+    quantised_top_k = numpy.argsort(-(quantised_query_embeddings @ quantised_embeddings.T), axis=1, kind='stable')[:, :top_k]
+    recalls = [len(set(expected) & set(actual)) / top_k for (expected, actual) in zip(float_top_k.tolist(), quantised_top_k.tolist())]
+    return sum(recalls) / len(recalls)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("sentence_transformers.SentenceTransformer").setLevel(logging.WARNING)
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(settings.EMBEDDING_MODEL)
+    docs = json.load(urlopen(solr_url + solr_query_to_get_sample.format(sample_size)))['response']['docs']
+    chunks = [chunk for doc in docs for chunk in get_chunks(doc['content'])]
+    queries = [doc['title'] for doc in docs if doc.get('title')][:no_of_queries]
+    print('Embedding {} chunks from {} pages, and {} queries, with {}'.format(len(chunks), len(docs), len(queries), settings.EMBEDDING_MODEL))
+    embeddings = model.encode(chunks)
+    query_embeddings = model.encode(queries)
+    scale = calibrate_scale(embeddings)
+    print('Scale: {} (the {}th percentile of the absolute values, the max is {})'.format(scale, percentile, float(abs(embeddings).max())))
+    print('Bytes per embedding: {} as FLOAT, {} as BYTE'.format(embeddings.shape[1] * 4, embeddings.shape[1]))
+    print('Recall@{} of BYTE against FLOAT: {:.3f}'.format(top_k, get_recall(embeddings, query_embeddings, scale)))
+    print("To use the BYTE encoding, set VECTOR_ENCODING = 'BYTE' and EMBEDDING_QUANTISATION_SCALES = {{'{}': {}}}".format(settings.EMBEDDING_MODEL, scale))
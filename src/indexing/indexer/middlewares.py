@@ -6,6 +6,7 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest
 
 
 class IndexerSpiderMiddleware:
@@ -101,3 +102,63 @@ class IndexerDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+# Enforces the indexing_page_limit when requests are about to be downloaded, rather than only when the pages have been parsed,
+# i.e. so that once the limit is in sight the requests still in the scheduler are dropped without being downloaded.
+# It tracks the requests in flight (sent to the downloader but without a response yet) plus the items scraped,
+# and ignores any new request once that reaches the indexing_page_limit. Requests with page_limit_exempt in their meta,
+# e.g. for sitemaps, are never counted or ignored because they don't result in pages being indexed.
+# It is after the RedirectMiddleware and RetryMiddleware in DOWNLOADER_MIDDLEWARES (i.e. a higher number), so it sees each response
+# and exception before they do, and a request stops being counted as soon as its response or exception arrives. This means a count is
+# never left behind by a redirect or retry which is then dropped, e.g. by the dupefilter (for a redirect to a page already seen) or
+# by an IgnoreRequest (for too many redirects). Redirects and retries are marked with page_limit_follow (via the meta they copy), so
+# they are counted again without being ignored. page_limit_counted is also removed from any request which is scheduled or dropped,
+# so it is never persisted in the JOBDIR. Each crawler has its own instance, so the counts are per spider.
+class PageLimitMiddleware:
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.requests_in_flight = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.stats)
+        crawler.signals.connect(middleware.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(middleware.request_scheduled, signal=signals.request_scheduled)
+        return middleware
+
+    def process_request(self, request, spider):
+        if request.meta.get('page_limit_counted') or request.meta.get('page_limit_exempt'):
+            return None
+        if not request.meta.pop('page_limit_follow', None):
+            indexing_page_limit = spider.site_config['indexing_page_limit']
+            if self.requests_in_flight + self.stats.get_value('item_scraped_count', 0) >= indexing_page_limit:
+                self.stats.inc_value('pagelimit/ignored')
+                raise IgnoreRequest('Indexing page limit of {} reached'.format(indexing_page_limit))
+        request.meta['page_limit_counted'] = True
+        self.requests_in_flight += 1
+        return None
+
+    def process_response(self, request, response, spider):
+        if self.request_finished(request):
+            request.meta['page_limit_follow'] = True # i.e. for a redirect or retry of this request
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if self.request_finished(request):
+            request.meta['page_limit_follow'] = True # i.e. for a retry of this request
+        return None
+
+    def request_dropped(self, request, spider):
+        self.request_finished(request)
+
+    def request_scheduled(self, request, spider):
+        self.request_finished(request)
+
+    # Returns True if the request was being counted
+    def request_finished(self, request):
+        if request.meta.pop('page_limit_counted', None):
+            self.requests_in_flight -= 1
+            return True
+        return False
@@ -2,16 +2,26 @@ import pysolr
 from scrapy.utils.log import configure_logging
 from scrapy.exceptions import DropItem
 import re
+import os
+import time
+import pickle
 from scrapy.utils.log import configure_logging
 from scrapy.utils.project import get_project_settings
+from scrapy.utils.job import job_dir
+from twisted.internet.threads import deferToThread
 import logging
 from common.utils import update_indexing_status, get_last_complete_indexing_log_message, deactivate_indexing, web_feed_and_sitemap, convert_datetime_to_utc_date, send_email
+from common.linkgraph import update_link_graph
+
+# The file in the JOBDIR which the items found so far are saved to when a full index times out, so it can be resumed
+crawl_state_file = 'items.pickle'
 
 
 # This is the Solr pipeline, for submitting indexed items to Solr
 # It originally just did a self.solr.add(dict(item)) in process_item 
 # and self.solr.commit() in close_spider because a commit on every add was slow.
-# However, it now builds a list of dicts and only connects to Solr on the close_spider.
+# However, it now builds a list of dicts and only connects to Solr on the close_spider,
+# and doesn't commit at all, leaving it to the coordinated commit (see SOLR_COMMIT_WITHIN in settings.py).
 # 
 # Notes on deduplication:
 # If I start indexing https://michael-lewis.com/ from https://www.michael-lewis.com/ 
@@ -27,11 +37,26 @@ from common.utils import update_indexing_status, get_last_complete_indexing_log_
 # (a workaround could be to remove the whole domain and fingerprint on the path, but that would break
 # if there were ever sites like blog.domain.com and news.domain.com), and (ii) I don't think you can 
 # access previous request.urls for comparison.
+#
+# Notes on resuming full indexes:
+# Full indexes are run with a JOBDIR (see get_crawler in search_my_site_scheduler.py), so Scrapy persists the scheduled requests
+# and the requests already seen. If the crawl is stopped by the CLOSESPIDER_TIMEOUT, the items found so far are saved to the JOBDIR
+# along with the index_generation, nothing is submitted to Solr, and the indexing status is set to PENDING so the site is claimed again
+# on the next scheduler cycle. The resumed crawl then loads the items, continues from the saved requests, and has its indexing_page_limit
+# reduced by the number of items already found. Only once the crawl completes are all the items submitted and the docs from previous
+# crawls deleted, so the site is never left partially indexed. Note that requests which were being downloaded when the crawl timed out
+# will have been marked as seen, so a few pages can be missed.
 
 class SolrPipeline:
 
-    def __init__(self, stats, solr_url):
+    def __init__(self, stats, solr_url, chunks_solr_url, solr_add_batch_size, solr_commit_within, jobdir, closespider_timeout, max_resumes):
         self.solr_url = solr_url
+        self.chunks_solr_url = chunks_solr_url
+        self.solr_add_batch_size = solr_add_batch_size
+        self.solr_commit_within = solr_commit_within
+        self.jobdir = jobdir
+        self.closespider_timeout = closespider_timeout
+        self.max_resumes = max_resumes
         self.items = []
         configure_logging()
         self.logger = logging.getLogger()
@@ -41,21 +66,135 @@ class SolrPipeline:
     def from_crawler(cls, crawler):
         return cls(
             solr_url = crawler.settings.get('SOLR_URL'),
+            chunks_solr_url = crawler.settings.get('CONTENT_CHUNKS_SOLR_URL'),
+            solr_add_batch_size = crawler.settings.getint('SOLR_ADD_BATCH_SIZE'),
+            solr_commit_within = crawler.settings.getint('SOLR_COMMIT_WITHIN'),
+            jobdir = job_dir(crawler.settings),
+            closespider_timeout = crawler.settings.getint('CLOSESPIDER_TIMEOUT'),
+            max_resumes = crawler.settings.getint('CRAWL_STATE_MAX_RESUMES'),
             stats = crawler.stats
         )
 
     def open_spider(self, spider):
         self.solr = pysolr.Solr(self.solr_url) # always_commit=False by default
+        # The content chunks are nested child docs of the pages in the content core unless CONTENT_CHUNKS_SOLR_URL is set
+        self.chunks_solr = pysolr.Solr(self.chunks_solr_url) if self.chunks_solr_url else None
+        # Every doc from this crawl is stamped with the index_generation, so after a full reindex the docs from
+        # previous crawls of the domain can be identified (and deleted) as those with a different index_generation
+        self.index_generation = int(time.time() * 1000)
+        self.resumes = 0
+        self.started = time.monotonic()
+        # If resuming a full index which timed out, carry on from where it stopped
+        if self.jobdir and os.path.exists(os.path.join(self.jobdir, crawl_state_file)):
+            with open(os.path.join(self.jobdir, crawl_state_file), 'rb') as f:
+                crawl_state = pickle.load(f)
+            self.items = crawl_state['items']
+            self.index_generation = crawl_state['index_generation']
+            self.resumes = crawl_state['resumes'] + 1
+            spider.site_config['feed_links'] = crawl_state['feed_links']
+            spider.site_config['indexing_page_limit'] = spider.site_config['indexing_page_limit'] - len(self.items)
+            self.logger.info('Resuming the full index for {} with {} documents found so far (resume {})'.format(spider.domain, len(self.items), self.resumes))
         return
 
+    # i.e. whether the crawl was stopped by the CLOSESPIDER_TIMEOUT with pages still to crawl, and can be resumed
+    def is_resumable(self, spider):
+        if not self.jobdir or not self.closespider_timeout or spider.site_config['full_index'] != True:
+            return False
+        if time.monotonic() - self.started < self.closespider_timeout or self.resumes >= self.max_resumes:
+            return False
+        return self.has_pending_requests(spider)
+
+    # Whether the scheduler still has requests queued, i.e. in the JOBDIR for the resumed crawl. The pipelines are closed before the scheduler,
+    # so it is still available here. The engine's slot is engine._slot in recent Scrapy versions and engine.slot in older ones.
+    def has_pending_requests(self, spider):
+        engine = spider.crawler.engine
+        slot = getattr(engine, '_slot', None) or getattr(engine, 'slot', None)
+        if slot is None or slot.scheduler is None:
+            return False
+        try:
+            return slot.scheduler.has_pending_requests()
+        except Exception as e:
+            self.logger.warning('Unable to check for pending requests for {}: {}'.format(spider.domain, e))
+            return False
+
+    def save_crawl_state(self, spider):
+        crawl_state = {'items': self.items, 'index_generation': self.index_generation, 'resumes': self.resumes, 'feed_links': spider.site_config['feed_links']}
+        with open(os.path.join(self.jobdir, crawl_state_file), 'wb') as f:
+            pickle.dump(crawl_state, f)
+        message = 'Crawl timed out with {} documents found so far, so the full index will be resumed. '.format(len(self.items))
+        self.logger.info('{}: {}'.format(spider.domain, message))
+        update_indexing_status(spider.domain, spider.site_config['full_index'], 'PENDING', message)
+
+    # The rest of the JOBDIR is removed when the next full index starts, because Scrapy writes to it after the pipeline has closed
+    def remove_crawl_state(self):
+        if self.jobdir and os.path.exists(os.path.join(self.jobdir, crawl_state_file)):
+            os.remove(os.path.join(self.jobdir, crawl_state_file))
+
+    # Add the items to Solr in batches rather than one request per item, stamping each (and any child docs) with the index_generation
+    # If the content chunks are in the chunks core, they are taken out of the items and returned (with the parent_id set) rather than
+    # added as child docs, so they can be added to the chunks core by add_content_chunks
+    def add_items(self):
+        content_chunks = []
+        for item in self.items:
+            item['index_generation'] = self.index_generation
+            for content_chunk in item.get('content_chunks') or []:
+                content_chunk['index_generation'] = self.index_generation
+            if self.chunks_solr and 'content_chunks' in item:
+                for content_chunk in item.pop('content_chunks') or []:
+                    content_chunk['parent_id'] = item['id']
+                    content_chunks.append(content_chunk)
+        for start in range(0, len(self.items), self.solr_add_batch_size):
+            self.solr.add(self.items[start:start + self.solr_add_batch_size], commitWithin=self.solr_commit_within)
+        return content_chunks
+
+    # Add the content chunks to the chunks core (if CONTENT_CHUNKS_SOLR_URL is set), replacing the existing chunks of the pages.
+    # For a full index, the chunks from previous crawls are deleted by index_generation like the pages in the content core.
+    # For an incremental index, the existing chunks of the pages which have been re-added are deleted by parent_id,
+    # so chunks from a longer previous version of a page don't get left behind.
+    def add_content_chunks(self, domain, content_chunks, full_index):
+        if not self.chunks_solr:
+            return
+        if not full_index:
+            ids = [item['id'] for item in self.items]
+            for start in range(0, len(ids), self.solr_add_batch_size):
+                self.chunks_solr.delete(q='{{!terms f=parent_id separator=" "}}{}'.format(' '.join(ids[start:start + self.solr_add_batch_size])))
+        for start in range(0, len(content_chunks), self.solr_add_batch_size):
+            self.chunks_solr.add(content_chunks[start:start + self.solr_add_batch_size], commitWithin=self.solr_commit_within)
+        if full_index:
+            self.chunks_solr.delete(q='domain:{} AND -index_generation:{}'.format(domain, self.index_generation))
+
     # close_spider is run for each site at the end of the spidering process
     # Depending on the type of index (full or incremental) and the outcome
     # - If it is a full reindex, but zero documents have been found, that suggests an error somewhere, e.g. site unavailable.
     #   If that happens twice in a row, that suggests a more permanent error, so indexing for the site is deactivated.
     # - If it is a full reindex, but documents are found, get all the site specific data which is set on the home page,
-    #   and clean out the existing index for that site.
+    #   add the new docs, and only once they have all been added successfully delete the docs from previous crawls,
+    #   so the site doesn't (even briefly) disappear from the search results, and if there's an error submitting to Solr
+    #   the docs from the previous crawl are kept.
     # - If it is an incremental reindex, don't delete the existing docs, just add the new ones.
+    # - If it is a full reindex which has timed out and can be resumed, save the crawl state rather than submitting anything.
+    # The Solr submission and database updates are blocking, so they are run in a thread from the reactor's thread pool,
+    # and the Deferred is returned so Scrapy waits for it to complete before the spider is closed. This means that
+    # other crawls running in the same process aren't stalled while one site's documents are submitted to Solr.
     def close_spider(self, spider):
+        d = deferToThread(self.submit_to_solr, spider)
+        d.addErrback(self.submit_to_solr_failed, spider)
+        return d
+
+    # If submit_to_solr fails with an unexpected error (e.g. a database error in update_link_graph or an error sending an email),
+    # log the traceback and mark the indexing as COMPLETE with a WARNING, so the failure is in the indexing log rather than
+    # the site being left RUNNING until its lease expires. The status update is blocking, so it is also run in a thread.
+    def submit_to_solr_failed(self, failure, spider):
+        self.logger.error('Error submitting docs to Solr for {}: {}'.format(spider.domain, failure.getTraceback()))
+        message = 'WARNING: Error completing the indexing: {}. '.format(failure.getErrorMessage())
+        d = deferToThread(update_indexing_status, spider.domain, spider.site_config['full_index'], 'COMPLETE', message)
+        d.addErrback(lambda status_failure: self.logger.error('Error updating the indexing status for {}: {}'.format(spider.domain, status_failure.getErrorMessage())))
+        return d
+
+    def submit_to_solr(self, spider):
+        if self.is_resumable(spider):
+            self.save_crawl_state(spider)
+            return
         no_of_docs = len(self.items)
         if spider.site_config['full_index'] == True and no_of_docs == 0:
             self.logger.warning('No documents found at start urls {} (domain {}). This is likely an error with the site or with this system.'.format(spider.start_urls, spider.domain))
@@ -72,6 +211,8 @@ class SolrPipeline:
                 newmessage = 'The previous indexing for {} also found no documents. Deleting existing Solr docs and deactivating indexing.'.format(spider.domain)
                 self.logger.warning(newmessage)
                 self.solr.delete(q='domain:{}'.format(spider.domain))
+                if self.chunks_solr: self.chunks_solr.delete(q='domain:{}'.format(spider.domain))
+                update_link_graph(spider.domain, [], True, spider.common_config['domains_allowing_subdomains'])
                 deactivate_indexing(spider.domain, "Indexing failed twice in a row. {}".format(submessage))
                 message = message + submessage + newmessage
                 if tier == 3: # If a paid for listing, send an email to the site admin for investigation
@@ -82,6 +223,7 @@ class SolrPipeline:
             else:
                 message = message + submessage + 'robotstxt/forbidden {}, retry/max_reached {}'.format(self.stats.get_value('robotstxt/forbidden'), self.stats.get_value('retry/max_reached'))
         else:
+            solr_error = None
             if spider.site_config['full_index'] == True:
                 # Get values which are only set for the home page
                 # Note that the home page will only be updated in a full reindex
@@ -89,11 +231,6 @@ class SolrPipeline:
                 date_domain_added = convert_datetime_to_utc_date(spider.site_config['date_domain_added'])
                 web_feed, sitemap = web_feed_and_sitemap(spider.domain, self.items)
                 self.logger.info('Using web_feed: {}, sitemap: {}'.format(web_feed, sitemap))
-                # Delete the existing documents
-                # It is important to delete all existing documents on a full reindex to clean up moved and deleted documents
-                # but the delete all existing documents must only be performed for a full rather than incremental reindex
-                self.logger.info('Deleting existing Solr docs for {}.'.format(spider.domain))
-                self.solr.delete(q='domain:{}'.format(spider.domain))
                 # Add the new documents
                 self.logger.info('Full index, submitting {} newly spidered docs to Solr for {}.'.format(str(no_of_docs), spider.domain))
                 for item in self.items:
@@ -103,7 +240,16 @@ class SolrPipeline:
                         item['api_enabled'] = api_enabled
                         item['date_domain_added'] = date_domain_added
                         item['web_feed'] = web_feed
-                    self.solr.add(dict(item))
+                try:
+                    content_chunks = self.add_items()
+                    # Delete the existing documents, i.e. those from previous crawls
+                    # It is important to delete all existing documents on a full reindex to clean up moved and deleted documents
+                    # but the delete all existing documents must only be performed for a full rather than incremental reindex
+                    self.logger.info('Deleting Solr docs from previous crawls for {}.'.format(spider.domain))
+                    self.solr.delete(q='domain:{} AND -index_generation:{}'.format(spider.domain, self.index_generation))
+                    self.add_content_chunks(spider.domain, content_chunks, True)
+                except pysolr.SolrError as e:
+                    solr_error = e
             else:
                 # i.e. if just an incremental index
                 # Note that the first incremental index for a site must come after the first full index, to ensure the full index sets e.g. the home page values
@@ -112,10 +258,22 @@ class SolrPipeline:
                     # This is removed by web_feed_and_sitemap for a full index, so have to remove here for incremental otherwise Solr will return error
                     if 'is_web_feed' in item:
                         del item['is_web_feed'] 
-                    self.solr.add(dict(item))
-            # Save changes
-            self.solr.commit()
-            message = 'SUCCESS: {} documents found. '.format(self.stats.get_value('item_scraped_count'))
+                try:
+                    content_chunks = self.add_items()
+                    self.add_content_chunks(spider.domain, content_chunks, False)
+                except pysolr.SolrError as e:
+                    solr_error = e
+            # There's no commit here, because the changes are made visible by the coordinated commit (see SOLR_COMMIT_WITHIN in settings.py),
+            # i.e. the commitWithin on the adds, or the soft auto commit for the delete (pysolr's delete doesn't support commitWithin).
+            # This means the adds and the delete of the docs from previous crawls normally become visible in the same commit.
+            # Update the link graph with the new indexed_outlinks, which also updates the indexed_inlinks on the pages linked to
+            if not solr_error:
+                update_link_graph(spider.domain, self.items, spider.site_config['full_index'], spider.common_config['domains_allowing_subdomains'])
+            if solr_error:
+                self.logger.error('Error submitting docs to Solr for {}: {}'.format(spider.domain, solr_error))
+                message = 'WARNING: Error submitting {} documents to Solr, so documents from the previous index have been kept. '.format(no_of_docs)
+            else:
+                message = 'SUCCESS: {} documents found. '.format(no_of_docs) # i.e. including those from before any resumes
             if self.stats.get_value('log_count/WARNING'):
                 message = message + 'log_count/WARNING: {} '.format(self.stats.get_value('log_count/WARNING'))
             if self.stats.get_value('log_count/ERROR'):
@@ -124,6 +282,7 @@ class SolrPipeline:
         # Pass in whether full index or not (i.e. whether indexing type full or incremental) to set the appropriate completed times.
         # Message starts with SUCCESS or WARNING.
         update_indexing_status(spider.domain, spider.site_config['full_index'], 'COMPLETE', message)
+        self.remove_crawl_state()
 
     def process_item(self, item, spider):
         new_url = item['url']
@@ -5,7 +5,7 @@ S=120
 if [ "$1" = "dev" ]
 then
   S=60
-  echo "Running in dev mode. Going to run search_my_site_scheduler.py every 60s rather than every 120s."
+  echo "Running in dev mode. Going to restart search_my_site_scheduler.py after 60s rather than 120s if it exits."
 elif [ "$1" = "test" ]
 then
   echo "Running in test mode. Not going to run search_my_site_scheduler.py"
@@ -17,8 +17,9 @@ fi
 # Give the database etc. time to start
 sleep $S
 
+# The scheduler keeps running in listen mode, starting indexing as sites become due or are notified by the web app,
+# and recalculating the domain ranks once a day, so this loop just restarts it if it exits
 while true
-  do python /usr/src/app/search_my_site_scheduler.py
+  do python /usr/src/app/search_my_site_scheduler.py --listen
   sleep $S
 done
-
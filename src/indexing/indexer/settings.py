@@ -22,13 +22,55 @@ DB_NAME = 'searchmysitedb'
 DB_USER = 'postgres'
 DB_HOST = 'db'
 
+# Searchmysite custom config for the indexing job queue
+# Sites are claimed by an indexer process with a lease, which is extended every INDEXING_HEARTBEAT_INTERVAL seconds while
+# the indexing is in progress. If the lease isn't extended (e.g. because the process has crashed) the site can be claimed by
+# another indexer process once INDEXING_LEASE_DURATION seconds have passed since the last heartbeat.
+INDEXING_LEASE_DURATION = 300
+INDEXING_HEARTBEAT_INTERVAL = 60
+# Up to INDEXING_MAX_SITES sites are indexed at a time by each indexer process, plus up to INDEXING_FAST_LANE_SITES sites
+# which the web app has notified need indexing straight away, e.g. newly approved sites (see search_my_site_scheduler.py).
+INDEXING_MAX_SITES = 8
+INDEXING_FAST_LANE_SITES = 1
+# When the scheduler is running in listen mode, how often to check for sites due for scheduled reindexing (in seconds).
+# This can be relatively infrequent because sites which need indexing straight away are notified rather than polled for.
+SCHEDULER_POLL_INTERVAL = 600
+SCHEDULER_NOTIFY_CHECK_INTERVAL = 1
+SCHEDULER_DOMAIN_RANK_INTERVAL = 86400 # i.e. recalculate the domain ranks once a day
+SCHEDULER_SEARCH_WARMING_INTERVAL = 3600 # i.e. update the Solr warming queries from the search query log once an hour
+# The number of the most frequent search queries used to warm the Solr caches after each commit
+SEARCH_WARMING_QUERIES = 20
+# The indexing log (tblIndexingLog) is partitioned by month, and partitions older than this are dropped
+INDEXING_LOG_RETENTION_MONTHS = 12
+SCHEDULER_SOLR_STATS_INTERVAL = 3600 # i.e. log the Solr commit counts and searcher warm up times once an hour
+
 # Searchmysite custom config for search
 SOLR_URL = 'http://search:8983/solr/content/'
+# Solr commits are coordinated by Solr's soft commit tracker rather than each writer committing, i.e. writers send their changes with
+# commitWithin SOLR_COMMIT_WITHIN (in ms) or without a commit, and the changes from all the crawls which finish within the interval become
+# visible in the same commit, so at most one new searcher is opened per interval. This should be the same as solr.autoSoftCommit.maxTime
+# in solrconfig.xml and solr_commit_within in the web app's solr.py.
+SOLR_COMMIT_WITHIN = 10000
+SOLR_ADD_BATCH_SIZE = 100 # number of docs submitted to Solr in each request at the end of a crawl
+SOLR_CLIENT_TIMEOUT = 30 # timeout in seconds for the requests to Solr outside the crawls, e.g. the atomic updates of the site level fields
+# The content chunks (with their embeddings) are nested child docs of the pages in the content core by default. Set this to the URL of a
+# core created from the chunks configset to keep them there instead, keyed on parent_id, so the lexical search isn't slowed down by the chunks.
+# This should be the same as CONTENT_CHUNKS_SOLR_URL in the web app's config.py.
+CONTENT_CHUNKS_SOLR_URL = None # e.g. 'http://search:8983/solr/chunks/'
 
 # Searchmysite custom config for chunking and embedding
 EMBEDDING_MODEL = 'BAAI/bge-small-en-v1.5'
 CHUNK_SIZE = 500 # in chars
 CHUNK_OVERLAP = 50
+# How the embeddings are stored:
+# - 'FLOAT' in content_chunk_vector as float32, i.e. 1.5KB per chunk for a 384 dimension model
+# - 'BYTE' in content_chunk_byte_vector scalar quantised to int8, i.e. 384 bytes per chunk, which is 4 times less memory for the HNSW graph
+# For BYTE, each value is scaled so the EMBEDDING_QUANTISATION_SCALES value for the EMBEDDING_MODEL maps to 127 (larger values are clipped).
+# The scale for a model is calibrated, and the recall@10 against the float embeddings measured, with python -m common.vectorquantisation
+# These should be the same as VECTOR_ENCODING and EMBEDDING_QUANTISATION_SCALES in the web app's config.py, and a change to either
+# (or to the scale for the model in use) requires the embeddings to be regenerated.
+VECTOR_ENCODING = 'FLOAT'
+EMBEDDING_QUANTISATION_SCALES = {} # e.g. {'BAAI/bge-small-en-v1.5': <scale from python -m common.vectorquantisation>}
 
 LOG_LEVEL = 'INFO'
 
@@ -71,8 +113,16 @@ TWISTED_REACTOR = 'twisted.internet.asyncioreactor.AsyncioSelectorReactor'
 # If the spider remains open for more than that number of seconds, it will be automatically closed with the reason closespider_timeout
 CLOSESPIDER_TIMEOUT = 1800 # i.e. 30 minutes
 
+# Full indexes which are stopped by the CLOSESPIDER_TIMEOUT are resumed on the next scheduler cycle rather than started again from the home page,
+# so large sites can be indexed up to their indexing_page_limit over several time slices. The crawl state for each domain, i.e. the JOBDIR
+# (the scheduled requests and the requests already seen) and the items found so far, is kept in CRAWL_STATE_DIR/<domain> until the full index completes.
+# After CRAWL_STATE_MAX_RESUMES resumes the full index completes at the next timeout with the items found so far, e.g. for sites with endless links.
+CRAWL_STATE_DIR = '/usr/src/crawlstate'
+CRAWL_STATE_MAX_RESUMES = 5
+
 # Changing from Last In First Out to First In First Out as per https://docs.scrapy.org/en/latest/faq.html#does-scrapy-crawl-in-breadth-first-or-depth-first-order
 # This is because important links like the RSS/Atom feed are often found first but not reached before the indexing page limit 
+# Note that the requests are scheduled by priority first (see the crawl frontier in spiders/search_my_site_spider.py), and FIFO within each priority
 SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleFifoDiskQueue'
 SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.FifoMemoryQueue'
 
@@ -9,7 +9,7 @@ from scrapy.utils.log import configure_logging
 from scrapy.utils.project import get_project_settings
 import logging
 import feedparser
-from common.utils import extract_domain_from_url, convert_string_to_utc_date, convert_datetime_to_utc_date, get_text #, get_content_chunks, get_vector
+from common.utils import extract_domain_from_url, convert_string_to_utc_date, convert_datetime_to_utc_date, get_text, get_static_rank #, get_content_chunks, get_vector, get_vector_field
 
 # Solr schema is:
 #    <field name="url" type="string" indexed="true" stored="true" required="true" />
@@ -43,10 +43,15 @@ from common.utils import extract_domain_from_url, convert_string_to_utc_date, co
 #    <field name="indexed_inlink_domains" type="string" indexed="true" stored="true" multiValued="true" />
 #    <field name="indexed_inlink_domains_count" type="pint" indexed="true" stored="true" />
 #    <field name="indexed_outlinks" type="string" indexed="true" stored="true" multiValued="true" />
+#    <field name="index_generation" type="plong" indexed="true" stored="true" /> <!-- same value for every doc added in a crawl, so docs from previous crawls can be deleted after a full reindex -->
+#    <field name="domain_rank" type="pfloat" indexed="true" stored="true" /> <!-- same value for every page in a site, calculated offline from the links between domains -->
+#    <field name="static_rank" type="pfloat" indexed="false" stored="false" /> <!-- docValues only, the query independent part of the relevancy, used by the boost in solrconfig.xml -->
 #    <fieldType name="knn_vector384" class="solr.DenseVectorField" vectorDimension="384" similarityFunction="dot_product"/>
+#    <fieldType name="knn_vector384_byte" class="solr.DenseVectorField" vectorDimension="384" similarityFunction="dot_product" vectorEncoding="BYTE"/>
 #    <field name="content_chunk_no" type="pint" indexed="true" stored="true" /> <!-- only in relationship:child below content_chunks pseudo-field -->
 #    <field name="content_chunk_text" type="string" indexed="true" stored="true" /> <!-- only in relationship:child below content_chunks pseudo-field -->
 #    <field name="content_chunk_vector" type="knn_vector384" indexed="true" stored="true"/> <!-- only in relationship:child below content_chunks pseudo-field -->
+#    <field name="content_chunk_byte_vector" type="knn_vector384_byte" indexed="true" stored="true"/> <!-- only in relationship:child below content_chunks pseudo-field, instead of content_chunk_vector if VECTOR_ENCODING is BYTE -->
 #    <field name="content_chunk_model" type="string" indexed="true" stored="true" /> <!-- only in relationship:child below content_chunks pseudo-field -->
 
 def customparser(response, domain, is_home, domains_for_indexed_links, site_config, common_config):
@@ -126,6 +131,9 @@ def customparser(response, domain, is_home, domains_for_indexed_links, site_conf
     # site_category
     item['site_category'] = site_config['site_category']
 
+    # domain_rank
+    item['domain_rank'] = site_config['domain_rank']
+
     # indexed_inlinks
     # i.e. the pages in the search collection on other domains which link to this page
     indexed_inlinks = []
@@ -303,6 +311,7 @@ def customparser(response, domain, is_home, domains_for_indexed_links, site_conf
         #        previous_content_chunks = previous_page['content_chunks']
         # Scenarios:
         # 1. Content has changed, or content is new, or there aren't any existing content_chunks (e.g. on first run) - regenerate
+        #    or the existing content_chunks are from a different VECTOR_ENCODING (i.e. don't have the get_vector_field()) - regenerate
         # 2. Else reuse previous values
         # Note: A full reindex until now has always been a clean reindex, i.e. delete everything in the index for that domain and
         #    start afresh. However, with the content_chunks functionality, it is the first time content is potentially preserved
@@ -310,7 +319,7 @@ def customparser(response, domain, is_home, domains_for_indexed_links, site_conf
         #    has changed. That may be fine for minor embedding config changes, e.g. a change to the chunk length, but could be breaking
         #    for significant embedding config changes, e.g. if the embedding model is changed. Suggestion in the case of significant
         #    config changes is to delete all embeddings, e.g. via <delete><query>relationship:child</query></delete> . 
-        #if (previous_content and new_content and previous_content != new_content) or (new_content and not previous_content) or (not previous_content_chunks):
+        #if (previous_content and new_content and previous_content != new_content) or (new_content and not previous_content) or (not previous_content_chunks) or (get_vector_field() not in previous_content_chunks[0]):
         #    content_chunks = get_content_chunks(content_text, site_config['content_chunks_limit'], item['id'], item['url'], domain)
         #else:
         #    logger.debug("Reusing existing embeddings for {}".format(item['id']))
@@ -370,4 +379,8 @@ def customparser(response, domain, is_home, domains_for_indexed_links, site_conf
         item['content'] = response.text
 
 
+    # static_rank
+    # This is last because it is derived from indexed_inlink_domains_count, contains_adverts and owner_verified
+    item['static_rank'] = get_static_rank(item['indexed_inlink_domains_count'], item.get('contains_adverts'), item['owner_verified'])
+
     return item
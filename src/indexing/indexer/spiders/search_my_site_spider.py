@@ -6,23 +6,59 @@ from scrapy.http.response.text import TextResponse
 from scrapy.http import Request, HtmlResponse, XmlResponse
 from scrapy.utils.log import configure_logging
 from scrapy.utils.project import get_project_settings
+from scrapy.utils.sitemap import sitemap_urls_from_robots
+from scrapy.utils.gz import gunzip, gzip_magic_number
 import logging
 from bs4 import BeautifulSoup
 import datetime
+from io import BytesIO
+from lxml import etree
 from urllib.parse import urlsplit
 import feedparser
 from indexer.spiders.search_my_site_parser import customparser
+from common.utils import convert_string_to_utc_date
 import re
 
 # extensions which have caused issues
 IGNORED_EXTENSIONS += ['jar', 'json', 'cbr'] 
 
+# Crawl frontier
+# Requests are scheduled in priority order (and in FIFO order within the same priority), so that on sites with more pages
+# than the indexing_page_limit the pages indexed are the most valuable ones rather than just the first reached breadth first.
+# The priority of a request is the sum of:
+# - feed_link_priority if it is in the web feed, i.e. is likely to be a post
+# - inlink_priority for each page (on other domains in the index) which links to it, up to max_inlinks
+# - depth_priority for each link followed from the start urls, so shallower pages come first
+# - low_value_priority if the URL looks like a listing page rather than content, e.g. a tag, category, author, archive or pagination page
+# - query_string_priority if the URL has a query string
+feed_link_priority = 100
+inlink_priority = 20
+max_inlinks = 5
+depth_priority = -10
+low_value_priority = -50
+query_string_priority = -20
+low_value_url_path = re.compile(r'/(tags?|categor(y|ies)|labels?|topics?|archives?|authors?|page|search)(/|$)|/\d{4}/(\d{2}/){0,2}$', re.IGNORECASE)
+# Once max_frontier_factor times the indexing_page_limit different URLs have been enqueued, only requests with a priority above zero
+# (e.g. those in the web feed or with indexed inlinks) are enqueued, because the others are unlikely to be reached within the limit
+max_frontier_factor = 2
+
+# Sitemaps (for incremental indexes)
+# The pages in the sitemap which have changed since they were indexed are given changed_link_priority on top of their usual priority,
+# so they are reindexed ahead of new pages. max_sitemaps is the maximum number of sitemaps fetched (including those listed in sitemap indexes),
+# and sitemap_max_size is the maximum (uncompressed) size of a sitemap, which is 50MB in the sitemap protocol
+changed_link_priority = 200
+max_sitemaps = 10
+sitemap_max_size = 52428800
+
 class SearchMySiteSpider(CrawlSpider):
     name = "searchmysitespider"
 
     custom_settings = {
         'ITEM_PIPELINES': {
             'indexer.pipelines.SolrPipeline': 300
+        },
+        'DOWNLOADER_MIDDLEWARES': {
+            'indexer.middlewares.PageLimitMiddleware': 650 # i.e. after the RedirectMiddleware (600) and RetryMiddleware (550)
         }
     }
 
@@ -41,6 +77,12 @@ class SearchMySiteSpider(CrawlSpider):
         self.exclusions = self.site_config['exclusions']
         self.domains_for_indexed_links = self.common_config['domains_for_indexed_links']
         self.site_config['feed_links'] = [] # This will be instantiated by parse_start_url
+        if 'sitemap' in self.site_config.keys():
+            self.sitemap = self.site_config['sitemap']
+        else:
+            self.sitemap = None
+        self.sitemaps_requested = 0
+        self.frontier_urls = set() # The URLs enqueued via set_request_priority
         # Need to remove current domain from the list so indexed_outlinks does just contain outlinks
         # (and also check the current domain is in the list in case it has been removed for another domain allowing subdomains)
         if self.domain in self.domains_for_indexed_links: self.domains_for_indexed_links.remove(self.domain)
@@ -70,11 +112,12 @@ class SearchMySiteSpider(CrawlSpider):
                     self.logger.info('Changing {} in deny path to {}'.format(old_exclusion_value, exclusion_value))
                 deny.append(exclusion_value)
         self.logger.info('Deny path {}'.format(deny))
+        self.deny = [re.compile(deny_path) for deny_path in deny] # for the links from the sitemap, which don't go through the LinkExtractor
         # Set up rules for full index or incremental index
         # There are two key differences - if it is an incremental index:
         # 1. Only index new links, i.e. links which aren't already in the index (use process_links to remove 
         #    already indexed links from the home_page links and parse_start_url to remove already indexed links
-        #    from the rss_feed and sitemap links).
+        #    from the rss_feed and sitemap links), plus the links in the sitemap which have changed since they were indexed (see parse_sitemap).
         # 2. Do not follow links, i.e. only index the new links on the home page, rss_feed and sitemap. 
         # Otherwise, both full and incremental have the same allowed domains, deny, deny extensions, and tags
         # (link is in the tags to pick up RSS feeds from <link rel="alternate" type="application/rss+xml" href=)
@@ -82,14 +125,14 @@ class SearchMySiteSpider(CrawlSpider):
             self.rules = (
                 Rule(
                     LinkExtractor(allow_domains=self.allowed_domains, deny=deny, deny_extensions=IGNORED_EXTENSIONS, tags=('a','area','link')),
-                    callback=self.parse_item, follow=True
+                    callback=self.parse_item, process_request=self.set_request_priority, follow=True
                     ),
                 )
         else:
             self.rules = (
                 Rule(
                     LinkExtractor(allow_domains=self.allowed_domains, deny=deny, deny_extensions=IGNORED_EXTENSIONS, tags=('a','area','link')),
-                    callback=self.parse_item, process_links=self.remove_already_indexed_links, follow=False
+                    callback=self.parse_item, process_links=self.remove_already_indexed_links, process_request=self.set_request_priority, follow=False
                     ),
                 )
         super(SearchMySiteSpider, self).__init__(self, *args, **kwargs)
@@ -135,7 +178,7 @@ class SearchMySiteSpider(CrawlSpider):
             yield item
             for link in links_to_index:
                 try:
-                    yield Request(link, callback=self.parse_item)
+                    yield Request(link, callback=self.parse_item, priority=self.get_request_priority(link, response.meta.get('depth', 0) + 1))
                 except ValueError:
                     logger.warn('ValueError for {}'.format(link)) # Sometimes links in feeds are relative and throw ValueError(f"Missing scheme in request url: {self._url}")
         elif isinstance(response, HtmlResponse):
@@ -156,6 +199,7 @@ class SearchMySiteSpider(CrawlSpider):
         # Using this method to stop the spider when indexing_page_limit reached
         # Can't use self.settings['CLOSESPIDER_ITEMCOUNT'] because that is at class level, 
         # but we may have different values at instance level
+        # Note that the PageLimitMiddleware stops requests being downloaded once the limit is in sight, so this is just a backstop
         if scrape_count == indexing_page_limit:
             logger.info('Indexing page limit of {} reached.'.format(str(indexing_page_limit)))
             raise CloseSpider("Indexing page limit reached.")
@@ -175,9 +219,77 @@ class SearchMySiteSpider(CrawlSpider):
     # for each url in start_urls"
     # The dont_filter=True means that the start_urls bypass the deduplication, which means a 2nd home page could be indexed after the first, 
     # and the 2nd wouldn't have is_home=true, so we need to override this method
+    # Incremental indexes also request the sitemaps, i.e. the recorded sitemap for the site and any listed in its robots.txt (see parse_sitemap)
     async def start(self):
         for url in self.start_urls:
             yield Request(url)
+        if self.full_index == False:
+            home_page = urlsplit(self.home_page)
+            yield Request('{}://{}/robots.txt'.format(home_page.scheme, home_page.netloc), callback=self.parse_robots, meta={'page_limit_exempt': True, 'dont_obey_robotstxt': True})
+            if self.sitemap:
+                yield self.get_sitemap_request(self.sitemap)
+
+    def get_sitemap_request(self, url):
+        self.sitemaps_requested += 1
+        return Request(url, callback=self.parse_sitemap, meta={'page_limit_exempt': True, 'download_maxsize': sitemap_max_size})
+
+    def parse_robots(self, response):
+        for url in sitemap_urls_from_robots(response.text, base_url=response.url):
+            if self.sitemaps_requested < max_sitemaps:
+                yield self.get_sitemap_request(url)
+
+    # parse_sitemap stream parses a sitemap or sitemap index (so a large sitemap isn't loaded into memory as a tree), and requests:
+    # - The pages which have been indexed but have a lastmod after the date they were indexed. The indexing_page_limit is increased
+    #   by the number of these, because they replace existing pages rather than adding to the number of pages in the index.
+    # - The pages which haven't been indexed, highest priority first, up to max_frontier_factor times the indexing_page_limit.
+    #   These are limited by the indexing_page_limit like the new links from the home page.
+    # - The sitemaps in a sitemap index, up to max_sitemaps in total.
+    # Pages which have been indexed and don't have a lastmod, or which match the deny paths, are skipped.
+    # Note that the lastmod and indexed date are both converted to Solr's date format, so they can be compared as strings.
+    def parse_sitemap(self, response):
+        configure_logging(get_project_settings())
+        logger = logging.getLogger()
+        body = response.body
+        if gzip_magic_number(response):
+            body = gunzip(body, max_size=sitemap_max_size)
+        already_indexed_links = self.site_config['already_indexed_links']
+        # The home page and web feed aren't reindexed from the sitemap, because parse_item doesn't set the home page fields (is_home etc.),
+        # i.e. the home page as indexed would be replaced by a doc without them. They are requested from the start_urls anyway.
+        not_changed_links = self.site_config.get('indexed_home_pages', set()) | {self.home_page, self.web_feed}
+        changed_links = []
+        new_links = []
+        sitemaps = []
+        try:
+            for event, element in etree.iterparse(BytesIO(body), events=('end',), tag=('{*}url', '{*}sitemap'), recover=True, resolve_entities=False):
+                loc = (element.findtext('{*}loc') or '').strip()
+                lastmod = convert_string_to_utc_date((element.findtext('{*}lastmod') or '').strip())
+                is_sitemap = etree.QName(element).localname == 'sitemap'
+                # Free the elements which have been processed
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                if not loc:
+                    continue
+                if is_sitemap:
+                    sitemaps.append(loc)
+                elif any(deny_path.search(loc) for deny_path in self.deny):
+                    continue
+                elif loc not in already_indexed_links:
+                    new_links.append(loc)
+                elif lastmod and already_indexed_links[loc] and lastmod > already_indexed_links[loc] and loc not in not_changed_links:
+                    changed_links.append(loc)
+        except etree.XMLSyntaxError as e:
+            logger.warning('Unable to parse sitemap {}: {}'.format(response.url, e))
+        self.site_config['indexing_page_limit'] += len(changed_links)
+        new_links = sorted(new_links, key=lambda link: self.get_request_priority(link, 1), reverse=True)[:self.site_config['indexing_page_limit'] * max_frontier_factor]
+        logger.info('Sitemap {}: {} changed links, {} new links, {} sitemaps'.format(response.url, len(changed_links), len(new_links), len(sitemaps)))
+        for link in changed_links:
+            yield Request(link, callback=self.parse_item, priority=self.get_request_priority(link, 1) + changed_link_priority)
+        for link in new_links:
+            yield Request(link, callback=self.parse_item, priority=self.get_request_priority(link, 1))
+        for sitemap in sitemaps:
+            if self.sitemaps_requested < max_sitemaps:
+                yield self.get_sitemap_request(sitemap)
 
     # remove_already_indexed_links is called by process_links in the LinkExtractor Rule
     # This means it is called for every HtmlResponse, but not for any XmlResponse.
@@ -187,3 +299,32 @@ class SearchMySiteSpider(CrawlSpider):
             for link in links:
                 if link.url not in self.site_config['already_indexed_links']:
                     yield link
+
+    # Get the priority of a request in the crawl frontier (see feed_link_priority etc. above), where depth is the number of links from the start urls
+    def get_request_priority(self, url, depth):
+        priority = depth * depth_priority
+        if url in self.site_config['feed_links']:
+            priority += feed_link_priority
+        priority += min(len(self.site_config['indexed_inlinks'].get(url, [])), max_inlinks) * inlink_priority
+        split_url = urlsplit(url)
+        if low_value_url_path.search(split_url.path):
+            priority += low_value_priority
+        if split_url.query:
+            priority += query_string_priority
+        return priority
+
+    # set_request_priority is called by process_request in the LinkExtractor Rule, for every link extracted from every HtmlResponse
+    # It sets the priority of the request, and drops the request (by returning None) if the indexing_page_limit has already been
+    # reached, or if the frontier is already large enough to fill the indexing_page_limit and the request isn't a high priority one
+    def set_request_priority(self, request, response):
+        indexing_page_limit = self.site_config['indexing_page_limit']
+        if self.crawler.stats.get_value('item_scraped_count', 0) >= indexing_page_limit:
+            self.crawler.stats.inc_value('frontier/dropped_limit_reached')
+            return None
+        request.priority = self.get_request_priority(request.url, response.meta.get('depth', 0) + 1)
+        if request.url not in self.frontier_urls:
+            if len(self.frontier_urls) >= indexing_page_limit * max_frontier_factor and request.priority <= 0:
+                self.crawler.stats.inc_value('frontier/dropped_low_priority')
+                return None
+            self.frontier_urls.add(request.url)
+        return request
@@ -1,45 +1,63 @@
 import scrapy
-from scrapy.crawler import CrawlerRunner
+from scrapy.crawler import Crawler, CrawlerRunner
 from scrapy.utils.log import configure_logging
 from scrapy.utils.project import get_project_settings
 from scrapy.utils.reactor import install_reactor
 import logging
+import os
+import sys
+import shutil
+import socket
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
 from indexer.spiders.search_my_site_spider import SearchMySiteSpider
-from common.utils import update_indexing_status, get_all_domains, get_domains_allowing_subdomains, get_all_indexed_inlinks_for_domain, get_already_indexed_links, get_contents, check_for_stuck_jobs, expire_listings
+from indexer.pipelines import crawl_state_file
+from common.utils import update_indexing_status, get_all_domains, get_domains_allowing_subdomains, get_already_indexed_links, get_contents, check_for_stuck_jobs, expire_listings, maintain_indexing_log_partitions, solr_commit, get_solr_commit_stats
+from common.linkgraph import get_indexed_inlinks_for_domain
+from common.domainrank import update_domain_ranks
+from common.searchwarming import update_warming_queries
 
 
 # As per https://docs.scrapy.org/en/latest/topics/practices.html
 # This runs the SearchMySiteSpider directly rather than via 'scrapy crawl' at the command line
 # CrawlerProcess will start a Twisted reactor for you
 # CrawlerRunner "provides more control over the crawling process" but
-# "the reactor should be explicitly run after scheduling your spiders" and 
+# "the reactor should be explicitly run after scheduling your spiders" and
 # "you will also have to shutdown the Twisted reactor yourself after the spider is finished"
+#
+# There are two ways of running the scheduler:
+# 1. python search_my_site_scheduler.py
+#    Run the maintenance jobs, index the sites which are due for indexing, and exit when the indexing has completed.
+#    This is useful for triggering indexing manually, e.g. from the tests.
+# 2. python search_my_site_scheduler.py --listen
+#    Keep running, indexing sites as they become due. This is what is run from run.sh.
+#    Sites which need indexing straight away, i.e. newly approved sites and user triggered reindexes, are notified by the web app
+#    via a NOTIFY on the indexing_pending channel. These are started as soon as the notification is received in a "fast lane",
+#    i.e. in INDEXING_FAST_LANE_SITES slots which are reserved for them, so they don't have to wait behind the scheduled reindexing.
+#    Sites which are due for scheduled reindexing are checked for every SCHEDULER_POLL_INTERVAL seconds (and as soon as a
+#    scheduled index completes if there may be more sites waiting), and indexed in up to INDEXING_MAX_SITES slots.
+#    The poll is also the fallback for notifications which are missed, e.g. if the indexer was restarting when they were sent.
 
 settings = get_project_settings()
 configure_logging(settings) # Need to pass in settings to pick up LOG_LEVEL, otherwise it will stay at DEBUG irrespective of LOG_LEVEL in settings.py
 logger = logging.getLogger()
 
 # Initialise variables
-# - sites_to_crawl and common_config are the two values passed into SearchMySiteSpider
-# - sites_to_crawl is a list of dicts, where each dict in the list corresponds to a site which needs to be crawled,
+# - site_config and common_config are the two values passed into SearchMySiteSpider
+# - site_config is a dict for a site which needs to be crawled (one of the sites_to_crawl),
 #   and the dict contains all the information about the site which could be needed at index time, e.g.
 #   - site['site_category']
 #   - site['web_feed']
+#   - site['sitemap']
 #   - site['exclusions'] (a list of dicts)
-#   - site['indexed_inlinks'] (from Solr)
+#   - site['indexed_inlinks'] (from the link graph in the database)
 #   - site['content'] (from Solr)
-#   - site['already_indexed_links'] (from Solr, only set for incremental indexes)
+#   - site['already_indexed_links'] (from Solr, only set for incremental indexes, a dict of url to the date it was last indexed)
+#   - site['indexed_home_pages'] (from Solr, only set for incremental indexes, a set of the urls indexed as the home page)
 # - common_config is a dict with settings which apply to all sites, i.e.
 #   - common_config['domains_for_indexed_links']
 #   - common_config['domains_allowing_subdomains']
- 
-sites_to_crawl = []
-# Just lookup domains_for_indexed_links and domains_allowing_subdomains once
-domains_for_indexed_links = get_all_domains()
-domains_allowing_subdomains = get_domains_allowing_subdomains()
-common_config = {}
 
 logger.debug('BOT_NAME: {} (indexer if custom settings are loaded okay, scrapybot if not)'.format(settings.get('BOT_NAME')))
 
@@ -50,83 +68,146 @@ db_password = settings.get('DB_PASSWORD')
 
 sql_select_filters = "SELECT * FROM tblIndexingFilters WHERE domain = (%s);"
 
-# This returns sites which are due for reindexing, either due to being new ('PENDING'), 
-# or having the last full index completed more than full_reindex_frequency ago, or
-# having the last index of any type (full or incremental) completed more than incremental_reindex_frequency ago.
+# This claims sites which are due for reindexing, either due to being new ('PENDING'),
+# or having passed next_due_at, i.e. having the last full index completed more than full_reindex_frequency ago, or
+# having the last index of any type (full or incremental) completed more than incremental_reindex_frequency ago, or
+# having been claimed by a worker whose lease has expired (e.g. because the worker crashed).
+# next_due_at and next_due_full are set when each index completes (see update_indexing_status), so finding the sites which are due
+# is a range scan on the partial indexes on next_due_at and indexing_status rather than a calculation for every domain.
 # Must also have indexing_type = 'spider/default' and indexing_enabled = TRUE.
+# If a domain is specified (i.e. for the fast lane) only that domain can be claimed, otherwise any domain which is due.
 # Only LIMIT results are returned to reduce the chance of memory issues in the indexing container.
-# The list is sorted so new ('PENDING') are first, followed by higher tiers,
+# The list is sorted so those with expired leases and new ('PENDING') are first, followed by higher tiers,
 # so these are prioritised in cases where not all sites are returned due to the LIMIT.
 # The CASE statement sets a column full_index to be TRUE when a full index is required
-# and FALSE when an incremental index is required. In cases where both a full and 
-# incremental index are due to be triggered the full index will come first.
-sql_select_domains_to_index = "SELECT d.domain, d.home_page, l.tier, d.domain_first_submitted, d.indexing_page_limit, d.content_chunks_limit, d.category, d.api_enabled, d.include_in_public_search, d.web_feed_auto_discovered, d.web_feed_user_entered, "\
-    "    CASE "\
-    "        WHEN d.indexing_status = 'PENDING' THEN TRUE "\
-    "        WHEN NOW() - d.last_full_index_completed > d.full_reindex_frequency THEN TRUE "\
-    "        WHEN NOW() - d.last_index_completed > d.incremental_reindex_frequency THEN FALSE "\
-    "    END AS full_index "\
-    "FROM tblDomains d INNER JOIN tblListingStatus l ON d.domain = l.domain "\
-    "WHERE d.indexing_type = 'spider/default' "\
-    "AND d.indexing_enabled = TRUE "\
-    "AND l.status = 'ACTIVE' "\
-    "AND ( "\
-    "    (d.indexing_status = 'PENDING') "\
-    "    OR (d.indexing_status = 'COMPLETE' AND NOW() - last_full_index_completed > full_reindex_frequency) "\
-    "    OR (d.indexing_status = 'COMPLETE' AND NOW() - last_index_completed > incremental_reindex_frequency) "\
+# and FALSE when an incremental index is required. In cases where both a full and
+# incremental index are due to be triggered the full index will come first, which includes
+# an incremental index which was due first but wasn't claimed until after the full index also became due.
+# Sites with an expired lease are given a full index because the index which failed may have been a full index.
+# The sites are claimed in the same statement, i.e. set to RUNNING with this worker's id and a lease expiry, with
+# FOR UPDATE SKIP LOCKED so that if several indexer processes (e.g. in several containers) claim sites at the same time
+# they each get different sites rather than waiting for each other or indexing the same sites.
+# The lease is extended periodically (see renew_leases) while the indexing is in progress, and cleared when it completes.
+sql_claim_domains_to_index = "WITH due AS ( "\
+    "    SELECT d.domain, l.tier, "\
+    "        CASE "\
+    "            WHEN d.indexing_status = 'RUNNING' THEN TRUE "\
+    "            WHEN d.indexing_status = 'PENDING' THEN TRUE "\
+    "            WHEN d.next_due_full = TRUE THEN TRUE "\
+    "            WHEN NOW() - d.last_full_index_completed > d.full_reindex_frequency THEN TRUE "\
+    "            ELSE FALSE "\
+    "        END AS full_index "\
+    "    FROM tblDomains d INNER JOIN tblListingStatus l ON d.domain = l.domain "\
+    "    WHERE d.indexing_type = 'spider/default' "\
+    "    AND d.indexing_enabled = TRUE "\
+    "    AND l.status = 'ACTIVE' "\
+    "    AND ((%s)::text IS NULL OR d.domain = (%s)) "\
+    "    AND NOT (d.domain = ANY(%s)) "\
+    "    AND ( "\
+    "        (d.indexing_status = 'PENDING') "\
+    "        OR (d.indexing_status = 'COMPLETE' AND d.next_due_at <= NOW()) "\
+    "        OR (d.indexing_status = 'RUNNING' AND d.indexing_lease_expiry < NOW()) "\
+    "    ) "\
+    "    ORDER BY d.indexing_status DESC, l.tier DESC "\
+    "    LIMIT (%s) "\
+    "    FOR UPDATE OF d SKIP LOCKED "\
+    "), claimed AS ( "\
+    "    UPDATE tblDomains d "\
+    "    SET indexing_status = 'RUNNING', indexing_status_changed = NOW(), indexing_worker = (%s), indexing_lease_expiry = NOW() + (%s) * INTERVAL '1 second' "\
+    "    FROM due WHERE d.domain = due.domain "\
+    "    RETURNING d.domain, d.home_page, due.tier, d.domain_first_submitted, d.indexing_page_limit, d.content_chunks_limit, d.category, d.api_enabled, d.include_in_public_search, d.web_feed_auto_discovered, d.web_feed_user_entered, d.sitemap_auto_discovered, d.sitemap_user_entered, d.domain_rank, due.full_index "\
+    "), logged AS ( "\
+    "    INSERT INTO tblIndexingLog (domain, status, timestamp, message) SELECT domain, 'RUNNING', NOW(), '' FROM claimed "\
     ") "\
-    "ORDER BY d.indexing_status DESC, l.tier DESC "\
-    "LIMIT 8;"
+    "SELECT * FROM claimed;"
+
+# Extend the lease on the sites this worker is indexing, for those which are still RUNNING
+sql_renew_leases = "UPDATE tblDomains SET indexing_lease_expiry = NOW() + (%s) * INTERVAL '1 second' "\
+    "WHERE domain = ANY(%s) AND indexing_worker = (%s) AND indexing_status = 'RUNNING';"
+
+# The web app sends a NOTIFY on this channel, with the domain as the payload, when a site needs indexing straight away
+sql_listen_indexing_pending = "LISTEN indexing_pending;"
+
+# The worker id identifies this process in tblDomains.indexing_worker, so the hostname (i.e. container) and process id
+worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+lease_duration = settings.getint('INDEXING_LEASE_DURATION')
+max_sites = settings.getint('INDEXING_MAX_SITES')
+fast_lane_sites = settings.getint('INDEXING_FAST_LANE_SITES')
+poll_interval = settings.getint('SCHEDULER_POLL_INTERVAL')
+notify_check_interval = settings.getfloat('SCHEDULER_NOTIFY_CHECK_INTERVAL')
+domain_rank_interval = settings.getint('SCHEDULER_DOMAIN_RANK_INTERVAL')
+search_warming_interval = settings.getint('SCHEDULER_SEARCH_WARMING_INTERVAL')
+solr_stats_interval = settings.getint('SCHEDULER_SOLR_STATS_INTERVAL')
+
+# This is the heartbeat, so it catches all exceptions, because an exception would stop the LoopingCall which runs it,
+# and then the leases would expire and the sites could be claimed and indexed again by another indexer process
+def renew_leases(domains):
+    conn = None
+    try:
+        conn = psycopg2.connect(dbname=db_name, user=db_user, host=db_host, password=db_password)
+        cursor = conn.cursor()
+        cursor.execute(sql_renew_leases, (lease_duration, domains, worker_id))
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error('renew_leases: {}'.format(e))
+    except Exception as e:
+        logger.exception('renew_leases: {}'.format(e))
+    finally:
+        if conn: conn.close()
 
 
 # MAINTENANCE JOBS
 # These could be in a separately scheduled job, which could be run less frequently, but is just here for now to save having to setup another job
-check_for_stuck_jobs()
-for tier in range(1, 4):
-    expire_listings(tier) # i.e. expire any tier 1 listings that are due for expiry, then tier 2, then tier 3
+
+def run_maintenance_jobs():
+    check_for_stuck_jobs()
+    maintain_indexing_log_partitions(settings.getint('INDEXING_LOG_RETENTION_MONTHS'))
+    for tier in range(1, 4):
+        expire_listings(tier) # i.e. expire any tier 1 listings that are due for expiry, then tier 2, then tier 3
 
 
 # MAIN INDEXING JOB
-# Read data from database (sites_to_crawl, domains_for_indexed_links, exclusion for each sites_to_crawl)
-
-logger.info('Checking for sites to index')
-
-logger.debug('Reading from database {}'.format(db_name))
-try:
-    conn = psycopg2.connect(dbname=db_name, user=db_user, host=db_host, password=db_password)
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    # sites_to_crawl is the config specific to each site
-    cursor.execute(sql_select_domains_to_index)
-    results = cursor.fetchall()
-    for result in results:
-        # Mark as RUNNING ASAP so if there's another indexer container running it is less likely to double-index 
-        # There's a risk something will fail before it gets to the actual indexing, hence the periodic check for stuck RUNNING jobs
-        update_indexing_status(result['domain'], None, 'RUNNING' , "")
-        site = {}
-        site['domain'] = result['domain']
-        site['home_page'] = result['home_page']
-        site['tier'] = result['tier']
-        site['date_domain_added'] = result['domain_first_submitted']
-        site['indexing_page_limit'] = result['indexing_page_limit']
-        site['content_chunks_limit'] = result['content_chunks_limit']
-        if result['tier'] == 3: site['owner_verified'] = True
-        else: site['owner_verified'] = False
-        site['site_category'] = result['category']
-        site['api_enabled'] = result['api_enabled']
-        site['include_in_public_search'] = result['include_in_public_search']
-        # Use web_feed_user_entered if there is one, otherwise use web_feed_auto_discovered
-        if result['web_feed_user_entered']: 
-            site['web_feed'] = result['web_feed_user_entered']
-        elif result['web_feed_auto_discovered']:
-            site['web_feed'] = result['web_feed_auto_discovered']
-        site['full_index'] = result['full_index']
-        sites_to_crawl.append(site)
-    # common_config is the config shared between all sites
-    if sites_to_crawl:
-        # domains_for_indexed_links
-        common_config['domains_for_indexed_links'] = domains_for_indexed_links
-        # domains allowing subdomains
-        common_config['domains_allowing_subdomains'] = domains_allowing_subdomains
+
+# Read data from database (sites_to_crawl, and exclusions for each sites_to_crawl)
+# Claims up to limit sites which are due for indexing, or just the specified domain if it is due
+# exclude_domains is the domains this process is already indexing, which mustn't be claimed again even if their lease has expired
+def claim_sites_to_crawl(limit, domain=None, exclude_domains=[]):
+    sites_to_crawl = []
+    logger.debug('Reading from database {}'.format(db_name))
+    try:
+        conn = psycopg2.connect(dbname=db_name, user=db_user, host=db_host, password=db_password)
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        # sites_to_crawl is the config specific to each site
+        # The sites are claimed (i.e. marked as RUNNING) as they are selected, and committed immediately so other indexer processes can see they are claimed
+        cursor.execute(sql_claim_domains_to_index, (domain, domain, list(exclude_domains), limit, worker_id, lease_duration))
+        results = cursor.fetchall()
+        conn.commit()
+        for result in results:
+            site = {}
+            site['domain'] = result['domain']
+            site['home_page'] = result['home_page']
+            site['tier'] = result['tier']
+            site['date_domain_added'] = result['domain_first_submitted']
+            site['indexing_page_limit'] = result['indexing_page_limit']
+            site['content_chunks_limit'] = result['content_chunks_limit']
+            if result['tier'] == 3: site['owner_verified'] = True
+            else: site['owner_verified'] = False
+            site['site_category'] = result['category']
+            site['domain_rank'] = result['domain_rank']
+            site['api_enabled'] = result['api_enabled']
+            site['include_in_public_search'] = result['include_in_public_search']
+            # Use web_feed_user_entered if there is one, otherwise use web_feed_auto_discovered
+            if result['web_feed_user_entered']:
+                site['web_feed'] = result['web_feed_user_entered']
+            elif result['web_feed_auto_discovered']:
+                site['web_feed'] = result['web_feed_auto_discovered']
+            # Similarly for the sitemap, which is used for incremental indexes
+            if result['sitemap_user_entered']:
+                site['sitemap'] = result['sitemap_user_entered']
+            elif result['sitemap_auto_discovered']:
+                site['sitemap'] = result['sitemap_auto_discovered']
+            site['full_index'] = result['full_index']
+            sites_to_crawl.append(site)
         # exclusions for domains
         for site_to_crawl in sites_to_crawl:
             cursor.execute(sql_select_filters, (site_to_crawl['domain'],))
@@ -139,49 +220,87 @@ try:
                     exclusion['exclusion_value'] = f['value']
                     exclusions.append(exclusion)
             site_to_crawl['exclusions'] = exclusions
-except psycopg2.Error as e:
-    logger.error(' %s' % e.pgerror)
-finally:
-    conn.close()
-
-if sites_to_crawl: logger.info('sites_to_crawl: {}'.format(sites_to_crawl))
+    except psycopg2.Error as e:
+        logger.error('claim_sites_to_crawl: {}'.format(e.pgerror))
+    finally:
+        conn.close()
+    return sites_to_crawl
 
-# Read data from Solr (indexed_inlinks, content and if necessary already_indexed_links)
-
-sites_to_remove = []
-for site_to_crawl in sites_to_crawl:
+# Read data from the link graph (indexed_inlinks) and Solr (content and if necessary already_indexed_links)
+# Returns False if the site doesn't need to be crawled after all
+def prepare_site_to_crawl(site_to_crawl):
     domain = site_to_crawl['domain']
     full_index = site_to_crawl['full_index']
     indexing_page_limit = site_to_crawl['indexing_page_limit']
     # indexed_inlinks, i.e. pages (from other domains within this search index) which link to this domain.
-    indexed_inlinks = get_all_indexed_inlinks_for_domain(domain)
+    indexed_inlinks = get_indexed_inlinks_for_domain(domain)
     logger.debug('indexed_inlinks: {}'.format(indexed_inlinks))
     site_to_crawl['indexed_inlinks'] = indexed_inlinks
     # content, i.e. get_contents(domain)
     contents = get_contents(domain)
     #logger.debug('contents: {}'.format(contents))
     site_to_crawl['contents'] = contents
+    # crawl state, i.e. for a full index remove any previous crawl state for the domain unless it is from a full index which timed out
+    if full_index == True:
+        remove_stale_crawl_state(domain)
     # already_indexed_links, i.e. pages on this domain which have already been indexed.
     # This is only set if it is needed, i.e. for an incremental index.
     if full_index == False:
-        already_indexed_links = get_already_indexed_links(domain)
+        already_indexed_links, indexed_home_pages = get_already_indexed_links(domain)
         no_of_already_indexed_links = len(already_indexed_links)
-        if no_of_already_indexed_links >= indexing_page_limit:
+        if no_of_already_indexed_links >= indexing_page_limit and 'sitemap' not in site_to_crawl:
             # if the indexing_page_limit was reached in the last index then remove this site from the sites to crawl
+            # unless it has a sitemap, because the pages in the sitemap which have changed can still be reindexed (see parse_sitemap in the spider)
             # update the status in the database so that it isn't selected again until the next scheduled full or incremental reindex
-            sites_to_remove.append(domain)
             message = 'The indexing page limit was reached on the last index, so not going to perform incremental reindex for {}'.format(domain)
             update_indexing_status(domain, full_index, 'COMPLETE' , message)
             logger.warning(message)
+            return False
         else:
             # reduce the indexing_page_limit according to the number of pages already in the index
             # so the incremental reindex doesn't exceed the indexing_page_limit
-            new_indexing_page_limit = indexing_page_limit - no_of_already_indexed_links
+            # The spider increases the indexing_page_limit by the number of changed pages it finds in the sitemap, because they replace existing pages
+            new_indexing_page_limit = max(indexing_page_limit - no_of_already_indexed_links, 0)
             site_to_crawl['indexing_page_limit'] = new_indexing_page_limit
             logger.info('no_of_already_indexed_links: {}, indexing_page_limit: {}, new_indexing_page_limit: {}, for {}'.format(no_of_already_indexed_links, indexing_page_limit, new_indexing_page_limit, domain))
             site_to_crawl['already_indexed_links'] = already_indexed_links
+            site_to_crawl['indexed_home_pages'] = indexed_home_pages
+    return True
+
+# Full indexes are run with a JOBDIR for the domain in CRAWL_STATE_DIR, so that if they time out they can be resumed (see the notes in pipelines.py)
+def get_crawl_state_dir(domain):
+    return os.path.join(settings.get('CRAWL_STATE_DIR'), domain)
+
+# The crawl state is only resumed if the pipeline saved the items when the previous full index timed out. Otherwise, e.g. if the
+# previous full index completed or the indexer was stopped part way through, the crawl state is removed so the full index starts afresh.
+def remove_stale_crawl_state(domain):
+    crawl_state_dir = get_crawl_state_dir(domain)
+    if os.path.isdir(crawl_state_dir) and not os.path.exists(os.path.join(crawl_state_dir, crawl_state_file)):
+        logger.debug('Removing the crawl state for {}'.format(domain))
+        shutil.rmtree(crawl_state_dir, ignore_errors=True)
+
+def get_crawler(site_to_crawl):
+    if site_to_crawl['full_index'] != True:
+        return SearchMySiteSpider
+    crawler_settings = settings.copy()
+    crawler_settings.set('JOBDIR', get_crawl_state_dir(site_to_crawl['domain']))
+    return Crawler(SearchMySiteSpider, crawler_settings)
+
+# Claim and prepare the sites to crawl
+# This does blocking database and Solr reads, so is run in a thread when the reactor is running
+def get_sites_to_crawl(limit, domain=None, exclude_domains=[]):
+    sites_to_crawl = claim_sites_to_crawl(limit, domain, exclude_domains)
+    if sites_to_crawl: logger.info('sites_to_crawl: {}'.format(sites_to_crawl))
+    return [site_to_crawl for site_to_crawl in sites_to_crawl if prepare_site_to_crawl(site_to_crawl)]
+
+# common_config is the config shared between all sites
+# Each crawl gets its own copy of domains_for_indexed_links because the spider removes its own domain from the list
+def get_common_config(domains_for_indexed_links, domains_allowing_subdomains):
+    common_config = {}
+    common_config['domains_for_indexed_links'] = list(domains_for_indexed_links)
+    common_config['domains_allowing_subdomains'] = domains_allowing_subdomains
+    return common_config
 
-sites_to_crawl = [site_to_crawl for site_to_crawl in sites_to_crawl if site_to_crawl['domain'] not in sites_to_remove]
 
 # Run the crawler
 # Note that from Scrapy 2.13.0 you need to
@@ -190,18 +309,185 @@ sites_to_crawl = [site_to_crawl for site_to_crawl in sites_to_crawl if site_to_c
 # twisted.internet.reactor import installs the default Twisted reactor as a side effect and once a Twisted reactor is installed it is not possible to switch to a different reactor at run time
 # (see https://docs.scrapy.org/en/latest/topics/asyncio.html#handling-a-pre-installed-reactor)
 
-if sites_to_crawl:
-    install_reactor(settings.get('TWISTED_REACTOR')) 
-    runner = CrawlerRunner(settings)
-    for site_to_crawl in sites_to_crawl:
-        runner.crawl(SearchMySiteSpider, 
-        site_config=site_to_crawl, common_config=common_config 
-        )
+# Index the sites which are currently due, and exit when the indexing has completed
+def run_once():
+    run_maintenance_jobs()
+    logger.info('Checking for sites to index')
+    # Just lookup domains_for_indexed_links and domains_allowing_subdomains once
+    domains_for_indexed_links = get_all_domains()
+    domains_allowing_subdomains = get_domains_allowing_subdomains()
+    sites_to_crawl = get_sites_to_crawl(max_sites)
+    if sites_to_crawl:
+        install_reactor(settings.get('TWISTED_REACTOR'))
+        runner = CrawlerRunner(settings)
+        for site_to_crawl in sites_to_crawl:
+            runner.crawl(get_crawler(site_to_crawl),
+            site_config=site_to_crawl, common_config=get_common_config(domains_for_indexed_links, domains_allowing_subdomains)
+            )
+        from twisted.internet import reactor
+        from twisted.internet.task import LoopingCall
+        from twisted.internet.threads import deferToThread
+        # Heartbeat, to extend the lease on the sites being indexed so they aren't claimed by another indexer process
+        heartbeat = LoopingCall(lambda: deferToThread(renew_leases, [site_to_crawl['domain'] for site_to_crawl in sites_to_crawl]))
+        heartbeat.start(settings.getint('INDEXING_HEARTBEAT_INTERVAL'), now=False)
+        d = runner.join()
+        d.addBoth(lambda _: heartbeat.stop())
+        d.addBoth(lambda _: reactor.stop())
+
+        # Actually run the indexing
+        logger.info('Starting indexing')
+        reactor.run()
+        logger.info('Completed indexing')
+        # One commit for all the sites, so the results can be searched straight away rather than after the coordinated commit
+        solr_commit()
+
+# Log the Solr commit counts and searcher warm up times, to check the commits are being coordinated,
+# i.e. softAutoCommits should go up by at most one per SOLR_COMMIT_WITHIN, and commits should hardly go up at all
+def log_solr_commit_stats():
+    logger.info('Solr commit stats: {}'.format(get_solr_commit_stats()))
+
+# Wrap a job which is run regularly by a LoopingCall so that any exception it raises is logged rather than stopping the LoopingCall,
+# which is what happens if the function called by a LoopingCall raises an exception or returns a Deferred which fails
+def log_exceptions(job):
+    def run_job(*args, **kwargs):
+        try:
+            result = job(*args, **kwargs)
+        except Exception:
+            logger.exception('{} failed'.format(job.__name__))
+            return None
+        if hasattr(result, 'addErrback'): # i.e. a Deferred
+            result.addErrback(lambda failure: logger.error('{} failed: {}'.format(job.__name__, failure.getTraceback())))
+        return result
+    return run_job
+
+# Keep running, starting crawls as sites become due or are notified, until the process is stopped
+# - running_sites is the domains currently being crawled in each lane, and claiming the number of slots reserved for claims in progress
+# - notified_domains is the domains which have been notified but not yet started, e.g. because all the fast lane slots are in use
+# The state is only changed from the reactor thread, with the blocking database and Solr reads run in threads via deferToThread.
+def run_listening():
+    install_reactor(settings.get('TWISTED_REACTOR'))
     from twisted.internet import reactor
-    d = runner.join()
-    d.addBoth(lambda _: reactor.stop())
+    from twisted.internet.task import LoopingCall
+    from twisted.internet.threads import deferToThread
+
+    runner = CrawlerRunner(settings)
+    lane_sites = {'scheduled': max_sites, 'fast': fast_lane_sites}
+    running_sites = {'scheduled': set(), 'fast': set()}
+    claiming = {'scheduled': 0, 'fast': 0}
+    notified_domains = []
+    state = {'polling': False, 'poll_again': False, 'listen_conn': None}
+    common_lookups = {'domains_for_indexed_links': get_all_domains(), 'domains_allowing_subdomains': get_domains_allowing_subdomains()}
+
+    def free_slots(lane):
+        return lane_sites[lane] - len(running_sites[lane]) - claiming[lane]
+
+    def start_crawls(sites_to_crawl, lane):
+        for site_to_crawl in sites_to_crawl:
+            domain = site_to_crawl['domain']
+            running_sites[lane].add(domain)
+            logger.info('Starting indexing for {} ({} lane)'.format(domain, lane))
+            d = runner.crawl(get_crawler(site_to_crawl),
+                site_config=site_to_crawl, common_config=get_common_config(common_lookups['domains_for_indexed_links'], common_lookups['domains_allowing_subdomains'])
+            )
+            d.addErrback(lambda failure, domain=domain: logger.error('Indexing failed for {}: {}'.format(domain, failure.getErrorMessage())))
+            d.addBoth(crawl_finished, domain, lane)
+
+    def crawl_finished(_, domain, lane):
+        running_sites[lane].discard(domain)
+        logger.info('Completed indexing for {} ({} lane)'.format(domain, lane))
+        if lane == 'fast':
+            start_notified()
+        elif state['poll_again']:
+            poll()
+
+    # Scheduled lane
+    def poll():
+        if state['polling']: return
+        state['polling'] = True
+        limit = free_slots('scheduled')
+        claiming['scheduled'] += limit
+        d = deferToThread(poll_in_thread, limit, running_sites['scheduled'] | running_sites['fast'])
+        d.addBoth(poll_finished, limit)
+        d.addCallback(poll_complete, limit)
+        d.addErrback(lambda failure: logger.error('poll: {}'.format(failure.getErrorMessage())))
+
+    def poll_in_thread(limit, exclude_domains):
+        run_maintenance_jobs()
+        common_lookups['domains_for_indexed_links'] = get_all_domains()
+        common_lookups['domains_allowing_subdomains'] = get_domains_allowing_subdomains()
+        if limit <= 0: return []
+        logger.info('Checking for sites to index')
+        return get_sites_to_crawl(limit, exclude_domains=exclude_domains)
 
-    # Actually run the indexing
-    logger.info('Starting indexing')
+    def poll_finished(result, limit):
+        claiming['scheduled'] -= limit
+        state['polling'] = False
+        return result
+
+    def poll_complete(sites_to_crawl, limit):
+        start_crawls(sites_to_crawl, 'scheduled')
+        # If all the free slots were filled there may be more sites waiting, so check again as soon as a scheduled index completes
+        state['poll_again'] = limit > 0 and len(sites_to_crawl) == limit
+
+    # Fast lane
+    def start_notified():
+        while notified_domains and free_slots('fast') > 0:
+            domain = notified_domains.pop(0)
+            if domain in running_sites['fast'] or domain in running_sites['scheduled']: continue
+            claiming['fast'] += 1
+            d = deferToThread(get_sites_to_crawl, 1, domain)
+            d.addBoth(fast_lane_claimed)
+            d.addCallback(start_crawls, 'fast')
+            d.addErrback(lambda failure: logger.error('start_notified: {}'.format(failure.getErrorMessage())))
+
+    def fast_lane_claimed(result):
+        claiming['fast'] -= 1
+        return result
+
+    def check_notifications():
+        try:
+            if state['listen_conn'] is None:
+                conn = psycopg2.connect(dbname=db_name, user=db_user, host=db_host, password=db_password)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(sql_listen_indexing_pending)
+                state['listen_conn'] = conn
+                logger.info('Listening for indexing_pending notifications')
+            conn = state['listen_conn']
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                logger.info('Received indexing_pending notification for {}'.format(notify.payload))
+                if notify.payload not in notified_domains:
+                    notified_domains.append(notify.payload)
+        except Exception as e:
+            # Reconnect next time, and poll in case any notifications were missed while disconnected
+            # (catching all exceptions rather than just psycopg2.Error so the LoopingCall keeps running)
+            logger.error('check_notifications: {}'.format(e))
+            state['listen_conn'] = None
+            poll()
+            return
+        start_notified()
+
+    # Heartbeat, to extend the lease on the sites being indexed so they aren't claimed by another indexer process
+    def renew_running_leases():
+        domains = list(running_sites['scheduled'] | running_sites['fast'])
+        if domains: return deferToThread(renew_leases, domains)
+
+    # The jobs are wrapped in log_exceptions because an exception (or failed Deferred) would stop the LoopingCall permanently
+    LoopingCall(log_exceptions(check_notifications)).start(notify_check_interval)
+    LoopingCall(log_exceptions(poll)).start(poll_interval)
+    LoopingCall(log_exceptions(renew_running_leases)).start(settings.getint('INDEXING_HEARTBEAT_INTERVAL'), now=False)
+    LoopingCall(deferToThread, log_exceptions(update_domain_ranks)).start(domain_rank_interval, now=False)
+    LoopingCall(deferToThread, log_exceptions(update_warming_queries)).start(search_warming_interval, now=False)
+    LoopingCall(deferToThread, log_exceptions(log_solr_commit_stats)).start(solr_stats_interval, now=False)
+
+    logger.info('Starting scheduler with {} scheduled and {} fast lane slots'.format(max_sites, fast_lane_sites))
     reactor.run()
-    logger.info('Completed indexing')
+    logger.info('Stopped scheduler')
+
+
+if __name__ == '__main__':
+    if '--listen' in sys.argv[1:]:
+        run_listening()
+    else:
+        run_once()
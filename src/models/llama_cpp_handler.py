@@ -5,10 +5,17 @@ from abc import ABC
 import torch
 from llama_cpp import Llama
 
+from ts.handler_utils.utils import send_intermediate_predict_response
 from ts.torch_handler.base_handler import BaseHandler
 
 logger = logging.getLogger(__name__)
 
+# The prompt templates start with a fixed system prompt, so the model state after evaluating
+# that prefix is cached and restored for each request, meaning only the tokens after the prefix
+# (i.e. the context and question) need to be evaluated. There are only a handful of templates,
+# but the number of cached states is capped because each state includes the KV cache.
+MAX_CACHED_PREFIX_STATES = 4
+
 
 class LlamaCppHandler(BaseHandler, ABC):
     def __init__(self):
@@ -42,21 +49,56 @@ class LlamaCppHandler(BaseHandler, ABC):
         torch.set_num_threads(1)
 
         self.model = Llama(model_path=model_path)
+        self.prefix_states = {}
 
     def preprocess(self, data):
         for row in data:
             item = row.get("body")
             return item
 
+    def load_prefix_state(self, prompt_prefix):
+        """Restore the model state for a prompt prefix, evaluating and caching it if required.
+        create_completion then only evaluates the tokens which follow the longest matching prefix
+        of the tokens already in the context.
+        """
+        state = self.prefix_states.get(prompt_prefix)
+        if state is None:
+            tokens = self.model.tokenize(prompt_prefix.encode("utf-8"), special=True)
+            self.model.reset()
+            self.model.eval(tokens)
+            state = self.model.save_state()
+            if len(self.prefix_states) < MAX_CACHED_PREFIX_STATES:
+                self.prefix_states[prompt_prefix] = state
+            logger.info("Evaluated prompt prefix of {} tokens".format(len(tokens)))
+        else:
+            self.model.load_state(state)
+
     def inference(self, data):
+        prompt = data["prompt"]
+        prompt_prefix = data.get("prompt_prefix")
+        if prompt_prefix and prompt.startswith(prompt_prefix):
+            self.load_prefix_state(prompt_prefix)
+        # echo=False so only the generated text is returned rather than the prompt and the generated text
         result = self.model.create_completion(
-            data["prompt"],
+            prompt,
             max_tokens=data["max_tokens"],
             top_p=data["top_p"],
             temperature=data["temperature"],
             stop=["Q:", "\n"],
-            echo=True,
+            echo=False,
+            stream=data.get("stream", False),
         )
+        if data.get("stream", False):
+            # Send each part of the text as it is generated, with the final (empty) part returned as normal
+            for output in result:
+                send_intermediate_predict_response(
+                    [output["choices"][0]["text"]],
+                    self.context.request_ids,
+                    "Intermediate Prediction success",
+                    200,
+                    self.context,
+                )
+            result = {"choices": [{"text": ""}]}
         return result
 
     def postprocess(self, output):
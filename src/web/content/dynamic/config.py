@@ -6,6 +6,44 @@ DB_USER = 'postgres'
 DB_HOST = 'db'
 TORCHSERVE = 'http://models:8080/'
 EMBEDDING_MODEL = 'BAAI/bge-small-en-v1.5'
+# The content chunks are nested child docs of the pages in the content core by default. If the indexer is configured to keep them
+# in the chunks core instead, this should be set to the same as CONTENT_CHUNKS_SOLR_URL in the indexer's settings.py
+CONTENT_CHUNKS_SOLR_URL = None # e.g. 'http://search:8983/solr/chunks/'
+# How the embeddings are stored, i.e. 'FLOAT' or 'BYTE' (scalar quantised with the scale for the EMBEDDING_MODEL in EMBEDDING_QUANTISATION_SCALES),
+# so the query vector can be encoded the same way. These should be the same as VECTOR_ENCODING and EMBEDDING_QUANTISATION_SCALES in the indexer's settings.py
+VECTOR_ENCODING = 'FLOAT'
+EMBEDDING_QUANTISATION_SCALES = {}
+# Answer API settings
+# - ANSWER_TOP_K is the number of content chunks retrieved for each question
+# - ANSWER_CONTEXT_TOKENS is the token budget for the context in the prompt, which needs to leave room in the model's
+#   context window (512 tokens by default) for the system prompt, question and answer
+# - ANSWER_CACHE_SIZE is the number of answers kept in each web server process's answer cache
+# - ANSWER_INDEX_GENERATION_TTL is how long in seconds the Solr index generation (part of the answer cache key) is reused before it is fetched again
+# - LLM_CONNECT_TIMEOUT and LLM_READ_TIMEOUT are the timeouts in seconds for connecting to the model server and for waiting for each part of the answer
+ANSWER_TOP_K = 8
+ANSWER_CONTEXT_TOKENS = 300
+ANSWER_CACHE_SIZE = 256
+ANSWER_INDEX_GENERATION_TTL = 10
+LLM_CONNECT_TIMEOUT = 5
+LLM_READ_TIMEOUT = 60
+# Solr query budget settings, to stop slow queries piling up web server workers under load
+# - SOLR_TIME_ALLOWED_MS is passed to Solr as timeAllowed, after which Solr returns the (partial) results found so far
+# - SOLR_CLIENT_TIMEOUT is the timeout in seconds for requests to Solr, so the web server gives up if Solr doesn't respond
+# - SOLR_MAX_CONCURRENT_QUERIES is the number of search queries each web server process will send to Solr at the same time
+# - SOLR_MAX_QUEUED_QUERIES is the number of search queries each web server process will queue waiting for a free slot, for up to
+#   SOLR_QUEUE_TIMEOUT seconds, before sending a degraded query (without facets, and with SOLR_DEGRADED_TIME_ALLOWED_MS) instead
+# - SOLR_MAX_DEGRADED_QUERIES is the number of degraded queries each web server process will send to Solr at the same time,
+#   after which an empty result is returned straight away
+SOLR_TIME_ALLOWED_MS = 2000
+SOLR_DEGRADED_TIME_ALLOWED_MS = 500
+SOLR_CLIENT_TIMEOUT = 5
+SOLR_MAX_CONCURRENT_QUERIES = 4
+SOLR_MAX_QUEUED_QUERIES = 8
+SOLR_QUEUE_TIMEOUT = 0.5
+SOLR_MAX_DEGRADED_QUERIES = 2
+# How often (in seconds) each web server process saves the counts of the search queries it has sent to Solr to tblSearchQueryLog,
+# from which the indexer generates the queries used to warm the Solr caches after a commit
+SEARCH_QUERY_LOG_FLUSH_INTERVAL = 60
 
 # POSTGRES_PASSWORD is normally set by docker from the .env file
 # The .env file is normally in the main application root (searchmysite/src/)
@@ -6,7 +6,7 @@ import psycopg2.extras
 from os import environ
 from searchmysite.db import get_db
 import searchmysite.sql
-from searchmysite.adminutils import extract_domain, generate_validation_key, check_for_validation_key, get_host, insert_subscription
+from searchmysite.adminutils import extract_domain, generate_validation_key, check_for_validation_key, get_host, insert_subscription, update_site_fields_in_solr
 import requests
 import subprocess
 
@@ -266,9 +266,12 @@ def success():
         current_app.logger.info('Finishing listing for domain {}, tier {}'.format(domain, tier))
         if tier == 2 or tier == 3:
             insert_subscription(domain, tier)
-            cursor.execute(searchmysite.sql.sql_update_freefull_approved, (domain, domain, tier, tier, domain))
+            cursor.execute(searchmysite.sql.sql_update_freefull_approved, (domain, domain, tier, tier, domain, domain))
             current_app.logger.info('Successfully finished listing for domain {}'.format(domain))
         conn.commit()
+        if tier == 2 or tier == 3:
+            # If the site was already indexed, e.g. via a Basic listing, update owner_verified etc. now rather than waiting for the reindex
+            update_site_fields_in_solr(domain)
     return render_template('admin/add-success.html', tier=tier, login_type=login_type)
 
 
@@ -5,7 +5,7 @@ from os import environ
 import psycopg2.extras
 from searchmysite.admin.auth import login_required, admin_required
 from searchmysite.db import get_db
-from searchmysite.adminutils import delete_domain, delete_domain_from_solr, get_most_recent_indexing_log_message
+from searchmysite.adminutils import delete_domain, delete_domain_from_solr
 import config
 import searchmysite.sql
 
@@ -50,8 +50,8 @@ def review():
                 action_id = name+action['id']
                 action_value = result['domain']+':'+action['value']
                 actions.append({'id':action_id, 'name':name, 'value':action_value, 'checked':action['checked'], 'label':action['label']})
-            # Determine status of last index (or NEW if no last index)
-            status = get_most_recent_indexing_log_message(result['domain'])
+            # Status of last index (or NEW if no last index)
+            status = result['indexing_log_message']
             # Append to review_form list of dicts
             review_form.append({'domain':result['domain'], 'home':result['home_page'], 'category':result['category'], 'date':result['domain_first_submitted'].strftime('%d %b %Y, %H:%M'), 'status':status, 'actions':actions})
         return render_template('admin/review.html', results=results, review_form=review_form)
@@ -70,7 +70,7 @@ def review():
                     message += '<li>domain: {}, action: {}</li>'.format(domain, action)                    
                     if action == "approve":
                         moderator = session['logged_in_domain']
-                        cursor.execute(searchmysite.sql.sql_update_basic_approved, (domain, moderator, domain, ))
+                        cursor.execute(searchmysite.sql.sql_update_basic_approved, (domain, moderator, domain, domain, ))
                         conn.commit()
                     elif action.startswith("reject"):
                         reason = next((a['reason'] for a in actions_list if a['value'] == action), 'Reason not listed') # Use the reason for value matching action, default to 'Reason not listed'
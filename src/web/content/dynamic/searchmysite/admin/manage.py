@@ -11,7 +11,7 @@ import json
 import config
 from searchmysite.admin.auth import login_required, set_login_session, get_login_session
 from searchmysite.db import get_db
-from searchmysite.adminutils import delete_domain, insert_subscription
+from searchmysite.adminutils import delete_domain, insert_subscription, update_site_fields_in_solr, site_field_columns
 import searchmysite.sql
 
 
@@ -33,7 +33,7 @@ manage_details_form = [
 
 # Manage Site / Indexing
 # Notes:
-# There isn't a database field for next_reindex - this will be populated in get_manage_data based on indexing_status, indexing_status_changed and full_reindex_frequency
+# There isn't a database field for next_reindex - this will be populated in get_manage_data based on indexing_status and next_due_at
 # There aren't database fields for web_feed and sitemap - this will be populated in get_manage_data based on web_feed_auto_discovered and web_feed_user_entered
 manage_indexing_form = [
 {'label':'indexing_enabled', 'label-text':'Indexing enabled', 'type':'text', 'class':'form-control-plaintext', 'editable':False, 'help':'True if indexing is enabled, and False if indexing is disabled (e.g. because of repeated failed indexing attempts).'},
@@ -72,6 +72,8 @@ def sitedetails():
                 current_app.logger.debug('edited field name: {}, value: {}'.format(edited_field_name, edited_field_value))
                 cursor.execute(searchmysite.sql.sql_update_value, (AsIs(edited_field_name), edited_field_value, domain,))
                 conn.commit()
+                if edited_field_name in site_field_columns:
+                    update_site_fields_in_solr(domain)
         manage_details_data = get_manage_data(domain, manage_details_form)
         return render_template('admin/manage-sitedetails.html', manage_details_form=manage_details_form, manage_details_data=manage_details_data)
 
@@ -98,6 +100,8 @@ def indexing():
                 current_app.logger.debug('edited field name: {}, value: {}'.format(edited_field_name, edited_field_value))
                 cursor.execute(searchmysite.sql.sql_update_value, (AsIs(edited_field_name), edited_field_value, domain,))
                 conn.commit()
+                if edited_field_name in site_field_columns:
+                    update_site_fields_in_solr(domain)
         # If they've clicked Delete Path or Save Path in Exclude Path section
         if request.form.get('delete_exclude_path'):
             delete_exclude_path = request.form.get('delete_exclude_path')
@@ -152,9 +156,13 @@ def reindex():
     (domain, method, is_admin) = get_login_session()
     conn = get_db()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute(searchmysite.sql.sql_update_indexing_status, (domain, domain, ))
+    cursor.execute(searchmysite.sql.sql_update_indexing_status, (domain, ))
+    queued = cursor.fetchone()
     conn.commit()
-    message = 'The site has been queued for reindexing. You can check on progress by refreshing this page.'
+    if queued:
+        message = 'The site has been queued for reindexing. You can check on progress by refreshing this page.'
+    else:
+        message = 'The site is being indexed at the moment, so it can\'t be queued for reindexing until that has finished. You can check on progress by refreshing this page.'
     flash(message)
     return redirect(url_for('manage.indexing'))
 
@@ -176,6 +184,8 @@ def renew_subscription_success():
     tier = 3 # Hardcoding to tier 3 for now given it is the only paid for option at the moment (if they're currently tier 2 we don't want them paying to renew tier 2)
     current_app.logger.info('Purchasing subscription for domain {}, tier {}'.format(domain, tier))
     insert_subscription(domain, tier)
+    # Update owner_verified etc. in Solr now rather than waiting for the reindex to complete
+    update_site_fields_in_solr(domain)
     message = 'Subscription successfully purchased for domain {}'.format(domain)
     current_app.logger.info(message)
     flash(message)
@@ -205,6 +215,8 @@ def get_manage_data(domain, manage_form):
         elif label == 'next_reindex':
             if result['indexing_status'] == 'PENDING':
                 next_reindex = "Any time now"
+            elif result['next_due_at']:
+                next_reindex = result['next_due_at'].strftime('%d %b %Y, %H:%M%z')
             elif result['indexing_status_changed'] and result['full_reindex_frequency']:
                 next_reindex_datetime = result['indexing_status_changed'] + result['full_reindex_frequency']
                 next_reindex = next_reindex_datetime.strftime('%d %b %Y, %H:%M%z')
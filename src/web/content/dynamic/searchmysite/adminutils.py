@@ -6,6 +6,9 @@ import psycopg2
 import psycopg2.extras
 import logging
 from os import environ
+from datetime import timezone
+import json
+import math
 import requests
 import smtplib, ssl
 from email import encoders
@@ -14,6 +17,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import stripe
 from searchmysite.db import get_db
+from searchmysite.domainresolver import extract_domain_from_url, get_domains_allowing_subdomains_cached
 import searchmysite.solr
 import searchmysite.sql
 import config
@@ -31,16 +35,13 @@ smtp_to_email = environ.get('SMTP_TO_EMAIL')
 # There is a special case for some domains to allow subdomains. This is to allow more than one account from that domain,
 # e.g. http://user1.github.io/ will return user1.github.io rather than github.io so the system will support a
 # later http://user2.github.io/
+# See domainresolver.py for the implementation, which caches the domains allowing subdomains rather than looking them up every time
 def extract_domain(url):
-    # Get the domain from the URL
-    if not url: url = ""
-    # returns subdomain, domain, suffix, is_private=True|False), also registered_domain (domain+'.'+suffix) and fqdn (subdomain+'.'+domain+'.'+suffix)
-    tld = tldextract.extract(url) 
-    domain = tld.registered_domain
-    if tld.domain == 'localhost' and tld.suffix == '': # special case for localhost which has tld.registered_domain = ''
-        domain = tld.domain
-    domain = domain.lower() # lowercase the domain to help prevent duplicates
-    # Look up list of domains which allow subdomains from database
+    domains_allowing_subdomains = get_domains_allowing_subdomains_cached(select_domains_allowing_subdomains)
+    return extract_domain_from_url(url, domains_allowing_subdomains)
+
+# Look up list of domains which allow subdomains from database
+def select_domains_allowing_subdomains():
     domains_allowing_subdomains = []
     conn = get_db()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -48,11 +49,7 @@ def extract_domain(url):
     results = cursor.fetchall()
     for result in results:
         domains_allowing_subdomains.append(result['setting_value'])
-    # Add subdomain if in domains_allowing_subdomains
-    if domain in domains_allowing_subdomains: # special domains where a site can be on a subdomain
-        if tld.subdomain and tld.subdomain != "":
-            domain = tld.subdomain + "." + domain
-    return domain
+    return domains_allowing_subdomains
 
 
 def select_indexed_domains():
@@ -65,18 +62,6 @@ def select_indexed_domains():
         indexed_domains.append(result['domain'])
     return indexed_domains
 
-# Returns the most recent completed indexing message from the indexing log, or NEW if none
-def get_most_recent_indexing_log_message(domain):
-    conn = get_db()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute(searchmysite.sql.sql_select_indexing_log_message, (domain,))
-    last_indexing_log_message = cursor.fetchone()
-    if last_indexing_log_message:
-        message = last_indexing_log_message['message']
-    else:
-        message = 'NEW'
-    return message
-
 # Get the actual host URL, for use in links which need to contain the servername and protocol
 # This will be 'http://127.0.0.1:5000/' if run in Flask and 'http://127.0.0.1:8080/' if run in Apache httpd + mod_wsgi
 # If run behind a reverse proxy, production will also be 'http://127.0.0.1:8080/', 
@@ -120,17 +105,98 @@ def delete_domain(domain):
 
 def delete_domain_from_solr(domain):
     # Delete from Solr
+    # and from the chunks core if the content chunks are kept there
+    for solrurl in [config.SOLR_URL, config.CONTENT_CHUNKS_SOLR_URL]:
+        if solrurl:
+            solrquery = solrurl + searchmysite.solr.solr_delete_query
+            data = searchmysite.solr.solr_delete_data.format(domain)
+            requests.post(url=solrquery, data=data.encode("utf8"), headers=searchmysite.solr.solr_delete_headers)
+    return
+
+# The tblDomains columns which are copied to the site level fields in Solr, i.e. if one of these changes the
+# site level fields should be updated in Solr via update_site_fields_in_solr
+site_field_columns = ['category', 'include_in_public_search', 'api_enabled']
+
+# The static rank of a page, i.e. the query independent part of the relevancy, which is stored in the static_rank field
+# and multiplied into the score by the boost in solrconfig.xml, rather than being calculated for every matching doc on every query.
+# It is the same as the boost function it replaces:
+# product( sum(1, log(sum(1, product(indexed_inlink_domains_count, 1.8)))), if(contains_adverts,0.5,1), if(owner_verified,1.1,1) )
+# noting log in Solr function queries is log base 10. It needs to be recalculated if any of the fields it is derived from change.
+# IMPORTANT: This function is in both indexing/common/utils.py and web/content/dynamic/searchmysite/adminutils.py
+# so if it is updated in one it should be updated in the other
+def get_static_rank(indexed_inlink_domains_count, contains_adverts, owner_verified):
+    static_rank = 1 + math.log10(1 + (indexed_inlink_domains_count or 0) * 1.8)
+    if contains_adverts: static_rank = static_rank * 0.5
+    if owner_verified: static_rank = static_rank * 1.1
+    return static_rank
+
+# Update the site level fields in Solr, i.e. the fields which have the same value for every page in a site, to match the
+# database, so changes such as a tier upgrade are reflected in the search results without having to wait for a full reindex.
+# public, owner_verified and site_category are set on every page, while api_enabled and date_domain_added are only set on the home page.
+def update_site_fields_in_solr(domain):
+    conn = get_db()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cursor.execute(searchmysite.sql.sql_select_site_fields, (domain,))
+    result = cursor.fetchone()
+    if result:
+        site_fields = {}
+        site_fields['public'] = result['include_in_public_search']
+        site_fields['owner_verified'] = True if result['tier'] == 3 else False
+        site_fields['site_category'] = result['category']
+        home_page_fields = {}
+        home_page_fields['api_enabled'] = result['api_enabled']
+        home_page_fields['date_domain_added'] = result['domain_first_submitted'].astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        solr_update_site_fields(domain, site_fields, home_page_fields)
+    return
+
+# Set field values on every page in a domain via atomic updates, i.e. without having to reindex the pages.
+# The ids are streamed from Solr via cursorMark so there's no limit on the number of pages, and the updates are submitted in batches,
+# with commitWithin rather than a commit so updates from different domains can be combined into the same commit.
+# home_page_fields are only set on the home page.
+# See https://solr.apache.org/guide/solr/latest/indexing-guide/partial-document-updates.html#atomic-updates
+# IMPORTANT: This function is in both indexing/common/utils.py and web/content/dynamic/searchmysite/adminutils.py
+# so if it is updated in one it should be updated in the other
+def solr_update_site_fields(domain, site_fields, home_page_fields):
     solrurl = config.SOLR_URL
-    solrquery = solrurl + searchmysite.solr.solr_delete_query
-    data = searchmysite.solr.solr_delete_data.format(domain)
-    requests.post(url=solrquery, data=data.encode("utf8"), headers=searchmysite.solr.solr_delete_headers)
+    batch_size = searchmysite.solr.solr_atomic_update_batch_size
+    cursor_mark = '*'
+    no_of_docs = 0
+    # A failure is logged rather than raised, because the database has already been updated, and the next reindex will set the fields anyway
+    try:
+        while True:
+            solrquery = solrurl + searchmysite.solr.solr_select_ids_for_domain.format(domain, batch_size)
+            response = requests.get(url=solrquery, params={'cursorMark': cursor_mark}, timeout=config.SOLR_CLIENT_TIMEOUT)
+            response.raise_for_status()
+            results = response.json()
+            updates = []
+            for doc in results['response']['docs']:
+                update = {'id': doc['id']}
+                fields = dict(site_fields, **home_page_fields) if doc.get('is_home') else site_fields
+                for field, value in fields.items():
+                    update[field] = {'set': value}
+                if 'owner_verified' in site_fields: # static_rank is derived from owner_verified
+                    update['static_rank'] = {'set': get_static_rank(doc.get('indexed_inlink_domains_count'), doc.get('contains_adverts'), site_fields['owner_verified'])}
+                updates.append(update)
+            if updates:
+                solrquery = solrurl + searchmysite.solr.solr_atomic_update_query
+                response = requests.post(url=solrquery, data=json.dumps(updates).encode("utf8"), headers=searchmysite.solr.solr_atomic_update_headers, timeout=config.SOLR_CLIENT_TIMEOUT)
+                response.raise_for_status()
+                no_of_docs += len(updates)
+            next_cursor_mark = results['nextCursorMark']
+            if next_cursor_mark == cursor_mark:
+                break
+            cursor_mark = next_cursor_mark
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        current_app.logger.error('Error updating {} on the docs for {} after {} docs: {}'.format(list(site_fields) + list(home_page_fields), domain, no_of_docs, e))
+        return
+    current_app.logger.info('Updated {} on {} docs for {}'.format(list(site_fields) + list(home_page_fields), no_of_docs, domain))
     return
 
 def delete_domain_from_database(domain):
     # Delete from database
     conn = get_db()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute(searchmysite.sql.sql_delete_domain, (domain, domain, domain, domain, domain,))
+    cursor.execute(searchmysite.sql.sql_delete_domain, (domain, domain, domain, domain, domain, domain,))
     conn.commit()
     return
 
@@ -1,16 +1,21 @@
 from flask import (
-    Blueprint, jsonify, request, current_app, make_response
+    Blueprint, jsonify, request, current_app, make_response, Response, stream_with_context
 )
 from urllib.request import urlopen
+from urllib.error import URLError
 from urllib.parse import quote
 from datetime import datetime, timezone
+from collections import OrderedDict
+from threading import Lock
 import json
+import time
+import socket
 import xml.etree.ElementTree as ET
 import xml.dom.minidom
 from searchmysite.db import get_db
 import config
 import searchmysite.solr
-from searchmysite.searchutils import check_if_api_enabled_for_domain, get_search_params, get_groupbydomain, get_filter_queries, get_start, do_search, get_no_of_results, get_links, get_display_results #, do_vector_search, get_query_vector_string
+from searchmysite.searchutils import check_if_api_enabled_for_domain, get_search_params, get_groupbydomain, get_filter_queries, get_start, do_search, get_no_of_results, get_links, get_display_results, do_vector_search, get_query_vector_string, get_index_generation
 import requests
 
 
@@ -34,6 +39,8 @@ bp = Blueprint('searchapi', __name__)
 #     404 {"message": "Domain <domain> not found"}
 #   Domain does not have API enabled:
 #     400 {"message": "Domain <domain> does not have the API enabled"}
+#   Solr unavailable:
+#     503 {"message": "Search is unavailable"}
 #   No results:
 #     200 {"params": {"q": "<query>", "page": 1, "resultsperpage": 10}, "totalresults": 0, "results": []}
 #   Results:
@@ -77,8 +84,12 @@ def search(domain, search_type='search'):
         # Do search
         solrurl = config.SOLR_URL
         queryurl = solrurl + searchmysite.solr.solrquery.format(quote(params['q']), start, params['resultsperpage'], domain, searchmysite.solr.split_text, searchmysite.solr.split_text)
-        connection = urlopen(queryurl)
-        response = json.load(connection)
+        try:
+            connection = urlopen(queryurl, timeout=config.SOLR_CLIENT_TIMEOUT)
+            response = json.load(connection)
+        except (socket.timeout, URLError, ValueError) as e:
+            current_app.logger.error('Error searching {}: {}'.format(domain, e))
+            return error_response(503, 'json', message="Search is unavailable")
         # Process results, i.e. get data, reformat dates, and add fragment
         totalresults = response['response']['numFound']
         results = response['response']['docs']
@@ -256,42 +267,198 @@ def predictions():
     # prompt_format is "chatml" for ChatML format, or "llama2-chat" for the Llama 2 Chat format
     #prompt_format = "llama2-chat"
     prompt_format = "chatml"
+    llm_prompt_prefix = get_llm_prompt_prefix(prompt_type, prompt_format)
     llm_prompt = get_llm_prompt(query, context, prompt_type, prompt_format)
-    llm_data = get_llm_data(llm_prompt)
+    llm_data = get_llm_data(llm_prompt, llm_prompt_prefix)
     #current_app.logger.debug('llm_prompt: {}'.format(llm_prompt))
     # Do request
-    response = do_llm_prediction(llm_prompt, llm_data)
+    response = do_llm_prediction(llm_data)
     return make_response(jsonify(response))
 
-def get_llm_prompt(question, context, prompt_type, prompt_format):
+# The prompt prefix is the fixed part at the start of the prompt, i.e. the system prompt.
+# It is sent to the model server separately so the model state after evaluating it can be cached
+# and reused, rather than the same system prompt being evaluated again on every request.
+def get_llm_prompt_prefix(prompt_type, prompt_format):
     if prompt_type == 'qa':
         system = "Answer the question based on the context below."
         if prompt_format == 'llama2-chat':
-            prompt = "<s>[INST] <<SYS>>{system}<</SYS>> \n [context]: {context} \n [question]: {question} [\INST]".format(system=system, context=context, question=question)
+            prefix = "<s>[INST] <<SYS>>{system}<</SYS>> ".format(system=system)
+        else:
+            prefix = "<|im_start|>system\n{system}<|im_end|>".format(system=system)
+    else:
+        prefix = "[INST] <<SYS>> You are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe. If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information.<</SYS>>"
+    return prefix
+
+def get_llm_prompt(question, context, prompt_type, prompt_format):
+    prefix = get_llm_prompt_prefix(prompt_type, prompt_format)
+    if prompt_type == 'qa':
+        if prompt_format == 'llama2-chat':
+            prompt = prefix + "\n [context]: {context} \n [question]: {question} [\INST]".format(context=context, question=question)
         else:
-            prompt = "<|im_start|>system\n{system}<|im_end|><|im_start|>user\nContext:{context} Question: {question}<|im_end|>\n<|im_start|>assistant".format(system=system, context=context, question=question)
+            prompt = prefix + "<|im_start|>user\nContext:{context} Question: {question}<|im_end|>\n<|im_start|>assistant".format(context=context, question=question)
     else:
-        prompt = "[INST] <<SYS>> You are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe. If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information.<</SYS>>{}[/INST]".format(query)
+        prompt = prefix + "{}[/INST]".format(question)
     return prompt
 
-def get_llm_data(prompt):
+def get_llm_data(prompt, prompt_prefix, stream=False):
     data = json.dumps(
         {
             "prompt": prompt,
+            "prompt_prefix": prompt_prefix,
             "max_tokens": 100,
             "top_p": 0.95,
             "temperature": 0.8,
+            "stream": stream,
         }
     )
     return data
 
-def do_llm_prediction(prompt, data):
+# The model server only returns the generated text (i.e. not the prompt as well)
+def do_llm_prediction(data):
     #url = config.TORCHSERVE + "predictions/llama2"
     url = config.TORCHSERVE + "predictions/rocket-3b"
     headers = {"Content-type": "application/json", "Accept": "text/plain"}
     response = requests.post(url=url, data=data, headers=headers)
-    cleaned_response = response.text.removeprefix(prompt)
-    return cleaned_response     
+    return response.text
+
+
+# Answer API
+# ----------
+# 
+# Full URL:
+#   /api/v1/answer/?q=<question>&domain=<domain>
+#   e.g. /api/v1/answer/?q=How%20long%20does%20it%20take%20to%20climb%20Ben%20Nevis&domain=*
+# 
+# Parameters:
+#   <question> is the question text
+#   <domain> is the domain to search, or * for all domains
+# 
+# Responses:
+#   No question:
+#     400 {"message": "No question"}
+#   Solr unavailable:
+#     503 {"message": "Search is unavailable"}
+#   Model server unavailable:
+#     503 {"message": "Answers are unavailable"}
+#   Results:
+#     Newline delimited JSON, streamed as it is generated, i.e. the sources first and then the answer text in one or more parts:
+#     {"sources": [{"url": "https://url/", "score": 0.8489073}, ...]}
+#     {"answer": "The answer"}
+#     ...
+#     If the model server fails part way through the answer, the last line is {"error": "Answer incomplete"}
+#
+# This does the retrieval, prompt construction and LLM call in one request, rather than the client calling
+# /knnsearch/ and then /predictions/llm. The context is built from as many of the retrieved content chunks as will
+# fit in the token budget. Complete answers are cached, keyed on the question, domain and Solr index generation
+# of the core the content chunks come from, so a repeated question is answered from the cache until the index changes.
+# The index generation is itself cached for ANSWER_INDEX_GENERATION_TTL seconds, so it isn't fetched on every request.
+
+answer_cache = OrderedDict()
+answer_cache_lock = Lock()
+answer_index_generation = {'generation': None, 'expires': 0}
+
+@bp.route('/answer/', methods=['GET', 'POST'])
+def answer():
+    question = request.values.get('q', '').strip()
+    if not question or question == '*':
+        return error_response(400, 'json', message="No question")
+    params = get_search_params(request, 'search')
+    domain = params['domain']
+    try:
+        cache_key = (question.lower(), domain, get_answer_index_generation())
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        current_app.logger.error('Error getting the index generation: {}'.format(e))
+        return error_response(503, 'json', message="Search is unavailable")
+    with answer_cache_lock:
+        cached = answer_cache.get(cache_key)
+        if cached: answer_cache.move_to_end(cache_key)
+    if cached:
+        sources, answer_text = cached
+        lines = [json.dumps({'sources': sources}) + '\n', json.dumps({'answer': answer_text}) + '\n']
+        return Response(lines, mimetype='application/x-ndjson')
+    query_vector_string = get_query_vector_string(question)
+    try:
+        response = do_vector_search(query_vector_string, domain, config.ANSWER_TOP_K)
+        chunks = response['response']['docs']
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        current_app.logger.error('Error doing the vector search: {}'.format(e))
+        return error_response(503, 'json', message="Search is unavailable")
+    context, sources = get_answer_context(chunks, config.ANSWER_CONTEXT_TOKENS)
+    prompt_format = "chatml"
+    llm_prompt_prefix = get_llm_prompt_prefix('qa', prompt_format)
+    llm_prompt = get_llm_prompt(question, context, 'qa', prompt_format)
+    llm_data = get_llm_data(llm_prompt, llm_prompt_prefix, stream=True)
+    # Start the request to the model server before the response, so a model server error is returned as an error
+    # response rather than being streamed (and cached) as the answer
+    try:
+        llm_response = start_llm_prediction_stream(llm_data)
+    except requests.exceptions.RequestException as e:
+        current_app.logger.error('Error starting the answer: {}'.format(e))
+        return error_response(503, 'json', message="Answers are unavailable")
+    def generate():
+        yield json.dumps({'sources': sources}) + '\n'
+        answer_parts = []
+        try:
+            for answer_part in do_llm_prediction_stream(llm_response):
+                answer_parts.append(answer_part)
+                yield json.dumps({'answer': answer_part}) + '\n'
+        except requests.exceptions.RequestException as e:
+            current_app.logger.error('Error streaming the answer: {}'.format(e))
+            yield json.dumps({'error': 'Answer incomplete'}) + '\n'
+            return
+        # Only complete answers are cached
+        with answer_cache_lock:
+            answer_cache[cache_key] = (sources, ''.join(answer_parts))
+            while len(answer_cache) > config.ANSWER_CACHE_SIZE:
+                answer_cache.popitem(last=False)
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# The index generation of the core the content chunks come from, reused for ANSWER_INDEX_GENERATION_TTL seconds.
+# Two requests may both fetch it when it expires, which is harmless.
+def get_answer_index_generation():
+    now = time.monotonic()
+    if answer_index_generation['generation'] is None or now >= answer_index_generation['expires']:
+        answer_index_generation['generation'] = get_index_generation(config.CONTENT_CHUNKS_SOLR_URL or config.SOLR_URL)
+        answer_index_generation['expires'] = now + config.ANSWER_INDEX_GENERATION_TTL
+    return answer_index_generation['generation']
+
+# Build the context from the content chunks (which are in descending score order), adding chunks until the next
+# one would take the context over the token budget. The number of tokens is estimated at 4 characters per token,
+# which avoids having to load the model's tokenizer here. Also returns the sources, i.e. the url and score of each
+# page used in the context.
+def get_answer_context(chunks, max_tokens):
+    max_chars = max_tokens * 4
+    context_chunks = []
+    context_chars = 0
+    sources = []
+    for chunk in chunks:
+        text = chunk.get('content_chunk_text', '').strip()
+        if not text or text in context_chunks: continue
+        if context_chars + len(text) > max_chars: break
+        context_chunks.append(text)
+        context_chars += len(text) + 1
+        if chunk['url'] not in [source['url'] for source in sources]:
+            sources.append({'url': chunk['url'], 'score': chunk['score']})
+    context = ' '.join(context_chunks)
+    return context, sources
+
+# Start the streamed request to the model server, raising an exception if it can't be reached or returns an error
+def start_llm_prediction_stream(data):
+    url = config.TORCHSERVE + "predictions/rocket-3b"
+    headers = {"Content-type": "application/json", "Accept": "text/plain"}
+    response = requests.post(url=url, data=data, headers=headers, stream=True, timeout=(config.LLM_CONNECT_TIMEOUT, config.LLM_READ_TIMEOUT))
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        response.close()
+        raise
+    return response
+
+# Stream the response from the model server, which sends each part of the answer as it is generated
+def do_llm_prediction_stream(response):
+    with response:
+        for answer_part in response.iter_content(chunk_size=None, decode_unicode=True):
+            if answer_part: yield answer_part
 
 
 # Utilities
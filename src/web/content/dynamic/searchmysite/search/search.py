@@ -35,7 +35,7 @@ def search(search_type='search'):
     display_facets = get_display_facets(params['filter_queries'], search_results)
     display_results = get_display_results(search_results, groupbydomain, params, links['query_string'])
 
-    return render_template('search/results.html', params=params, facets=display_facets, sort_options=searchmysite.solr.sort_options_search, results=display_results, no_of_results=total_results, pagination=display_pagination, links=links, display_type='list', subtitle='Search Results')
+    return render_template('search/results.html', params=params, facets=display_facets, sort_options=searchmysite.solr.sort_options_search, results=display_results, no_of_results=total_results, pagination=display_pagination, links=links, degraded=search_results.get('degraded'), display_type='list', subtitle='Search Results')
 
 
 @bp.route('/browse/', methods=['GET', 'POST'])
@@ -58,7 +58,7 @@ def browse(search_type='browse'):
     display_facets = get_display_facets(params['filter_queries'], search_results)
     display_results = get_display_results(search_results, groupbydomain, params, links['query_string'])
 
-    return render_template('search/results.html', params=params, facets=display_facets, sort_options=searchmysite.solr.sort_options_browse, results=display_results, no_of_domains=total_results, pagination=display_pagination, links=links, display_type='table', subtitle='Browse Sites')
+    return render_template('search/results.html', params=params, facets=display_facets, sort_options=searchmysite.solr.sort_options_browse, results=display_results, no_of_domains=total_results, pagination=display_pagination, links=links, degraded=search_results.get('degraded'), display_type='table', subtitle='Browse Sites')
 
 
 @bp.route('/chat/', methods=['GET', 'POST'])
@@ -106,7 +106,7 @@ def newest(search_type='newest'):
     display_facets = get_display_facets(params['filter_queries'], search_results)
     display_results = get_display_results(search_results, groupbydomain, params, links['query_string'])
 
-    return render_template('search/results.html', params=params, facets=display_facets, sort_options=searchmysite.solr.sort_options_newest, results=display_results, no_of_results=total_domains, pagination=display_pagination, links=links, display_type='list', subtitle='Newest Pages')
+    return render_template('search/results.html', params=params, facets=display_facets, sort_options=searchmysite.solr.sort_options_newest, results=display_results, no_of_results=total_domains, pagination=display_pagination, links=links, degraded=search_results.get('degraded'), display_type='list', subtitle='Newest Pages')
 
 
 @bp.route('/random/')
@@ -115,14 +115,14 @@ def random():
 
     # Step 1: find out how many domains are in the collection
     solrquery = solrurl + searchmysite.solr.random_result_step1_get_no_of_domains
-    connection = urlopen(solrquery)
+    connection = urlopen(solrquery, timeout=config.SOLR_CLIENT_TIMEOUT)
     response = json.load(connection)
     no_of_domains = response['grouped']['domain']['ngroups'] 
 
     # Step 2: pick a random domain and get the domain name and number of documents on that domain
     random_domain_number = randrange(no_of_domains)
     solrquery = solrurl + searchmysite.solr.random_result_step2_get_domain_and_no_of_docs_on_domain.format(str(random_domain_number))
-    connection = urlopen(solrquery)
+    connection = urlopen(solrquery, timeout=config.SOLR_CLIENT_TIMEOUT)
     response = json.load(connection)
     domain_name = response['grouped']['domain']['groups'][0]['groupValue'] 
     no_of_docs_on_domain = response['grouped']['domain']['groups'][0]['doclist']['numFound']
@@ -130,7 +130,7 @@ def random():
     # Step 3: pick a random document from that domain
     random_document_number = randrange(no_of_docs_on_domain)
     solrquery = solrurl + searchmysite.solr.random_result_step3_get_doc_from_domain.format(str(random_document_number), domain_name)
-    connection = urlopen(solrquery)
+    connection = urlopen(solrquery, timeout=config.SOLR_CLIENT_TIMEOUT)
     response = json.load(connection)
     url = response['response']['docs'][0]['url']
 
@@ -2,6 +2,10 @@ from flask import url_for, current_app
 import requests
 import json
 import math
+import threading
+import time
+import hashlib
+from collections import Counter
 from datetime import datetime
 import psycopg2.extras
 import config
@@ -113,12 +117,30 @@ def get_groupbydomain(params, search_type):
 # Get the query string expressed as a vector string
 # i.e. convert the query string to a vector and convert the vector to a string representation of a list, 
 # e.g. "[1.0, 2.0, 3.0, 4.0]" as required by Solr (see https://solr.apache.org/guide/solr/latest/query-guide/dense-vector-search.html)
-# def get_query_vector_string(query):
-#     model = SentenceTransformer(config.EMBEDDING_MODEL)
-#     embedding = model.encode(query)
-#     query_vector = embedding.tolist()
-#     query_vector_string = repr(query_vector)
-#     return query_vector_string
+# The embedding model is loaded on first use and kept for the lifetime of the process rather than being loaded for every query.
+# sentence-transformers is only imported here because it is commented out in requirements.txt while vector search is not enabled.
+# If the embeddings are BYTE encoded, the query vector is quantised in the same way, e.g. "[12, -3, 127, 0]"
+embedding_model = None
+def get_query_vector_string(query):
+    global embedding_model
+    if embedding_model is None:
+        from sentence_transformers import SentenceTransformer
+        embedding_model = SentenceTransformer(config.EMBEDDING_MODEL)
+    embedding = embedding_model.encode(query)
+    query_vector = embedding.tolist()
+    if config.VECTOR_ENCODING == 'BYTE':
+        query_vector = quantise_vector(query_vector, config.EMBEDDING_QUANTISATION_SCALES[config.EMBEDDING_MODEL])
+    query_vector_string = repr(query_vector)
+    return query_vector_string
+
+# Scalar quantise an embedding to int8, i.e. so it can be stored in a BYTE encoded DenseVectorField,
+# where scale is the value which maps to 127 (calibrated for each model, see indexing/common/vectorquantisation.py)
+# and larger values are clipped. The dot product of the quantised vectors is proportional to the dot product of the
+# originals (less the rounding and clipping error), so the ranking is preserved for similarityFunction="dot_product".
+# IMPORTANT: This function is in both indexing/common/utils.py and web/content/dynamic/searchmysite/searchutils.py
+# so if it is updated in one it should be updated in the other
+def quantise_vector(vector, scale):
+    return [max(-127, min(127, round(value * 127 / scale))) for value in vector]
 
 # Get start parameter for Solr query
 def get_start(params):
@@ -153,9 +175,113 @@ def get_filter_queries(filter_queries):
 # Perform the actual search
 # -------------------------
 
+# Admission control for the search queries to Solr
+# Each web server process sends at most SOLR_MAX_CONCURRENT_QUERIES search queries to Solr at once, with up to SOLR_MAX_QUEUED_QUERIES
+# more waiting up to SOLR_QUEUE_TIMEOUT seconds for a free slot. If the queue is full or the wait times out, a cheaper degraded query
+# (without facets) is sent instead, up to SOLR_MAX_DEGRADED_QUERIES at once, beyond which an empty result is returned without querying Solr.
+# If Solr times out or fails an empty result is also returned, so a slow Solr returns a quick degraded page rather than tying up all the
+# workers. The degraded responses are counted in solr_degraded_counts by reason, and logged.
+solr_query_slots = threading.BoundedSemaphore(config.SOLR_MAX_CONCURRENT_QUERIES)
+solr_degraded_query_slots = threading.BoundedSemaphore(config.SOLR_MAX_DEGRADED_QUERIES)
+solr_query_queue_lock = threading.Lock()
+solr_query_queue = {'waiting': 0}
+solr_degraded_counts = Counter()
+
+# Returns True if a slot was acquired, in which case release_solr_query_slot must be called after the query
+def acquire_solr_query_slot():
+    if solr_query_slots.acquire(blocking=False):
+        return True
+    with solr_query_queue_lock:
+        if solr_query_queue['waiting'] >= config.SOLR_MAX_QUEUED_QUERIES:
+            return False
+        solr_query_queue['waiting'] += 1
+    try:
+        return solr_query_slots.acquire(timeout=config.SOLR_QUEUE_TIMEOUT)
+    finally:
+        with solr_query_queue_lock:
+            solr_query_queue['waiting'] -= 1
+
+def release_solr_query_slot():
+    solr_query_slots.release()
+
+# Returns True if a degraded query slot was acquired, in which case release_solr_degraded_query_slot must be called after the query
+def acquire_solr_degraded_query_slot():
+    return solr_degraded_query_slots.acquire(blocking=False)
+
+def release_solr_degraded_query_slot():
+    solr_degraded_query_slots.release()
+
+def record_degraded_search(reason):
+    solr_degraded_counts[reason] += 1
+    current_app.logger.warning('Degraded search response ({}), counts so far: {}'.format(reason, dict(solr_degraded_counts)))
+
+# An empty result, in the same format as a Solr response, for when Solr doesn't respond in time
+def get_empty_search_results(groupbydomain):
+    if groupbydomain:
+        return {'grouped': {'domain': {'matches': 0, 'ngroups': 0, 'groups': []}}, 'facets': {}, 'highlighting': {}}
+    else:
+        return {'response': {'numFound': 0, 'docs': []}, 'facets': {}, 'highlighting': {}}
+
+# Record the search queries sent to Solr, so the indexer can warm the Solr caches after a commit with the queries which are actually used
+# (see indexing/common/searchwarming.py). The counts are kept in memory and added to tblSearchQueryLog every SEARCH_QUERY_LOG_FLUSH_INTERVAL
+# seconds by a background thread (started on the first search in each web server process), rather than writing to the database on
+# every search. If a flush fails the counts are kept for the next one. Only the Solr request is recorded, i.e. nothing about who searched.
+search_query_log_lock = threading.Lock()
+search_query_log = {'counts': Counter(), 'requests': {}, 'flusher': None}
+
+def record_search_query(solr_search):
+    request = json.dumps(solr_search, sort_keys=True)
+    request_hash = hashlib.md5(request.encode("utf8")).hexdigest()
+    with search_query_log_lock:
+        search_query_log['counts'][request_hash] += 1
+        search_query_log['requests'][request_hash] = request
+        if search_query_log['flusher'] is None:
+            flusher = threading.Thread(target=flush_search_query_log_periodically, args=(current_app._get_current_object(),), daemon=True)
+            flusher.start()
+            search_query_log['flusher'] = flusher
+
+def flush_search_query_log_periodically(app):
+    while True:
+        time.sleep(config.SEARCH_QUERY_LOG_FLUSH_INTERVAL)
+        try:
+            with app.app_context():
+                flush_search_query_log()
+        except Exception as e:
+            app.logger.exception('flush_search_query_log: {}'.format(e))
+
+def flush_search_query_log():
+    with search_query_log_lock:
+        counts = search_query_log['counts']
+        query_requests = search_query_log['requests']
+        search_query_log['counts'] = Counter()
+        search_query_log['requests'] = {}
+    if not counts:
+        return
+    values = [(request_hash, query_requests[request_hash], count) for request_hash, count in counts.items()]
+    conn = None
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, searchmysite.sql.sql_upsert_search_query_log, values, template="(%s, %s, %s, NOW())")
+        conn.commit()
+    except psycopg2.Error as e:
+        if conn: conn.rollback()
+        current_app.logger.warning('flush_search_query_log: {}'.format(e))
+        # Put the counts back so they are included in the next flush
+        with search_query_log_lock:
+            search_query_log['counts'].update(counts)
+            for request_hash in counts:
+                search_query_log['requests'].setdefault(request_hash, query_requests[request_hash])
+
 # Construct the search query params and facets
 # q and group are only required for the main search
 # start, sort and fq are required for all
+# If the response is degraded, search_results['degraded'] is set to the reason, i.e. one of:
+# - 'saturated' if there wasn't a free slot, so the query was sent without facets
+# - 'overloaded' if there wasn't a free degraded query slot either, so the results are empty
+# - 'partial_results' if Solr reached timeAllowed, so the results may be incomplete
+# - 'timeout' if Solr didn't respond within SOLR_CLIENT_TIMEOUT, so the results are empty
+# - 'error' if the request to Solr failed or its response couldn't be read, so the results are empty
 def do_search(query_params, query_facets, params, start, default_filter_queries, filter_queries, groupbydomain):
     solrquery = config.SOLR_URL + searchmysite.solr.solr_request_handler
     query_params['q'] = params['q']
@@ -164,37 +290,75 @@ def do_search(query_params, query_facets, params, start, default_filter_queries,
     query_params['fq'] = default_filter_queries + filter_queries
     query_params['group'] = groupbydomain
     solr_search = {}
-    solr_search['params'] = query_params
+    solr_search['params'] = dict(query_params)
     solr_search['facet'] = query_facets
+    record_search_query(solr_search) # i.e. the full query is recorded for warming even if a degraded query is sent
+    degraded = None
+    slot_acquired = acquire_solr_query_slot()
+    if slot_acquired:
+        solr_search['params']['timeAllowed'] = config.SOLR_TIME_ALLOWED_MS
+    else:
+        del solr_search['facet']
+        degraded = 'saturated'
+        solr_search['params']['timeAllowed'] = config.SOLR_DEGRADED_TIME_ALLOWED_MS
+        if not acquire_solr_degraded_query_slot():
+            search_results = get_empty_search_results(groupbydomain)
+            record_degraded_search('overloaded')
+            search_results['degraded'] = 'overloaded'
+            return search_results
     solr_search_json = json.dumps(solr_search)
     #current_app.logger.debug('solr_search_json: {}'.format(solr_search_json))
-    response = requests.post(url=solrquery, data=solr_search_json.encode("utf8"), headers=searchmysite.solr.solr_request_headers)
-    search_results = response.json()
+    try:
+        response = requests.post(url=solrquery, data=solr_search_json.encode("utf8"), headers=searchmysite.solr.solr_request_headers, timeout=config.SOLR_CLIENT_TIMEOUT)
+        search_results = response.json()
+    except requests.exceptions.Timeout:
+        degraded = 'timeout'
+        search_results = get_empty_search_results(groupbydomain)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        current_app.logger.error('do_search: {}'.format(e))
+        degraded = 'error'
+        search_results = get_empty_search_results(groupbydomain)
+    finally:
+        if slot_acquired:
+            release_solr_query_slot()
+        else:
+            release_solr_degraded_query_slot()
+    if not degraded and search_results.get('responseHeader', {}).get('partialResults'):
+        degraded = 'partial_results'
+    if degraded:
+        record_degraded_search(degraded)
+        search_results['degraded'] = degraded
     return search_results
 
 # Perform the vector search
 # Example from https://solr.apache.org/guide/solr/latest/query-guide/dense-vector-search.html
 # &q={!knn f=vector topK=10}[1.0, 2.0, 3.0, 4.0]
 # Need double curly braces to escape the curly braces.
-# Field in schema is content_chunk_vector.
+# Field in schema is content_chunk_vector, or content_chunk_byte_vector if the embeddings are BYTE encoded.
 # Vector has to be a string representation of a list like "[1.0, 2.0, 3.0, 4.0]"
-#def do_vector_search(query_vector_string, domain):
-#    solr_select_params_vector_search = {
-#        "q": '{{!knn f=content_chunk_vector topK=4}}{}'.format(query_vector_string),
-#        "fl": ["id", "url", "content_chunk_text", "score"],
-#        "fq": "domain:{}".format(domain)
-#    }
-#    solr_search = {}
-#    solr_search['params'] = solr_select_params_vector_search
-#    solr_search_json = json.dumps(solr_search)
-#    solrquery = config.SOLR_URL + searchmysite.solr.solr_request_handler
-#    response = requests.post(url=solrquery, data=solr_search_json.encode("utf8"), headers=searchmysite.solr.solr_request_headers)
-#    search_results = response.json()
-##    results = []
-##    for search_result in search_results['response']['docs']:
-##        result = extract_data_from_result(search_result, search_results, False)
-##        results.append(result)
-#    return search_results
+def do_vector_search(query_vector_string, domain, top_k=4):
+    vector_field = 'content_chunk_byte_vector' if config.VECTOR_ENCODING == 'BYTE' else 'content_chunk_vector'
+    solr_select_params_vector_search = {
+        "q": '{{!knn f={} topK={}}}{}'.format(vector_field, top_k, query_vector_string),
+        "fl": ["id", "url", "content_chunk_text", "score"],
+        "fq": "domain:{}".format(domain)
+    }
+    solr_search = {}
+    solr_search['params'] = solr_select_params_vector_search
+    solr_search_json = json.dumps(solr_search)
+    # The content chunks are in the chunks core if configured, otherwise they are child docs in the content core
+    solrquery = (config.CONTENT_CHUNKS_SOLR_URL or config.SOLR_URL) + searchmysite.solr.solr_request_handler
+    response = requests.post(url=solrquery, data=solr_search_json.encode("utf8"), headers=searchmysite.solr.solr_request_headers, timeout=config.SOLR_CLIENT_TIMEOUT)
+    search_results = response.json()
+    return search_results
+
+# Get the generation of the Solr index, i.e. a number which increases every time a commit changes the index.
+# Used to invalidate anything cached which is derived from the index contents.
+def get_index_generation(solrurl):
+    solrquery = solrurl + searchmysite.solr.solr_index_generation_query
+    response = requests.get(url=solrquery, timeout=config.SOLR_CLIENT_TIMEOUT)
+    index_generation = response.json()['generation']
+    return index_generation
 
 
 # Utils to get data required to display the results
@@ -321,7 +485,7 @@ def get_display_pagination(current_page, pages):
 # ]
 def get_display_facets(filter_queries, results):
     facets = []
-    for facet_field in results['facets']:
+    for facet_field in results.get('facets', {}): # there are no facets in a degraded response
         if facet_field != "count":
             facet = {}
             if facet_field == "site_category":
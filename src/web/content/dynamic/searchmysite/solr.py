@@ -7,7 +7,7 @@ default_results_per_page_browse = 20
 default_results_per_page_newest = 12
 default_results_per_page_api = 10
 sort_options_search = {"score desc": "Score (high-low)", "published_date desc": "Published (new-old)", "page_last_modified desc": "Modified (new-old)"}
-sort_options_browse = {"date_domain_added desc": "Added (new-old)", "date_domain_added asc": "Added (old-new)", "domain asc": "Domain (A-Z)", "domain desc": "Domain (Z-A)", "indexed_inlink_domains_count desc": "Inlinks (high-low)"}
+sort_options_browse = {"date_domain_added desc": "Added (new-old)", "date_domain_added asc": "Added (old-new)", "domain asc": "Domain (A-Z)", "domain desc": "Domain (Z-A)", "indexed_inlink_domains_count desc": "Inlinks (high-low)", "domain_rank desc": "Domain rank (high-low)"}
 sort_options_newest = {"published_date desc": "Published (new-old)", "published_date asc": "Published (old-new)", "page_last_modified desc": "Modified (new-old)"}
 default_sort_search = "score desc"
 default_sort_browse = "date_domain_added desc"
@@ -126,13 +126,28 @@ random_result_step3_get_doc_from_domain = 'select?q=*%3A*&rows=1&start={}&fq=dom
 # 5. API query
 # &fq=!relationship%3Achild added to ensure only parent pages are returned, i.e. not the content chunks used for embedding 
 # (can't use fq=relationship%3Aparent because not all pages will have a value for relationship initially)
-solrquery = 'select?fl=id,url,title,author,description,tags,page_type,page_last_modified,published_date,language,indexed_inlinks,indexed_outlinks&q={}&start={}&rows={}&wt=json&fq=domain%3A{}&fq=!relationship%3Achild&hl=on&hl.fl=content&hl.simple.pre={}&hl.simple.post={}'
+# defType=edismax so the query searches the qf fields in solrconfig.xml, as the main search does
+solrquery = 'select?fl=id,url,title,author,description,tags,page_type,page_last_modified,published_date,language,indexed_inlinks,indexed_outlinks&q={}&defType=edismax&start={}&rows={}&wt=json&fq=domain%3A{}&fq=!relationship%3Achild&hl=on&hl.fl=content&hl.simple.pre={}&hl.simple.post={}'
+
+# 6. Index generation query
+# Returns the generation of the latest commit point, which is used for the answer cache key so cached answers are invalidated when the index changes
+solr_index_generation_query = 'replication?command=indexversion&wt=json'
 
 
 # Solr update queries
 # -------------------
 
+# Atomic update queries, used in adminutils
+# The ids are sorted so cursorMark can be used, and fq=!relationship:child excludes the content chunks
+solr_select_ids_for_domain = 'select?q=domain%3A{}&fq=!relationship%3Achild&fl=id,is_home,indexed_inlink_domains_count,contains_adverts&sort=id%20asc&rows={}'
+# Changes are sent with commitWithin rather than committed, so they become visible in the same coordinated commit as the indexer's changes
+# (see SOLR_COMMIT_WITHIN in indexing/indexer/settings.py)
+solr_commit_within = 10000
+solr_atomic_update_query = "update?commitWithin={}".format(solr_commit_within)
+solr_atomic_update_headers = {'Content-Type': 'application/json'}
+solr_atomic_update_batch_size = 500
+
 # Delete queries, used in adminutils
-solr_delete_query = "update?commit=true"
+solr_delete_query = "update?commitWithin={}".format(solr_commit_within)
 solr_delete_headers = {'Content-Type': 'text/xml'}
 solr_delete_data = "<delete><query>domain:{}</query></delete>"
@@ -51,6 +51,7 @@ sql_update_freefull_validated = "UPDATE tblValidations "\
     "WHERE domain = (%s);"
 
 # Delete any tier 1 listings if present to avoid any potential issues later, then update the tier 2 or 3 status to 'ACTIVE'
+# The pg_notify tells the indexer (which LISTENs on indexing_pending) to start indexing the site straight away, rather than waiting for its next poll
 sql_update_freefull_approved = "DELETE FROM tblListingStatus WHERE domain = (%s) AND tier = 1;"\
     "UPDATE tblListingStatus "\
     "SET status = 'ACTIVE', status_changed = NOW(), pending_state = NULL, pending_state_changed = NOW() "\
@@ -65,7 +66,8 @@ sql_update_freefull_approved = "DELETE FROM tblListingStatus WHERE domain = (%s)
     "indexing_enabled = TRUE, "\
     "indexing_status = 'PENDING', "\
     "indexing_status_changed = NOW() "\
-    "FROM tblTiers WHERE tblTiers.tier = (%s) and tblDomains.domain = (%s);"
+    "FROM tblTiers WHERE tblTiers.tier = (%s) and tblDomains.domain = (%s); "\
+    "SELECT pg_notify('indexing_pending', (%s));"
 
 sql_select_validation_key = "SELECT validation_key FROM tblValidations WHERE domain = (%s);"
 
@@ -75,11 +77,15 @@ sql_select_validation_key = "SELECT validation_key FROM tblValidations WHERE dom
 
 sql_select_home_page = 'SELECT home_page FROM tblDomains WHERE domain = (%s);'
 
-sql_select_basic_pending = "SELECT d.domain, d.home_page, d.category, d.domain_first_submitted FROM tblDomains d "\
+# indexing_log_message is the most recent COMPLETE indexing log message, or NEW if there isn't one
+sql_select_basic_pending = "SELECT d.domain, d.home_page, d.category, d.domain_first_submitted, "\
+    "CASE WHEN s.last_complete_timestamp IS NULL THEN 'NEW' ELSE s.last_complete_message END AS indexing_log_message FROM tblDomains d "\
     "INNER JOIN tblListingStatus l ON d.domain = l.domain "\
+    "LEFT JOIN tblIndexingStatusLatest s ON d.domain = s.domain "\
     "WHERE l.status = 'PENDING' AND l.tier = 1 AND l.pending_state = 'MODERATOR_REVIEW' "\
     "ORDER BY l.listing_end DESC, l.tier ASC;"
 
+# The pg_notify tells the indexer to start indexing the site straight away (see sql_update_freefull_approved)
 sql_update_basic_approved = "UPDATE tblListingStatus "\
     "SET status = 'ACTIVE', status_changed = NOW(), pending_state = NULL, pending_state_changed = NOW(), listing_start = NOW(), listing_end = NOW() + (SELECT listing_duration FROM tblTiers WHERE tier = 1) "\
     "WHERE domain = (%s) AND status = 'PENDING' AND tier = 1 AND pending_state = 'MODERATOR_REVIEW'; "\
@@ -95,7 +101,8 @@ sql_update_basic_approved = "UPDATE tblListingStatus "\
     "indexing_enabled = TRUE, "\
     "indexing_status = 'PENDING', "\
     "indexing_status_changed = NOW() "\
-    "FROM tblTiers WHERE tblTiers.tier = 1 and tblDomains.domain = (%s);"
+    "FROM tblTiers WHERE tblTiers.tier = 1 and tblDomains.domain = (%s); "\
+    "SELECT pg_notify('indexing_pending', (%s));"
 
 sql_update_basic_reject = "UPDATE tblListingStatus "\
     "SET status = 'DISABLED', status_changed = NOW(), pending_state = NULL, pending_state_changed = NOW() "\
@@ -110,8 +117,6 @@ sql_update_basic_reject = "UPDATE tblListingStatus "\
     "indexing_disabled_changed = NOW() "\
     "WHERE domain = (%s);"
 
-sql_select_indexing_log_message = "SELECT domain, message FROM tblindexinglog WHERE domain IN ((%s)) AND status = 'COMPLETE' ORDER BY timestamp DESC LIMIT 1;"
-
 
 # SQL for admin/auth.py
 # ---------------------
@@ -147,8 +152,16 @@ sql_insert_filter = "INSERT INTO tblIndexingFilters VALUES ((%s), 'exclude', (%s
 
 sql_delete_filter = "DELETE FROM tblIndexingFilters WHERE domain = (%s) AND action = 'exclude' AND type = (%s) AND VALUE = (%s);"
 
-sql_update_indexing_status = "UPDATE tblDomains SET indexing_status = 'PENDING', indexing_status_changed = now() WHERE domain = (%s); "\
-    "INSERT INTO tblIndexingLog VALUES ((%s), 'PENDING', now());"
+# The pg_notify tells the indexer to start indexing the site straight away (see sql_update_freefull_approved)
+# A site which is already being indexed (i.e. RUNNING) isn't changed, because a PENDING site can be claimed by another indexer, and the
+# running index would overwrite the PENDING when it completes. A row is returned if the site was set to PENDING.
+sql_update_indexing_status = "WITH pending AS ( "\
+    "    UPDATE tblDomains SET indexing_status = 'PENDING', indexing_status_changed = now() "\
+    "    WHERE domain = (%s) AND indexing_status IS DISTINCT FROM 'RUNNING' RETURNING domain "\
+    "), logged AS ( "\
+    "    INSERT INTO tblIndexingLog (domain, status, timestamp) SELECT domain, 'PENDING', now() FROM pending "\
+    ") "\
+    "SELECT pg_notify('indexing_pending', domain) FROM pending;"
 
 sql_select_tier = "SELECT l.status, l.tier, t.tier_name, l.listing_end FROM tblListingStatus l INNER JOIN tblTiers t ON t.tier = l.tier WHERE l.domain = (%s) AND l.status = 'ACTIVE' ORDER BY tier DESC LIMIT 1;"
 
@@ -179,9 +192,13 @@ sql_select_indexed_domains = "SELECT d.domain FROM tblDomains d INNER JOIN tblLi
 
 sql_select_domains_allowing_subdomains = "SELECT setting_value FROM tblSettings WHERE setting_name = 'domain_allowing_subdomains';"
 
+sql_select_site_fields = "SELECT d.category, d.include_in_public_search, d.api_enabled, d.domain_first_submitted, l.tier FROM tblDomains d INNER JOIN tblListingStatus l ON d.domain = l.domain "\
+    "WHERE d.domain = (%s) AND l.status = 'ACTIVE' ORDER BY l.tier DESC LIMIT 1;"
+
 # Delete tables with foreign keys before finally deleting from tblDomains
 # Note there may still be references to the domain in tblSubscriptions and tblIndexingLog, but we want to keep those and they don't have a foreign key
-sql_delete_domain = "DELETE FROM tblValidations WHERE domain = (%s); DELETE FROM tblPermissions WHERE domain = (%s); DELETE FROM tblListingStatus WHERE domain = (%s); DELETE FROM tblIndexingFilters WHERE domain = (%s); DELETE FROM tblDomains WHERE domain = (%s);"
+# The links from the domain are removed from the link graph (tblIndexedLinks), so they are removed from the indexed_inlinks of the pages linked to when those are next updated
+sql_delete_domain = "DELETE FROM tblValidations WHERE domain = (%s); DELETE FROM tblPermissions WHERE domain = (%s); DELETE FROM tblListingStatus WHERE domain = (%s); DELETE FROM tblIndexingFilters WHERE domain = (%s); DELETE FROM tblIndexedLinks WHERE source_domain = (%s); DELETE FROM tblDomains WHERE domain = (%s);"
 
 # The SELECT coalesce(MAX(subscription_end),NOW()) AS subscription_end FROM tblSubscriptions WHERE domain = (%s) AND subscription_end > NOW()
 # returns the latest subscription end date, if the subscription end date is in the future, or NOW() if none is set, so that subscriptions can be "stacked"
@@ -206,3 +223,7 @@ sql_update_free_listing_startandend = "UPDATE tblListingStatus "\
 # ----------------------
 
 sql_check_api_enabled = "SELECT api_enabled FROM tblDomains WHERE domain = (%s);"
+
+# Add the counts of the search queries sent since the last flush, where each row is (request_hash, request, count)
+sql_upsert_search_query_log = "INSERT INTO tblSearchQueryLog AS q (request_hash, request, count, last_seen) VALUES %s "\
+    "ON CONFLICT (request_hash) DO UPDATE SET count = q.count + EXCLUDED.count, last_seen = EXCLUDED.last_seen;"
@@ -0,0 +1,29 @@
+import pytest
+from common.domainrank import get_csr_arrays, get_domain_ranks
+
+# a links to b once and c twice, b links to c, c links to a, and d has no outlinks (i.e. is dangling)
+domains = ['a.com', 'b.com', 'c.com', 'd.com']
+links = [('c.com', 'a.com', 1), ('a.com', 'b.com', 1), ('b.com', 'c.com', 1), ('a.com', 'c.com', 2), ('a.com', 'unknown.com', 1)]
+
+def test_get_csr_arrays():
+    indptr, indices, weights = get_csr_arrays(domains, links)
+    # Links to domains which aren't in the list are ignored, and the edges are sorted by source domain
+    assert indptr.tolist() == [0, 2, 3, 4, 4]
+    assert indices.tolist() == [1, 2, 2, 0]
+    # The weights of the edges from each source domain sum to 1
+    assert weights.tolist() == pytest.approx([1/3, 2/3, 1.0, 1.0])
+
+def test_get_domain_ranks():
+    ranks = get_domain_ranks(*get_csr_arrays(domains, links))
+    # The ranks are scaled so the average is 1, i.e. the underlying probabilities sum to 1
+    assert (ranks / len(domains)).sum() == pytest.approx(1.0)
+    # d.com has no inlinks, so only gets the share every domain gets from the damping factor and the dangling rank
+    assert ranks.tolist() == pytest.approx([1.5624, 0.6331, 1.6140, 0.1905], abs=1e-3)
+
+def test_get_domain_ranks_dangling_only():
+    # With no links at all every domain is dangling, so the rank is spread evenly
+    ranks = get_domain_ranks(*get_csr_arrays(domains, []))
+    assert ranks.tolist() == pytest.approx([1.0, 1.0, 1.0, 1.0])
+
+def test_get_domain_ranks_empty():
+    assert len(get_domain_ranks(*get_csr_arrays([], []))) == 0
@@ -0,0 +1,68 @@
+import pytest
+from scrapy.http import Request, Response
+from scrapy.exceptions import IgnoreRequest
+from indexer.middlewares import PageLimitMiddleware
+
+class FakeStats:
+    def __init__(self):
+        self.values = {}
+    def get_value(self, key, default=None):
+        return self.values.get(key, default)
+    def inc_value(self, key, count=1):
+        self.values[key] = self.values.get(key, 0) + count
+
+class FakeSpider:
+    site_config = {'indexing_page_limit': 2}
+
+def test_page_limit():
+    stats = FakeStats()
+    middleware = PageLimitMiddleware(stats)
+    spider = FakeSpider()
+    request1 = Request('https://michael-lewis.com/a/')
+    request2 = Request('https://michael-lewis.com/b/')
+    middleware.process_request(request1, spider)
+    middleware.process_request(request2, spider)
+    assert middleware.requests_in_flight == 2
+    # Requests beyond the limit are ignored, unless exempt
+    with pytest.raises(IgnoreRequest):
+        middleware.process_request(Request('https://michael-lewis.com/c/'), spider)
+    middleware.process_request(Request('https://michael-lewis.com/sitemap.xml', meta={'page_limit_exempt': True}), spider)
+    assert middleware.requests_in_flight == 2
+    # A response frees the slot until the item is scraped
+    middleware.process_response(request1, Response(request1.url), spider)
+    stats.inc_value('item_scraped_count')
+    assert middleware.requests_in_flight == 1
+    with pytest.raises(IgnoreRequest):
+        middleware.process_request(Request('https://michael-lewis.com/c/'), spider)
+    assert stats.get_value('pagelimit/ignored') == 2
+
+def test_page_limit_redirect_dropped():
+    stats = FakeStats()
+    middleware = PageLimitMiddleware(stats)
+    spider = FakeSpider()
+    request = Request('https://michael-lewis.com/a')
+    middleware.process_request(request, spider)
+    # The redirect response is seen before the RedirectMiddleware, so the count isn't left behind if the redirect is then dropped
+    # (e.g. by the dupefilter) or ignored (e.g. for too many redirects)
+    middleware.process_response(request, Response(request.url, status=301, headers={'Location': '/a/'}), spider)
+    assert middleware.requests_in_flight == 0
+    redirect = request.replace(url='https://michael-lewis.com/a/')
+    middleware.request_dropped(redirect, spider)
+    assert middleware.requests_in_flight == 0
+    # A redirect which isn't dropped is counted again, and isn't ignored even if the limit has been reached
+    stats.inc_value('item_scraped_count', 2)
+    middleware.request_scheduled(redirect, spider)
+    middleware.process_request(redirect, spider)
+    assert middleware.requests_in_flight == 1
+    middleware.process_exception(redirect, Exception(), spider)
+    assert middleware.requests_in_flight == 0
+
+def test_page_limit_counted_not_persisted():
+    stats = FakeStats()
+    middleware = PageLimitMiddleware(stats)
+    spider = FakeSpider()
+    request = Request('https://michael-lewis.com/a/')
+    middleware.process_request(request, spider)
+    middleware.request_scheduled(request, spider)
+    assert 'page_limit_counted' not in request.meta
+    assert middleware.requests_in_flight == 0
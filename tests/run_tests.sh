@@ -6,6 +6,9 @@ set -a; source ~/projects/searchmysite.net/src/.env; set +a
 
 echo "Unit test"
 pytest web/unit/test_adminutil.py
+pytest web/unit/test_searchapi.py
+PYTHONPATH=$PYTHONPATH:~/projects/searchmysite.net/src/indexing/ pytest indexer/unit/test_middlewares.py
+PYTHONPATH=$PYTHONPATH:~/projects/searchmysite.net/src/indexing/ pytest indexer/unit/test_domainrank.py
 
 echo "PART 1 of 6: Submitting a Basic listing"
 pytest -v web/integration/test_1_addbasic.py
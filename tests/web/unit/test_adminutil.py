@@ -1,7 +1,19 @@
 from searchmysite.adminutils import extract_domain
+from searchmysite.domainresolver import extract_domain_from_url
 
 # Might also want to test domain_allowing_subdomains, e.g. user.github.io
 # That would require initialising tblSettings accordingly
 def test_extract_domain(anon_client):
     domain = extract_domain("https://www.michael-lewis.com/")
-    assert domain == "michael-lewis.com"
\ No newline at end of file
+    assert domain == "michael-lewis.com"
+
+def test_extract_domain_from_url():
+    assert extract_domain_from_url("https://user1.github.io/about/", {"github.io"}) == "user1.github.io"
+    assert extract_domain_from_url("https://user1.github.io/about/", set()) == "github.io"
+    assert extract_domain_from_url("https://www.Michael-Lewis.com:443/about/?page=1", set()) == "michael-lewis.com"
+    assert extract_domain_from_url("http://localhost:8080/", set()) == "localhost"
+    # Only a scheme at the start is removed, and a URL with a scheme but no // has no hostname
+    assert extract_domain_from_url("example.com/?ref=https://evil.com/", set()) == "example.com"
+    assert extract_domain_from_url("mailto:foo@bar.com", set()) == ""
+    assert extract_domain_from_url("www.michael-lewis.com:443/about/", set()) == "michael-lewis.com"
+    assert extract_domain_from_url("//www.michael-lewis.com/about/", set()) == "michael-lewis.com"
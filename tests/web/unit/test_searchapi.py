@@ -0,0 +1,29 @@
+import json
+import searchmysite.api.searchapi
+from searchmysite.api.searchapi import get_answer_context
+
+def test_get_answer_context():
+    chunks = [
+        {"url": "https://michael-lewis.com/a/", "content_chunk_text": "a" * 400, "score": 0.9},
+        {"url": "https://michael-lewis.com/a/", "content_chunk_text": "a" * 400, "score": 0.8},
+        {"url": "https://michael-lewis.com/b/", "content_chunk_text": "b" * 400, "score": 0.7},
+        {"url": "https://michael-lewis.com/c/", "content_chunk_text": "c" * 400, "score": 0.6},
+    ]
+    context, sources = get_answer_context(chunks, 250)
+    # Duplicate chunks are skipped and chunks are added until the token budget (approx 4 chars per token) is reached
+    assert context == "a" * 400 + " " + "b" * 400
+    assert [source["url"] for source in sources] == ["https://michael-lewis.com/a/", "https://michael-lewis.com/b/"]
+
+def test_answer_no_question(anon_client):
+    response = anon_client.get('/api/v1/answer/?q=%20&domain=*')
+    assert response.status_code == 400
+
+def test_answer_from_cache(anon_client, monkeypatch):
+    # A cached answer is returned without the vector search or model server being called
+    sources = [{"url": "https://michael-lewis.com/a/", "score": 0.9}]
+    monkeypatch.setattr(searchmysite.api.searchapi, "get_answer_index_generation", lambda: 42)
+    monkeypatch.setitem(searchmysite.api.searchapi.answer_cache, ("how high is ben nevis", "*", 42), (sources, "1345m"))
+    response = anon_client.get('/api/v1/answer/?q=How%20high%20is%20Ben%20Nevis&domain=*')
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == [{"sources": sources}, {"answer": "1345m"}]